@@ -0,0 +1,62 @@
+import os
+import json
+import functools
+import numpy as np
+
+# A CAP embedding bank packs all per-CAP embeddings into one memory-mapped array:
+#     <bank_dir>/embeddings.npy  (total length, embedding dim) float32 or float16, CAPs concatenated
+#     <bank_dir>/index.json      dtype, dim and [offset, length] of each CAP
+# Built by utils/pack_cap_embeddings.py. Embeddings are addressed as <bank_dir>/<cap>.
+
+class CapEmbeddingBank:
+    ''' Reader of a packed CAP embedding bank, embeddings are zero-copy views of one memmap.
+    The memmap is copy-on-write so views convert to tensors like regular arrays, the bank file is never modified.
+    '''
+
+    def __init__(self, bank_dir):
+        self.bank_dir = bank_dir
+        with open(os.path.join(bank_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.dtype = np.dtype(index['dtype'])
+        self.dim = index['dim']
+        self.caps = {cap : tuple(span) for cap, span in index['caps'].items()}
+        self.embeddings = np.load(os.path.join(bank_dir, 'embeddings.npy'), mmap_mode = 'c')
+
+    def __contains__(self, cap):
+        return cap in self.caps
+
+    def __len__(self):
+        return len(self.caps)
+
+    def get(self, cap):
+        ''' Get the (length, dim) embedding of a CAP as a view of the bank '''
+        if cap not in self.caps:
+            raise KeyError(f'CAP {cap} not found in embedding bank {self.bank_dir}')
+        offset, length = self.caps[cap]
+        return self.embeddings[offset : offset + length]
+
+    def __getstate__(self):
+        # Workers reopen the memmap instead of pickling its content
+        state = self.__dict__.copy()
+        del state['embeddings']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.embeddings = np.load(os.path.join(self.bank_dir, 'embeddings.npy'), mmap_mode = 'c')
+
+@functools.lru_cache(maxsize = None)
+def open_cap_bank(bank_dir):
+    ''' Open a bank once per process, shared by all datasets '''
+    return CapEmbeddingBank(bank_dir)
+
+def is_cap_bank(path):
+    return os.path.exists(os.path.join(path, 'index.json')) and os.path.exists(os.path.join(path, 'embeddings.npy'))
+
+def load_esm_feature(esm_feature_path):
+    ''' Load a CAP embedding from <cap>.npz or from a bank as <bank_dir>/<cap>, as float32 '''
+    bank_dir, cap = os.path.split(esm_feature_path)
+    if not esm_feature_path.endswith('.npz') and is_cap_bank(bank_dir):
+        embedding = open_cap_bank(bank_dir).get(cap)
+        return embedding if embedding.dtype == np.float32 else embedding.astype(np.float32)
+    return np.load(esm_feature_path)['embedding']
@@ -1,12 +1,17 @@
 import chromnitron_data.transforms as transforms
 
-from chromnitron_data.origami_infrastructure.tracks import Track
-from chromnitron_data.origami_infrastructure.storages import ZarrStorage
+from chromnitron_data.origami_infrastructure.tracks import Track, TrackSum, StackedSampleTrack
+from chromnitron_data.origami_infrastructure.variants import VariantOverlayStorage
+from chromnitron_data.origami_infrastructure.storages import ZarrStorage, PreloadedZarrStorage, StackedZarrStorage, MergedTrackStorage, BigWigStorage, RLEStorage, FastaStorage, TwoBitStorage
 from chromnitron_data.origami_infrastructure.partitions import CustomRangeRegion
+from chromnitron_data.cap_bank import load_esm_feature
 
 import numpy as np
 from torch.utils.data import Dataset
 
+# Stand-in returned per sample for inputs served through the static input channel
+STATIC_INPUT_PLACEHOLDER = np.empty(0, dtype = np.float32)
+
 def get_inference_region(loci_info, assembly, chr_sizes, sample_size, step_size, excluded_region_path, excluded_chrs = ['chrY', 'chrM']):
     region = CustomRangeRegion(sample_size, step_size, loci_info, excluded_region_path, assembly, chr_sizes, excluded_chrs, verbose = False)
     return region
@@ -16,7 +21,33 @@ class InferenceDataset(Dataset):
                  assembly, chr_sizes,
                  verbose = False, metadata_key = 'NaN', 
                  sample_size = 8192, step_size = 5120,
-                 excluded_region_path = None):
+                 excluded_region_path = None,
+                 seq_encoding = 'onehot',
+                 static_esm_feature = False,
+                 chunk_cache_size = 0, shared_chunk_cache = False,
+                 decoded_cache_dir = None, decoded_cache_size = None, decoded_cache_mode = 'spans',
+                 input_features_sample = None,
+                 vcf_path = None, vcf_sample = None, vcf_haplotype = 0,
+                 replicate_threads = 1, merged_replicate_cache = False,
+                 excluded_index = None, stacked_storage = None):
+        ''' seq_encoding: 'onehot' returns float32 one-hot (length, 5) sequence,
+                          'codes' returns uint8 base codes (length) expanded to one-hot by the model
+        static_esm_feature: serve the CAP embedding once through get_static_inputs instead of with every sample
+        chunk_cache_size: bytes of decompressed zarr chunks cached per storage, 0 disables caching
+        shared_chunk_cache: share chunk caches across DataLoader workers through shared memory
+        decoded_cache_dir: local directory caching decoded zarr tracks as .npy memmaps, None disables it
+        decoded_cache_size: maximum decoded cache size in bytes, None for unlimited
+        decoded_cache_mode: 'spans' decodes only the windows of this job, 'full' decodes whole chromosomes
+        input_features_sample: sample name when input_features_path is a stacked multi-sample store
+        vcf_path: VCF of an individual whose SNVs and indels are applied to the reference sequence, None for the reference
+        vcf_sample: VCF sample name, None for the first sample
+        vcf_haplotype: haplotype (0 or 1) of phased genotypes to apply
+        replicate_threads: threads reading replicates concurrently when input_features_path is a list of replicates to sum
+        merged_replicate_cache: materialize the replicate sum once into decoded_cache_dir
+        excluded_index: prebuilt IntervalIndex of excluded_region_path shared across datasets, None to load it
+        stacked_storage: StackedZarrStorage of input_features_path shared across cell types, None to open it
+        '''
+        assert seq_encoding in ['onehot', 'codes']
         # Print target features
         if verbose:
             print(f'Loading input seq from {input_seq_path}')
@@ -25,9 +56,22 @@ class InferenceDataset(Dataset):
         self.input_seq_path = input_seq_path
         self.input_features_path = input_features_path
         self.esm_feature_path = esm_feature_path
+        self.seq_encoding = seq_encoding
+        self.static_esm_feature = static_esm_feature
+        self.cache_kwargs = {'cache_size' : chunk_cache_size, 'shared_cache' : shared_chunk_cache}
+        assert decoded_cache_mode in ['spans', 'full']
+        self.decoded_cache_dir = decoded_cache_dir
+        self.decoded_cache_size = decoded_cache_size
+        self.decoded_cache_mode = decoded_cache_mode
+        self.input_features_sample = input_features_sample
+        self.stacked_storage = stacked_storage
+        self.variant_kwargs = {'vcf_path' : vcf_path, 'sample' : vcf_sample, 'haplotype' : vcf_haplotype}
+        self.replicate_threads = replicate_threads
+        self.merged_replicate_cache = merged_replicate_cache
         self.verbose = verbose
 
-        self.region = get_inference_region(loci_info, assembly, chr_sizes, sample_size, step_size, excluded_region_path)
+        excluded_regions = excluded_region_path if excluded_index is None else excluded_index
+        self.region = get_inference_region(loci_info, assembly, chr_sizes, sample_size, step_size, excluded_regions)
         # Initialize data
         self.data = self.load_data(input_seq_path, input_features_path, esm_feature_path, assembly, chr_sizes, verbose)
 
@@ -36,16 +80,83 @@ class InferenceDataset(Dataset):
         data_dict = {'seq' : None,
                      'input_features' : None,
                      'esm_feature' : None}
-        data_dict['seq'] = Track(ZarrStorage(input_seq_path, assembly, chr_sizes))
-        data_dict['input_features'] = self.load_storage_with_paths(assembly, 'input_features', input_features_path, chr_sizes)
-        data_dict['esm_feature'] = np.load(esm_feature_path)['embedding']
+        seq_storage = self.open_seq_storage(input_seq_path, assembly, chr_sizes)
+        if self.variant_kwargs['vcf_path'] is not None:
+            seq_storage = VariantOverlayStorage(seq_storage, **self.variant_kwargs)
+        data_dict['seq'] = Track(seq_storage)
+        if self.input_features_sample is not None:
+            stacked_storage = self.stacked_storage
+            if stacked_storage is None:
+                stacked_storage = StackedZarrStorage(input_features_path, assembly, chr_sizes, **self.cache_kwargs)
+            # Only the row of this sample is read and dequantized
+            sample_storage = stacked_storage.select([self.input_features_sample])
+            data_dict['input_features'] = StackedSampleTrack(sample_storage, self.input_features_sample)
+        elif isinstance(input_features_path, list):
+            data_dict['input_features'] = self.load_replicate_sum(input_features_path, assembly, chr_sizes)
+        else:
+            data_dict['input_features'] = self.load_storage_with_paths(assembly, 'input_features', input_features_path, chr_sizes)
+        data_dict['esm_feature'] = load_esm_feature(esm_feature_path)
         return data_dict
 
+    def open_seq_storage(self, path, assembly, chr_sizes):
+        ''' Open a sequence storage by file type: .2bit, (bgzip) FASTA with .fai index, or zarr '''
+        if path.endswith('.2bit'):
+            return TwoBitStorage(path, assembly, chr_sizes)
+        if path.endswith(('.fa', '.fasta', '.fa.gz', '.fasta.gz', '.fa.bgz', '.fasta.bgz')):
+            return FastaStorage(path, assembly, chr_sizes)
+        return self.open_zarr_storage(path, assembly, chr_sizes)
+
+    def encode_seq(self, seq):
+        ''' Convert sequence storage output to uint8 base codes '''
+        if self.data['seq'].storage.base_codes:
+            return seq
+        return transforms.encode_bases(seq)
+
+    def open_zarr_storage(self, path, assembly, chr_sizes):
+        if self.decoded_cache_dir is None:
+            return ZarrStorage(path, assembly, chr_sizes, **self.cache_kwargs)
+        spans = self.get_region_spans() if self.decoded_cache_mode == 'spans' else None
+        return PreloadedZarrStorage(path, assembly, chr_sizes,
+                                    cache_dir = self.decoded_cache_dir, max_cache_size = self.decoded_cache_size,
+                                    spans = spans, **self.cache_kwargs)
+
+    def open_feature_storage(self, path, assembly, chr_sizes, decoded_cache = True):
+        ''' Open a feature storage by file type: bigWig, run-length encoded zarr or zarr, through the decoded track cache if enabled '''
+        if path.endswith(('.bw', '.bigwig', '.bigWig')):
+            return BigWigStorage(path, assembly, chr_sizes, **self.cache_kwargs)
+        if path.endswith('.rle.zarr'):
+            return RLEStorage(path, assembly, chr_sizes)
+        if not decoded_cache:
+            return ZarrStorage(path, assembly, chr_sizes, **self.cache_kwargs)
+        return self.open_zarr_storage(path, assembly, chr_sizes)
+
+    def load_replicate_sum(self, paths, assembly, chr_sizes):
+        ''' Sum of replicate tracks, read concurrently or from the merged replicate cache '''
+        merged = self.merged_replicate_cache and self.decoded_cache_dir is not None
+        # Only the sum is cached when merging, replicates are read once to build it
+        storages = [self.open_feature_storage(path, assembly, chr_sizes, decoded_cache = not merged) for path in paths]
+        replicate_sum = TrackSum(storages, num_threads = self.replicate_threads)
+        if not merged:
+            return replicate_sum
+        spans = self.get_region_spans() if self.decoded_cache_mode == 'spans' else None
+        return Track(MergedTrackStorage(replicate_sum, paths, assembly, chr_sizes,
+                                        cache_dir = self.decoded_cache_dir, max_cache_size = self.decoded_cache_size, spans = spans))
+
+    def get_region_spans(self):
+        ''' Get the spans covered by the windows of this dataset per chromosome '''
+        spans = {}
+        windows = self.region.to_table()
+        for chrom_code, chrom in enumerate(windows.chrom_names):
+            chrom_mask = windows.chrom_codes == chrom_code
+            if chrom_mask.any():
+                spans[str(chrom)] = list(zip(windows.starts[chrom_mask].tolist(), windows.ends[chrom_mask].tolist()))
+        return spans
+
     def load_storage_with_paths(self, assembly, feature_name, paths, chr_sizes):
         if isinstance(paths, str):
             if paths == '':
                 return None
-            return Track(ZarrStorage(paths, assembly, chr_sizes))
+            return Track(self.open_feature_storage(paths, assembly, chr_sizes))
         elif isinstance(paths, list):
             return [self.load_storage_with_paths(assembly, feature_name, path, chr_sizes) for path in paths]
         else:
@@ -61,23 +172,103 @@ class InferenceDataset(Dataset):
         else:
             raise ValueError(f'Invalid features: {features}')
 
+    def cache_stats(self):
+        ''' Get chunk cache statistics per input, None if caching is disabled '''
+        if self.cache_kwargs['cache_size'] <= 0:
+            return None
+        stats = {'seq' : self.data['seq'].storage.cache_stats()}
+        features = self.data['input_features']
+        features = features if isinstance(features, list) else [features]
+        for feature_idx, feature in enumerate(features):
+            if isinstance(feature, TrackSum):
+                for replicate_idx, storage in enumerate(feature.storage):
+                    stats[f'input_features_{feature_idx}_replicate_{replicate_idx}'] = storage.cache_stats()
+            elif feature is not None:
+                stats[f'input_features_{feature_idx}'] = feature.storage.cache_stats()
+        return stats
+
+    def get_static_inputs(self):
+        ''' Inputs shared by every sample of the job, to be moved to device once and broadcast by the model
+        return: None or dict of arrays with a leading batch dimension of 1
+        '''
+        if not self.static_esm_feature:
+            return None
+        return {'esm_feature' : self.data['esm_feature'][np.newaxis, np.newaxis, :, :]}
+
     def __len__(self):
         return len(self.region)
 
+    def find_windows(self, chrom, start, end, contained = False):
+        ''' Indices of windows overlapping [start, end), or containing it with contained, chrom None searches all chromosomes '''
+        return self.region.find_windows(chrom, start, end, contained)
+
+    def get_features_many(self, features, chrom, starts, ends):
+        if features is None:
+            return np.nan * np.ones((len(starts), ends[0] - starts[0]))
+        if isinstance(features, Track):
+            return features.get_many(chrom, starts, ends)
+        elif isinstance(features, list):
+            return [self.get_features_many(feature, chrom, starts, ends) for feature in features]
+        else:
+            raise ValueError(f'Invalid features: {features}')
+
+    def select_features(self, features, window_idx):
+        if isinstance(features, list):
+            return [self.select_features(feature, window_idx) for feature in features]
+        return features[window_idx]
+
     def __getitem__(self, idx):
         # Get sampled region
-        chrom, start_str, end_str, region_id = self.region[idx]
-        start, end = int(start_str), int(end_str)
+        chrom, start, end, region_id = self.region[idx]
         # Get features
-        seq = transforms.to_onehot(self.data['seq'].get(chrom, start, end))
+        seq = self.encode_seq(self.data['seq'].get(chrom, start, end))
         input_features = self.get_features(self.data['input_features'], chrom, start, end)
-        esm_feature = self.data['esm_feature']
+        return self.make_sample(seq, input_features, chrom, start, end, region_id)
+
+    def __getitems__(self, indices):
+        ''' Batched fetch used by DataLoader, overlapping windows on a chromosome are read as one span '''
+        samples = [None] * len(indices)
+        for group in self.group_windows(indices):
+            chrom = group[0][1]
+            starts = [start for _, _, start, _, _ in group]
+            ends = [end for _, _, _, end, _ in group]
+            seqs = self.encode_seq(self.data['seq'].get_many(chrom, starts, ends))
+            input_features = self.get_features_many(self.data['input_features'], chrom, starts, ends)
+            for window_idx, (sample_idx, _, start, end, region_id) in enumerate(group):
+                window_features = self.select_features(input_features, window_idx)
+                samples[sample_idx] = self.make_sample(seqs[window_idx], window_features, chrom, start, end, region_id)
+        return samples
+
+    def group_windows(self, indices):
+        ''' Group windows by chromosome into runs of overlapping windows '''
+        windows = []
+        for sample_idx, idx in enumerate(indices):
+            windows.append((sample_idx, *self.region[idx]))
+        windows.sort(key = lambda window: (window[1], window[2]))
+        groups = []
+        for window in windows:
+            _, chrom, start, end, _ = window
+            last_group = groups[-1] if len(groups) > 0 else None
+            if last_group is not None and last_group[-1][1] == chrom and start <= last_group[-1][3] \
+                    and end - start == last_group[-1][3] - last_group[-1][2]:
+                last_group.append(window)
+            else:
+                groups.append([window])
+        return groups
+
+    def make_sample(self, seq, input_features, chrom, start, end, region_id):
+        ''' Assemble a sample from uint8 base codes and raw input features '''
+        if self.seq_encoding == 'onehot':
+            seq = transforms.codes_to_onehot(seq)
+        if self.static_esm_feature:
+            esm_feature = STATIC_INPUT_PLACEHOLDER
+        else:
+            esm_feature = self.data['esm_feature'][np.newaxis, :, :]
         # log(1+x) transform features
         input_features = transforms.log1p_clip_negative(input_features)
         # Add zero dimension to esm_feature
-        seq = seq[np.newaxis, :, :]
+        seq = seq[np.newaxis]
         input_features = input_features[np.newaxis, :]
-        esm_feature = esm_feature[np.newaxis, :, :]
         return seq, input_features, esm_feature, (start, end, chrom, region_id, self.metadata_key)
 
 class InferenceSNPDataset(Dataset):
@@ -103,21 +294,15 @@ class InferenceSNPDataset(Dataset):
 
         snp_data_list = []
 
-        for data in dataset:
-            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = data
-            # Remove regions that do not contain the SNP
-            margin = 2000
-            if chrom != snp_chrom or start > snp_location - margin or end < snp_location + margin: continue
+        # Only read regions that contain the SNP with a margin
+        margin = 2000
+        for idx in dataset.find_windows(snp_chrom, snp_location - margin, snp_location + margin, contained = True):
+            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = dataset[idx]
             if chrom == snp_chrom and start <= snp_location and end >= snp_location:
-                base_seq = transforms.onehot_to_base(seq[0, :, :])
                 snp_offset = snp_location - start - 1
-                assert base_seq[snp_offset] == wt_base.lower()
-                # Covert string to list
-                snp_seq_list = list(base_seq)
-                snp_seq_list[snp_offset] = mut_base.lower()
-                snp_seq = ''.join(snp_seq_list)
-                snp_seq = transforms.to_onehot(snp_seq)
-                snp_seq = snp_seq[np.newaxis, :, :]
+                # Edit the base on a copy, seq is either one-hot or uint8 base codes
+                assert transforms.get_base(seq[0], snp_offset) == transforms.encode_bases(wt_base)[0]
+                snp_seq = transforms.set_base(seq.copy(), snp_offset, transforms.encode_bases(mut_base)[0])
                 # Edit region_id
                 snp_region_id = f'{region_id}_snp_info_{snp_offset}_{wt_base}_to_{mut_base}'
                 snp_data_list.append((snp_seq, input_features, esm_feature, (start, end, chrom, snp_region_id, metadata_key)))
@@ -133,128 +318,143 @@ class InferenceSNPDataset(Dataset):
         return len(self.dataset) + len(self.snp_dataset)
 
 class InferenceMotifDataset(Dataset):
+    ''' In-silico mutagenesis around mutation centers, generated lazily from (window, offset, base).
+    Every mutated window contributes its reference item followed by one item per non-reference base
+    at each offset within mutation_radius of its center. Edits are described in mutation_table.
+    '''
+
     def __init__(self, dataset, motif_config = None, mutation_center_list = None):
         self.motif_config = motif_config
         self.mutation_center_list = mutation_center_list
         self.dataset = dataset
-        self.motif_dataset = self.get_motif_dataset(motif_config, dataset)
+        self.mutation_table = self.get_mutation_table(motif_config, dataset)
+        self.item_windows = self.mutation_table['window'].to_numpy()
+        self.item_offsets = self.mutation_table['offset'].to_numpy()
+        self.item_bases = transforms.encode_bases(''.join(self.mutation_table['alt'].replace('', 'N')))
 
     def __getitem__(self, idx):
-        return self.motif_dataset[idx]
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        ''' Items of a batch, every window is read once and copied for each of its edits '''
+        window_indices = np.unique(self.item_windows[indices]).tolist()
+        window_samples = dict(zip(window_indices, self.dataset.__getitems__(window_indices)))
+        samples = []
+        for idx in indices:
+            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = window_samples[self.item_windows[idx]]
+            offset = self.item_offsets[idx]
+            if offset < 0:
+                samples.append((seq, input_features, esm_feature, (start, end, chrom, f'{region_id}|WT', metadata_key)))
+                continue
+            mut_seq = transforms.set_base(seq.copy(), offset, self.item_bases[idx])
+            mut_info = f'|{offset}_mut:{self.mutation_table["alt"].iat[idx]}'
+            samples.append((mut_seq, input_features, esm_feature, (start, end, chrom, region_id + mut_info, metadata_key)))
+        return samples
 
     def __len__(self):
-        return len(self.motif_dataset)
+        return len(self.mutation_table)
 
-    def get_motif_dataset(self, motif_config, dataset):
+    def get_mutation_table(self, motif_config, dataset):
+        ''' One row per item: window, chr, start, end, region_id, offset (-1 for the reference window), position, ref and alt base '''
+        import pandas as pd
         if self.mutation_center_list is not None:
             mut_center_list = self.mutation_center_list
         else:
             mut_center_list = motif_config['loci']['mutation_center']
         mut_radius = motif_config['loci']['mutation_radius']
-        motif_dataset = []
-        for data in dataset:
-            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = data
-            # Create mutation dataset
-            # Check if mutation center is a list
-            if not isinstance(mut_center_list, list):
-                mut_center = mut_center_list
-            else:
-                # Select the first mutation center falling into the region
-                mut_center = None
-                for mut_center_i in mut_center_list:
-                    if start <= mut_center_i and end >= mut_center_i:
-                        mut_center = mut_center_i
-                        break
-                if mut_center is None:
-                    continue
-            mut_start = mut_center - mut_radius
-            mut_end = mut_center + mut_radius
-            mut_start_offset = mut_start - start
-            mut_end_offset = mut_end - start
-            seq_list, mut_info_list = self.mutate_seq(seq, mut_start_offset, mut_end_offset)
-            for seq, mut_info in zip(seq_list, mut_info_list):
-                motif_dataset.append((seq, input_features, esm_feature, (start, end, chrom, region_id + mut_info, metadata_key)))
-        return motif_dataset
-
-    def mutate_seq(self, seq, mut_start, mut_end):
-        seq_list = []
-        seq_list.append(seq)
-        mut_info_list = []
-        base_seq = transforms.onehot_to_base(seq[0, :, :])
-        mut_info_list.append(f'|WT_ref_seq:{base_seq}')
-        for i in range(mut_start, mut_end):
-            seq_list.extend(self.gen_mutations(seq, i))
-            mut_info_list.extend([f'|{i}_mut:A', f'|{i}_mut:C', f'|{i}_mut:G', f'|{i}_mut:T'])
-        return seq_list, mut_info_list
-
-    def gen_mutations(self, seq, i):
-        seqs = []
-        new_seq = seq.copy()
-        new_seq[0, i] = [1, 0, 0, 0, 0]
-        seqs.append(new_seq)
-        new_seq = seq.copy()
-        new_seq[0, i] = [0, 1, 0, 0, 0]
-        seqs.append(new_seq)
-        new_seq = seq.copy()
-        new_seq[0, i] = [0, 0, 1, 0, 0]
-        seqs.append(new_seq)
-        new_seq = seq.copy()
-        new_seq[0, i] = [0, 0, 0, 1, 0]
-        seqs.append(new_seq)
-        return seqs
+        columns = {'window' : [], 'chr' : [], 'start' : [], 'end' : [], 'region_id' : [], 'offset' : [], 'position' : [], 'ref' : [], 'alt' : []}
+        def add_row(window, chrom, start, end, region_id, offset, ref, alt):
+            for name, value in zip(columns, [window, chrom, start, end, region_id, offset, start + offset if offset >= 0 else -1, ref, alt]):
+                columns[name].append(value)
+        for idx, mut_center in self.find_mutation_windows(dataset, mut_center_list):
+            chrom, start, end, region_id = dataset.region[idx]
+            # Only the reference bases are read here, windows are loaded when items are fetched
+            ref_codes = dataset.encode_seq(dataset.data['seq'].get(chrom, start, end))
+            add_row(idx, chrom, start, end, region_id, -1, '', '')
+            mut_start_offset = max(mut_center - mut_radius - start, 0)
+            mut_end_offset = min(mut_center + mut_radius - start, end - start)
+            for offset in range(mut_start_offset, mut_end_offset):
+                ref_base = transforms.BASES[ref_codes[offset]].upper()
+                for alt_base in 'ACGT':
+                    if alt_base != ref_base: # Skip reference-identical edits
+                        add_row(idx, chrom, start, end, region_id, offset, ref_base, alt_base)
+        return pd.DataFrame(columns)
+
+    def find_mutation_windows(self, dataset, mut_center_list):
+        ''' (window index, mutation center) pairs in dataset order '''
+        # A single mutation center is applied to every region
+        if not isinstance(mut_center_list, list):
+            return [(idx, mut_center_list) for idx in range(len(dataset))]
+        # Select the first mutation center falling into the region, centers are positions on any chromosome
+        window_centers = {}
+        for mut_center in mut_center_list:
+            for idx in dataset.find_windows(None, mut_center, mut_center, contained = True):
+                window_centers.setdefault(int(idx), mut_center)
+        return sorted(window_centers.items())
 
 class InferenceATACPerturbInPlaceDataset(Dataset):
+    ''' ATAC-seq dose-response around a peak, generated lazily over the (value, radius) grid.
+    Every window covering the peak contributes its reference item followed by one item per grid point,
+    values in the outer and radii in the inner loop. Item idx maps to window idx // grid_size and
+    grid point idx % grid_size, so memory does not grow with the grid.
+    '''
 
     def __init__(self, dataset, perturb_in_place_config):
-        self.perturb_in_place_config = perturb_in_place_config
-        self.dataset = dataset
-        self.perturb_in_place_dataset = self.get_perturb_in_place_dataset(perturb_in_place_config, dataset)
-
-    def get_perturb_in_place_dataset(self, perturb_in_place_config, dataset):
         '''
         loci:
             chr_name: chr5
             location: 1295113
-        mutation:
-            from: G
-            to: A
+        perturbation_radius: 500 or [start, end, step]
+        value_range: [start, end, step] scaling of the log1p ATAC-seq signal
         '''
-        ptb_chrom = perturb_in_place_config['loci']['chr_name']
-        ptb_location = perturb_in_place_config['loci']['location']
-        ptb_radius_config = perturb_in_place_config['perturbation_radius']
+        self.perturb_in_place_config = perturb_in_place_config
+        self.dataset = dataset
+        self.ptb_chrom = perturb_in_place_config['loci']['chr_name']
+        self.ptb_location = perturb_in_place_config['loci']['location']
         ptb_value_range_num = perturb_in_place_config['value_range']
-        ptb_value_range = np.arange(ptb_value_range_num[0], ptb_value_range_num[1], ptb_value_range_num[2])
+        self.ptb_values = np.arange(ptb_value_range_num[0], ptb_value_range_num[1], ptb_value_range_num[2])
+        ptb_radius_config = perturb_in_place_config['perturbation_radius']
+        if isinstance(ptb_radius_config, list):
+            self.ptb_radii = np.arange(ptb_radius_config[0], ptb_radius_config[1], ptb_radius_config[2])
+        else:
+            self.ptb_radii = np.array([ptb_radius_config])
+        self.grid_size = 1 + len(self.ptb_values) * len(self.ptb_radii)
+        self.windows = self.find_perturbation_windows(dataset)
 
-        ptb_data_list = []
+    def find_perturbation_windows(self, dataset):
+        ''' Indices of windows that contain the perturbation with a margin '''
+        margin = 1000
+        return dataset.find_windows(self.ptb_chrom, self.ptb_location - margin, self.ptb_location + margin, contained = True)
 
-        for data in dataset:
-            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = data
-            # Remove regions that do not contain the SNP
-            margin = 1000
-            if chrom != ptb_chrom or start > ptb_location - margin or end < ptb_location + margin: 
-                print(f'region {region_id} too far from {ptb_location}')
-                continue
-            atac_wt = input_features.copy()
-            for value in ptb_value_range:
-                if isinstance(ptb_radius_config, list):
-                    ptb_radius_range = np.arange(ptb_radius_config[0], ptb_radius_config[1], ptb_radius_config[2])
-                else:
-                    ptb_radius_range = [ptb_radius_config]
-
-                for ptb_radius in ptb_radius_range:
-                    ptb_start_relative = ptb_location - start - ptb_radius
-                    ptb_end_relative = ptb_location - start + ptb_radius
-                    ptb_atac = atac_wt.copy()
-                    ptb_atac[:, ptb_start_relative:ptb_end_relative] = atac_wt[:, ptb_start_relative:ptb_end_relative] * value
-                    ptb_region_id = f'{region_id}|ptb_atac_info:{value}|peak_center:{ptb_location}|peak_radius:{ptb_radius}'
-                    ptb_data_list.append((seq, ptb_atac, esm_feature, (start, end, chrom, ptb_region_id, metadata_key)))
-        return ptb_data_list
+    def grid_point(self, idx):
+        ''' Window index, value and radius of an item, None value and radius for the reference item '''
+        window_idx, grid_idx = divmod(idx, self.grid_size)
+        if grid_idx == 0:
+            return int(self.windows[window_idx]), None, None
+        value_idx, radius_idx = divmod(grid_idx - 1, len(self.ptb_radii))
+        return int(self.windows[window_idx]), self.ptb_values[value_idx], self.ptb_radii[radius_idx]
 
     def __getitem__(self, idx):
-        if idx < len(self.dataset):
-            return self.dataset[idx]
-        else:
-            return self.perturb_in_place_dataset[idx - len(self.dataset)]
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        ''' Items of a batch, every window is read once and scaled for each of its grid points '''
+        grid_points = [self.grid_point(idx) for idx in indices]
+        window_indices = sorted(set(window_idx for window_idx, _, _ in grid_points))
+        window_samples = dict(zip(window_indices, self.dataset.__getitems__(window_indices)))
+        samples = []
+        for window_idx, value, ptb_radius in grid_points:
+            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = window_samples[window_idx]
+            if value is None:
+                samples.append((seq, input_features, esm_feature, (start, end, chrom, f'{region_id}|WT', metadata_key)))
+                continue
+            ptb_start_relative = max(self.ptb_location - start - ptb_radius, 0)
+            ptb_end_relative = max(self.ptb_location - start + ptb_radius, 0)
+            ptb_atac = input_features.copy()
+            ptb_atac[:, ptb_start_relative:ptb_end_relative] *= value
+            ptb_region_id = f'{region_id}|ptb_atac_info:{value}|peak_center:{self.ptb_location}|peak_radius:{ptb_radius}'
+            samples.append((seq, ptb_atac, esm_feature, (start, end, chrom, ptb_region_id, metadata_key)))
+        return samples
 
     def __len__(self):
-        return len(self.dataset) + len(self.perturb_in_place_dataset)
\ No newline at end of file
+        return len(self.windows) * self.grid_size
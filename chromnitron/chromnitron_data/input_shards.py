@@ -0,0 +1,153 @@
+import os
+import json
+import shutil
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+from torch.utils.data import Dataset, DataLoader
+
+import chromnitron_data.transforms as transforms
+from chromnitron_data.chromnitron_dataset import STATIC_INPUT_PLACEHOLDER
+from chromnitron_data.cap_bank import load_esm_feature
+from chromnitron_data.origami_infrastructure.decoded_cache import source_mtime
+
+# Input shards hold the encoded inputs of one cell type's window plan, shared by every CAP:
+#     <shard_dir>/seq.npy             uint8 base codes (n_windows, window_size)
+#     <shard_dir>/input_features.npy  log1p ATAC-seq (n_windows, window_size) float32
+#     <shard_dir>/locus.csv           chr, start, end, region_id of each window
+#     <shard_dir>/meta.json           sources the shard was built from
+
+def shard_key(input_seq_path, input_features_path, loci_info, chr_sizes, sample_size, step_size, excluded_region_path, variants = None):
+    ''' Key of an input shard, changes when any input or the window plan changes
+    variants: optional (vcf_path, sample, haplotype) applied to the sequence
+    '''
+    sources = {'seq' : source_entry(input_seq_path),
+               'input_features' : source_entry(input_features_path),
+               'excluded_region' : excluded_region_path,
+               'loci' : [list(map(str, locus)) for locus in loci_info],
+               'chr_sizes' : chr_sizes,
+               'sample_size' : sample_size,
+               'step_size' : step_size}
+    if variants is not None and variants[0] is not None:
+        vcf_path = os.path.abspath(variants[0])
+        sources['variants'] = [vcf_path, cached_source_mtime(vcf_path), variants[1], variants[2]]
+    return hashlib.sha1(json.dumps(sources, sort_keys = True).encode()).hexdigest()[:16], sources
+
+def source_entry(path):
+    ''' Path and modification time of a source, or of each source of a list (replicates) '''
+    if isinstance(path, list):
+        return [source_entry(p) for p in path]
+    return [os.path.abspath(path), cached_source_mtime(os.path.abspath(path))]
+
+@functools.lru_cache(maxsize = None)
+def cached_source_mtime(path):
+    # Zarr stores are walked once per process rather than once per job
+    return source_mtime(path)
+
+def shard_exists(shard_dir):
+    return os.path.exists(os.path.join(shard_dir, 'meta.json'))
+
+def materialize_input_shard(dataset, shard_dir, sources = None, batch_size = 64, num_workers = 0):
+    ''' Encode all windows of an InferenceDataset into a memory-mapped shard
+    dataset: InferenceDataset with a single input feature track
+    shard_dir: output directory, written atomically
+    sources: description of the inputs stored in meta.json
+    '''
+    if shard_exists(shard_dir):
+        return shard_dir
+    tmp_dir = f'{shard_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok = True)
+    n_windows = len(dataset)
+    window_size = int(dataset.region[0][2]) - int(dataset.region[0][1])
+    seq_shard = np.lib.format.open_memmap(f'{tmp_dir}/seq.npy', mode = 'w+', dtype = np.uint8, shape = (n_windows, window_size))
+    feature_shard = np.lib.format.open_memmap(f'{tmp_dir}/input_features.npy', mode = 'w+', dtype = np.float32, shape = (n_windows, window_size))
+    loci = {'chr' : [], 'start' : [], 'end' : [], 'region_id' : []}
+
+    seq_encoding, static_esm_feature = dataset.seq_encoding, dataset.static_esm_feature
+    dataset.seq_encoding, dataset.static_esm_feature = 'codes', True
+    try:
+        dataloader = DataLoader(dataset, batch_size = batch_size, shuffle = False, num_workers = num_workers)
+        offset = 0
+        for seq, input_features, _, loc_info in dataloader:
+            batch_len = len(seq)
+            seq_shard[offset : offset + batch_len] = seq[:, 0].numpy()
+            feature_shard[offset : offset + batch_len] = input_features[:, 0].numpy()
+            loci['start'].extend(loc_info[0].tolist())
+            loci['end'].extend(loc_info[1].tolist())
+            loci['chr'].extend(loc_info[2])
+            loci['region_id'].extend(loc_info[3])
+            offset += batch_len
+    finally:
+        dataset.seq_encoding, dataset.static_esm_feature = seq_encoding, static_esm_feature
+    seq_shard.flush()
+    feature_shard.flush()
+    del seq_shard, feature_shard
+    pd.DataFrame(loci).to_csv(f'{tmp_dir}/locus.csv', index = False)
+    with open(f'{tmp_dir}/meta.json', 'w') as f:
+        json.dump({'n_windows' : n_windows, 'window_size' : window_size, 'sources' : sources}, f)
+    try:
+        os.rename(tmp_dir, shard_dir)
+    except OSError: # Built concurrently by another process
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+    return shard_dir
+
+class InputShardDataset(Dataset):
+    ''' Streams encoded inputs of a cell type's window plan from a memory-mapped input shard '''
+
+    def __init__(self, shard_dir, esm_feature_path, metadata_key = 'NaN',
+                 seq_encoding = 'onehot', static_esm_feature = False):
+        assert seq_encoding in ['onehot', 'codes']
+        self.shard_dir = shard_dir
+        self.esm_feature_path = esm_feature_path
+        self.metadata_key = metadata_key
+        self.seq_encoding = seq_encoding
+        self.static_esm_feature = static_esm_feature
+        self.seq = np.load(f'{shard_dir}/seq.npy', mmap_mode = 'r')
+        self.input_features = np.load(f'{shard_dir}/input_features.npy', mmap_mode = 'r')
+        self.loci = pd.read_csv(f'{shard_dir}/locus.csv', dtype = {'chr' : str, 'region_id' : str})
+        self.loci_starts = self.loci['start'].to_numpy()
+        self.loci_ends = self.loci['end'].to_numpy()
+        self.loci_chrs = self.loci['chr'].to_numpy()
+        self.loci_ids = self.loci['region_id'].to_numpy()
+        self.esm_feature = load_esm_feature(esm_feature_path)
+
+    def __len__(self):
+        return len(self.seq)
+
+    def cache_stats(self):
+        return None
+
+    def get_static_inputs(self):
+        if not self.static_esm_feature:
+            return None
+        return {'esm_feature' : self.esm_feature[np.newaxis, np.newaxis, :, :]}
+
+    def __getitem__(self, idx):
+        return self.make_sample(np.array(self.seq[idx]), np.array(self.input_features[idx]), idx)
+
+    def __getitems__(self, indices):
+        # One gather per batch from the memmaps
+        seqs = self.seq[indices]
+        input_features = self.input_features[indices]
+        return [self.make_sample(seqs[i], input_features[i], idx) for i, idx in enumerate(indices)]
+
+    def make_sample(self, seq, input_features, idx):
+        if self.seq_encoding == 'onehot':
+            seq = transforms.codes_to_onehot(seq)
+        if self.static_esm_feature:
+            esm_feature = STATIC_INPUT_PLACEHOLDER
+        else:
+            esm_feature = self.esm_feature[np.newaxis, :, :]
+        location = (int(self.loci_starts[idx]), int(self.loci_ends[idx]), self.loci_chrs[idx], self.loci_ids[idx], self.metadata_key)
+        return seq[np.newaxis], input_features[np.newaxis, :], esm_feature, location
+
+def order_jobs(cap_list, celltype_list):
+    ''' Order (cap, celltype) jobs CAP by CAP, each model is loaded once, and sweep cell types
+    back and forth so the last shard of one CAP is the first of the next and is still in page cache
+    '''
+    jobs = []
+    for cap_idx, cap in enumerate(cap_list):
+        celltypes = celltype_list if cap_idx % 2 == 0 else celltype_list[::-1]
+        jobs.extend((cap, celltype) for celltype in celltypes)
+    return jobs
@@ -0,0 +1,190 @@
+import os
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+
+class ChunkCache:
+    ''' Size bounded LRU cache of decompressed chunks, private to each process.
+    Hit/miss counters live in shared memory so statistics add up across DataLoader workers.
+    '''
+
+    def __init__(self, max_bytes):
+        ''' Initialize cache
+        max_bytes: maximum total size of cached chunks in bytes
+        '''
+        self.max_bytes = max_bytes
+        self.chunks = OrderedDict()
+        self.nbytes = 0
+        self.counters = multiprocessing.Array('q', 3) # hits, misses, evictions
+
+    def read_into(self, key, start, end, out, rows = None):
+        ''' Copy chunk[..., start:end] into out if the chunk is cached
+        rows: indices along the first axis to copy, None for all
+        return: True on cache hit
+        '''
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            self.count(1)
+            return False
+        self.chunks.move_to_end(key)
+        out[...] = chunk[..., start:end] if rows is None else chunk[rows, start:end]
+        self.count(0)
+        return True
+
+    def put(self, key, chunk):
+        ''' Insert a decompressed chunk, evicting least recently used chunks beyond max_bytes '''
+        if chunk.nbytes > self.max_bytes or key in self.chunks:
+            return
+        self.chunks[key] = chunk
+        self.nbytes += chunk.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.chunks.popitem(last = False)
+            self.nbytes -= evicted.nbytes
+            self.count(2)
+
+    def count(self, counter_idx):
+        with self.counters.get_lock():
+            self.counters[counter_idx] += 1
+
+    def stats(self):
+        ''' Get hit rate statistics '''
+        hits, misses, evictions = self.counters[:]
+        total = hits + misses
+        return {'hits' : hits,
+                'misses' : misses,
+                'evictions' : evictions,
+                'hit_rate' : hits / total if total > 0 else 0.0}
+
+    def clear(self):
+        self.chunks.clear()
+        self.nbytes = 0
+
+class SharedChunkCache(ChunkCache):
+    ''' LRU cache of decompressed chunks in shared memory, shared by all DataLoader workers.
+    Chunks are stored in fixed size slots, so all chunks must share chunk_shape (or be shorter
+    along the last axis) and dtype. The cache must be created in the main process before workers start.
+    '''
+    META_FIELDS = 4 # key0, key1, length, last used tick
+
+    def __init__(self, max_bytes, chunk_shape, dtype):
+        ''' Initialize cache
+        max_bytes: maximum total size of cached chunks in bytes
+        chunk_shape: shape of a full chunk
+        dtype: chunk dtype
+        '''
+        self.max_bytes = max_bytes
+        self.chunk_shape = tuple(chunk_shape)
+        self.dtype = np.dtype(dtype)
+        slot_bytes = chunk_nbytes(self.chunk_shape, self.dtype)
+        if slot_bytes > max_bytes:
+            raise ValueError(f'Chunks of {slot_bytes} bytes do not fit in a {max_bytes} byte cache')
+        self.n_slots = max_bytes // slot_bytes
+        self.lock = multiprocessing.Lock()
+        self.counters = multiprocessing.Array('q', 4) # hits, misses, evictions, tick
+        self.data_shm = shared_memory.SharedMemory(create = True, size = self.n_slots * slot_bytes)
+        self.meta_shm = shared_memory.SharedMemory(create = True, size = self.n_slots * self.META_FIELDS * 8)
+        self.owner_pid = os.getpid()
+        self.attach_arrays()
+        self.meta[:] = -1
+
+    def attach_arrays(self):
+        self.slots = np.ndarray((self.n_slots,) + self.chunk_shape, dtype = self.dtype, buffer = self.data_shm.buf)
+        self.meta = np.ndarray((self.n_slots, self.META_FIELDS), dtype = np.int64, buffer = self.meta_shm.buf)
+
+    def __getstate__(self):
+        # Workers started with spawn re-attach to the same blocks by name
+        state = self.__dict__.copy()
+        for name in ['data_shm', 'meta_shm', 'slots', 'meta']:
+            del state[name]
+        state['shm_names'] = (self.data_shm.name, self.meta_shm.name)
+        return state
+
+    def __setstate__(self, state):
+        data_name, meta_name = state.pop('shm_names')
+        self.__dict__.update(state)
+        self.data_shm = attach_shared_memory(data_name)
+        self.meta_shm = attach_shared_memory(meta_name)
+        self.attach_arrays()
+
+    def find_slot(self, key):
+        match = np.flatnonzero((self.meta[:, 0] == key[0]) & (self.meta[:, 1] == key[1]))
+        return match[0] if len(match) > 0 else None
+
+    def tick(self):
+        self.counters[3] += 1
+        return self.counters[3]
+
+    def read_into(self, key, start, end, out, rows = None):
+        with self.lock:
+            slot = self.find_slot(key)
+            if slot is None:
+                self.counters[1] += 1
+                return False
+            out[...] = self.slots[slot][..., start:end] if rows is None else self.slots[slot][rows, start:end]
+            self.meta[slot, 3] = self.tick()
+            self.counters[0] += 1
+            return True
+
+    def put(self, key, chunk):
+        if chunk.dtype != self.dtype or chunk.shape[:-1] != self.chunk_shape[:-1] or chunk.shape[-1] > self.chunk_shape[-1]:
+            return
+        with self.lock:
+            if self.find_slot(key) is not None:
+                return
+            slot = np.argmin(self.meta[:, 3]) # Empty slots have tick -1
+            if self.meta[slot, 0] != -1:
+                self.counters[2] += 1
+            length = chunk.shape[-1]
+            self.slots[slot][..., :length] = chunk
+            self.meta[slot] = [key[0], key[1], length, self.tick()]
+
+    def stats(self):
+        with self.lock:
+            hits, misses, evictions, _ = self.counters[:]
+        total = hits + misses
+        return {'hits' : hits,
+                'misses' : misses,
+                'evictions' : evictions,
+                'hit_rate' : hits / total if total > 0 else 0.0}
+
+    def clear(self):
+        with self.lock:
+            self.meta[:] = -1
+
+    def close(self):
+        ''' Release shared memory, the owning process also unlinks it '''
+        self.slots = None
+        self.meta = None
+        self.data_shm.close()
+        self.meta_shm.close()
+        if os.getpid() == self.owner_pid: # Forked workers inherit the object but not ownership
+            self.data_shm.unlink()
+            self.meta_shm.unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+        except (AttributeError, FileNotFoundError, BufferError):
+            pass
+
+def chunk_nbytes(chunk_shape, dtype):
+    return int(np.prod(chunk_shape)) * np.dtype(dtype).itemsize
+
+def init_shared_chunk_cache(max_bytes, chunk_shape, dtype):
+    ''' SharedChunkCache of at most max_bytes, None if a single chunk exceeds it (as ChunkCache.put refuses such chunks) '''
+    slot_bytes = chunk_nbytes(chunk_shape, dtype)
+    if slot_bytes > max_bytes:
+        print(f'Warning: chunks of {slot_bytes / 1024 ** 2:.1f} MB exceed the {max_bytes / 1024 ** 2:.1f} MB chunk cache, shared chunk cache disabled')
+        return None
+    return SharedChunkCache(max_bytes, chunk_shape, dtype)
+
+def attach_shared_memory(name):
+    ''' Attach to an existing shared memory block without handing it to this process' resource tracker '''
+    try:
+        return shared_memory.SharedMemory(name = name, track = False)
+    except TypeError: # Python < 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name = name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+class DecodedTrackCache:
+    ''' Local scratch cache of decoded tracks stored as raw .npy files for memory mapping.
+    Each source track (or list of source tracks aggregated into one) gets an entry directory keyed by its paths and modification time:
+        <cache_root>/<key>/meta.json  source, mtime and decoded spans per chromosome
+        <cache_root>/<key>/<chr>.npy  decoded chromosome, full length (sparse file for span entries)
+    '''
+
+    def __init__(self, cache_root, max_size = None, verbose = False):
+        ''' Initialize cache
+        cache_root: cache directory on local scratch
+        max_size: maximum total cache size on disk in bytes, None for unlimited
+        '''
+        self.cache_root = cache_root
+        self.max_size = max_size
+        self.verbose = verbose
+        os.makedirs(cache_root, exist_ok = True)
+
+    def entry_dir(self, path):
+        ''' Get the entry directory of a source track '''
+        key = hashlib.sha1(f'{source_id(path)}:{source_mtime(path)}'.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_root, key)
+
+    def load(self, path, chrs, chr_lengths, spans = None):
+        ''' Decode missing data into the cache and open it
+        path: source track path, or list of paths of tracks aggregated by chrs
+        chrs: source chromosome arrays supporting slicing, e.g. a zarr group
+        chr_lengths: dictionary of chromosome lengths to cache
+        spans: optional dictionary of chromosome to [(start, end), ...] to decode instead of full chromosomes
+        return: dictionary of read-only memmaps, dictionary of decoded spans (None for full chromosomes)
+        '''
+        entry_dir = self.entry_dir(path)
+        os.makedirs(entry_dir, exist_ok = True)
+        meta = self.read_meta(entry_dir, path)
+        for chr_name, chr_length in chr_lengths.items():
+            chr_spans = None if spans is None else merge_spans(spans.get(chr_name, []))
+            self.decode_chr(entry_dir, meta, chrs[chr_name], chr_name, chr_length, chr_spans)
+        self.write_meta(entry_dir, meta)
+        self.evict(keep = entry_dir)
+        memmaps = {}
+        decoded_spans = {}
+        for chr_name in chr_lengths:
+            memmaps[chr_name] = np.load(self.chr_path(entry_dir, chr_name), mmap_mode = 'r')
+            decoded_spans[chr_name] = meta['chrs'][chr_name]['spans']
+        return memmaps, decoded_spans
+
+    def chr_path(self, entry_dir, chr_name):
+        return os.path.join(entry_dir, f'{chr_name}.npy')
+
+    def read_meta(self, entry_dir, path):
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['source'] == source_id(path):
+                return meta
+        return {'source' : source_id(path), 'mtime' : source_mtime(path), 'chrs' : {}}
+
+    def write_meta(self, entry_dir, meta):
+        meta['last_used'] = time.time()
+        tmp_path = os.path.join(entry_dir, f'meta.json.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(entry_dir, 'meta.json'))
+
+    def is_valid(self, entry_dir, meta, chr_name, chr_length, dtype):
+        ''' Check that a cached chromosome exists and matches the source shape and dtype '''
+        chr_path = self.chr_path(entry_dir, chr_name)
+        if chr_name not in meta['chrs'] or not os.path.exists(chr_path):
+            return False
+        try:
+            cached = np.load(chr_path, mmap_mode = 'r')
+        except ValueError:
+            return False
+        return cached.shape[-1] == chr_length and cached.dtype == dtype
+
+    def decode_chr(self, entry_dir, meta, chr_data, chr_name, chr_length, spans):
+        ''' Decode a chromosome, or the spans not decoded yet, into the cache '''
+        chr_path = self.chr_path(entry_dir, chr_name)
+        if self.is_valid(entry_dir, meta, chr_name, chr_length, chr_data.dtype):
+            cached_spans = meta['chrs'][chr_name]['spans']
+            if cached_spans is None:
+                return
+            missing_spans = subtract_spans([(0, chr_length)] if spans is None else spans, cached_spans)
+            if len(missing_spans) == 0:
+                return
+            cached = np.load(chr_path, mmap_mode = 'r+')
+            if self.verbose: print(f'Decoding {len(missing_spans)} new spans of {chr_name} into {chr_path}')
+            copy_spans(chr_data, cached, missing_spans)
+            cached.flush()
+            del cached
+            meta['chrs'][chr_name]['spans'] = None if spans is None else merge_spans(cached_spans + missing_spans)
+            return
+        if self.verbose: print(f'Decoding {chr_name} into {chr_path}')
+        tmp_path = f'{chr_path}.{os.getpid()}.tmp.npy'
+        cached = np.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = chr_data.dtype, shape = chr_data.shape)
+        copy_spans(chr_data, cached, [(0, chr_length)] if spans is None else spans)
+        cached.flush()
+        del cached
+        os.replace(tmp_path, chr_path)
+        meta['chrs'][chr_name] = {'length' : chr_length, 'spans' : spans}
+
+    def entries(self):
+        ''' List cache entries as (last used time, size on disk, entry directory) '''
+        entries = []
+        for key in os.listdir(self.cache_root):
+            entry_dir = os.path.join(self.cache_root, key)
+            meta_path = os.path.join(entry_dir, 'meta.json')
+            if not os.path.isdir(entry_dir):
+                continue
+            last_used = 0
+            if os.path.exists(meta_path):
+                with open(meta_path, 'r') as f:
+                    last_used = json.load(f).get('last_used', 0)
+            entries.append((last_used, disk_usage(entry_dir), entry_dir))
+        return entries
+
+    def evict(self, keep = None):
+        ''' Remove least recently used entries until the cache fits in max_size '''
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+            if entry_dir == keep:
+                continue
+            if self.verbose: print(f'Evicting {entry_dir} from decoded track cache')
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            total_size -= size
+
+def source_id(path):
+    ''' Absolute path of a source, paths joined by | for aggregated sources '''
+    if isinstance(path, (list, tuple)):
+        return '|'.join(os.path.abspath(p) for p in path)
+    return os.path.abspath(path)
+
+def source_mtime(path):
+    ''' Latest modification time of a file, any file under a directory (zarr stores) or any source of a list '''
+    if isinstance(path, (list, tuple)):
+        return max(source_mtime(p) for p in path)
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    mtime = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            mtime = max(mtime, os.path.getmtime(os.path.join(root, name)))
+    return mtime
+
+def disk_usage(path):
+    ''' Allocated size of a directory, sparse span files only count decoded blocks '''
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.stat(os.path.join(root, name)).st_blocks * 512
+    return size
+
+def copy_spans(source, target, spans, block_size = 1000000):
+    ''' Copy spans from source to target along the last axis in blocks to bound memory '''
+    for start, end in spans:
+        for block_start in range(start, end, block_size):
+            block_end = min(block_start + block_size, end)
+            target[..., block_start:block_end] = source[..., block_start:block_end]
+
+def merge_spans(spans):
+    ''' Merge overlapping or adjacent spans '''
+    merged = []
+    for start, end in sorted((int(start), int(end)) for start, end in spans):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def subtract_spans(spans, covered_spans):
+    ''' Parts of spans not covered by covered_spans, both merged and sorted '''
+    missing = []
+    for start, end in spans:
+        current = start
+        for covered_start, covered_end in covered_spans:
+            if covered_end <= current or covered_start >= end:
+                continue
+            if covered_start > current:
+                missing.append([current, covered_start])
+            current = max(current, covered_end)
+        if current < end:
+            missing.append([current, end])
+    return missing
@@ -1,6 +1,66 @@
 from chromnitron_data.origami_infrastructure.partition import Partition
+from chromnitron_data.origami_infrastructure.region_table import RegionTable
+import functools
 import numpy as np
 
+class IntervalIndex:
+    ''' Per-chromosome interval index of excluded loci.
+    Intervals are sorted by start, max_ends holds the running maximum of ends so that
+    the intervals overlapping a query are found with two searchsorted calls.
+    '''
+
+    def __init__(self, excluded_loci):
+        ''' Initialize index
+        excluded_loci: array of [chr, start, end, ...] entries
+        '''
+        self.loci = excluded_loci
+        self.chrs = {}
+        if len(excluded_loci) == 0:
+            return
+        chr_names = excluded_loci[:, 0].astype(str)
+        starts = excluded_loci[:, 1].astype(np.int64)
+        ends = excluded_loci[:, 2].astype(np.int64)
+        for chr_name in np.unique(chr_names):
+            chr_mask = chr_names == chr_name
+            order = np.argsort(starts[chr_mask], kind = 'stable')
+            chr_ends = ends[chr_mask][order]
+            self.chrs[chr_name] = {'starts' : starts[chr_mask][order],
+                                   'ends' : chr_ends,
+                                   'max_ends' : np.maximum.accumulate(chr_ends)}
+
+    def __len__(self):
+        return len(self.loci)
+
+    def find(self, chr_name, starts, ends):
+        ''' Candidate index ranges [first, last) of intervals overlapping each [start, end) on a chromosome.
+        An interval overlaps exactly when first < last, candidates inside the range may still end before start.
+        '''
+        starts = np.asarray(starts, dtype = np.int64)
+        ends = np.asarray(ends, dtype = np.int64)
+        if chr_name not in self.chrs:
+            return np.zeros(len(starts), dtype = np.int64), np.zeros(len(starts), dtype = np.int64)
+        chr_index = self.chrs[chr_name]
+        first = np.searchsorted(chr_index['max_ends'], starts, side = 'right')
+        last = np.searchsorted(chr_index['starts'], ends, side = 'left')
+        return first, last
+
+    def overlaps(self, chr_name, start, end):
+        ''' Sorted starts and ends of intervals overlapping [start, end) '''
+        first, last = self.find(chr_name, [start], [end])
+        if first[0] >= last[0]:
+            return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+        chr_index = self.chrs[chr_name]
+        ex_starts = chr_index['starts'][first[0]:last[0]]
+        ex_ends = chr_index['ends'][first[0]:last[0]]
+        overlap = ex_ends > start
+        return ex_starts[overlap], ex_ends[overlap]
+
+@functools.lru_cache(maxsize = 8)
+def load_interval_index(path):
+    ''' Interval index of a bed file of excluded loci, cached so that repeated partitions share one index '''
+    import pandas as pd
+    return IntervalIndex(pd.read_csv(path, sep='\t', header=None).to_numpy())
+
 class CustomRegion(Partition):
     ''' Partition with custom input '''
 
@@ -13,10 +73,33 @@ class CustomRegion(Partition):
 
     def load_excluded(self, path):
         ''' Load excluded loci data 
-        return: excluded_loci, an iterable object
+        path: bed file or a prebuilt IntervalIndex
+        return: excluded_loci, an IntervalIndex
         '''
-        import pandas as pd
-        return pd.read_csv(path, sep='\t', header=None).to_numpy()
+        if isinstance(path, IntervalIndex):
+            return path
+        return load_interval_index(path)
+
+    def get_interval_index(self, excluded_loci):
+        ''' Interval index of excluded loci given as an IntervalIndex or an array '''
+        if isinstance(excluded_loci, IntervalIndex):
+            return excluded_loci
+        return IntervalIndex(excluded_loci)
+
+    def find_loci_overlaps(self, loci, excluded_index):
+        ''' Boolean mask of loci overlapping any excluded interval '''
+        overlapped = np.zeros(len(loci), dtype = bool)
+        if len(loci) == 0:
+            return overlapped
+        locations = [self.get_loci_chr_location(loci_entry) for loci_entry in loci]
+        chr_names = np.array([location[0] for location in locations])
+        starts = np.array([location[1] for location in locations], dtype = np.int64)
+        ends = np.array([location[2] for location in locations], dtype = np.int64)
+        for chr_name in np.unique(chr_names):
+            chr_mask = chr_names == chr_name
+            first, last = excluded_index.find(chr_name, starts[chr_mask], ends[chr_mask])
+            overlapped[chr_mask] = first < last
+        return overlapped
 
     def get_loci_chr_location(self, loci_entry):
         ''' Get chromosome name and location from a loci entry '''
@@ -42,13 +125,9 @@ class CustomRegion(Partition):
         ''' Exclude loci from the partition '''
         new_loci = []
         filtered_loci = []
-        for loci_entry in loci:
-            chr_name, start, end = self.get_loci_chr_location(loci_entry)
-            ex_chr = excluded_loci[:, 0]
-            ex_start = excluded_loci[:, 1].astype(int)
-            ex_end = excluded_loci[:, 2].astype(int)
-            overlap = np.logical_and(np.logical_and(ex_end > start, ex_start < end), ex_chr == chr_name)
-            if overlap.sum() == 0:
+        overlapped = self.find_loci_overlaps(loci, self.get_interval_index(excluded_loci))
+        for loci_entry, overlap in zip(loci, overlapped):
+            if not overlap:
                 new_loci.append(loci_entry)
             else:
                 filtered_loci.append(loci_entry)
@@ -58,20 +137,16 @@ class CustomRegion(Partition):
 
     def exclude_loci(self, loci, excluded_loci, exclusion_margin = 8192):
         new_loci = []
-        for loci_entry in loci:
-            chr_name, start, end = self.get_loci_chr_location(loci_entry)
-            # Create a mask for exclusions on the same chromosome that actually overlap.
-            ex_mask = (excluded_loci[:, 0] == chr_name) & \
-                    (excluded_loci[:, 2].astype(int) > start) & \
-                    (excluded_loci[:, 1].astype(int) < end)
-            overlapping_exclusions = excluded_loci[ex_mask]
-            if overlapping_exclusions.shape[0] == 0:
+        excluded_index = self.get_interval_index(excluded_loci)
+        overlapped = self.find_loci_overlaps(loci, excluded_index)
+        for loci_entry, overlap in zip(loci, overlapped):
+            if not overlap:
                 new_loci.append(loci_entry)
             else:
-                exclusion_list = []
-                for ex in overlapping_exclusions:
-                    exclusion_list.append([chr_name, int(ex[1]), int(ex[2])])
-                remaining_segments = subtract_overlaps(loci_entry, exclusion_list, exclusion_margin)
+                chr_name, start, end = self.get_loci_chr_location(loci_entry)
+                # Exclusions on the same chromosome that actually overlap, sorted by start
+                ex_starts, ex_ends = excluded_index.overlaps(chr_name, start, end)
+                remaining_segments = subtract_overlaps(loci_entry, zip(ex_starts, ex_ends), exclusion_margin, presorted = True)
                 new_loci.extend(remaining_segments)
 
         new_loci = np.array(new_loci)
@@ -101,20 +176,46 @@ class SlidingWindowRegion(CustomRegion):
         self.check_loci_within_chr()
 
     def split_pad_loci(self, loci, margin = 2048):
-        ''' Split loci that are too long and pad loci that are too short '''
-        new_loci = []
-        for region_id, loci_entry in enumerate(loci):
-            chr_name, start, end = self.get_loci_chr_location(loci_entry)
-            chr_length = self.chr_lengths[chr_name]
-            start = max(start - margin, 0)
-            end = min(end + margin, chr_length)
-            if end - start > self.window_size:
-                n_windows = (end - start) // self.step_size
-                for region_sub_id, i in enumerate(range(n_windows)):
-                    new_loci.append([chr_name, start + i * self.step_size, start + i * self.step_size + self.window_size, f'region_{region_id}_{region_sub_id}'])
-            else:
-                new_loci.append([chr_name, start, start + self.window_size, f'region_{region_id}_0'])
-        return np.array(new_loci)
+        ''' Split loci that are too long and pad loci that are too short
+        return: RegionTable of windows, sub windows of a locus share its region id
+        '''
+        chrom_names = list(self.chr_lengths.keys())
+        if len(loci) == 0:
+            return RegionTable(chrom_names, [], [], [])
+        loci = np.asarray(loci)
+        chroms = loci[:, 0].astype(str)
+        chr_table = RegionTable.from_chroms(chroms, loci[:, 1].astype(np.int64), loci[:, 2].astype(np.int64), chrom_names = chrom_names)
+        chr_lengths = np.array([self.chr_lengths[chrom] for chrom in chrom_names], dtype = np.int64)[chr_table.chrom_codes]
+        starts = np.maximum(chr_table.starts - margin, 0)
+        ends = np.minimum(chr_table.ends + margin, chr_lengths)
+        n_windows = np.where(ends - starts > self.window_size, (ends - starts) // self.step_size, 1)
+        region_ids = np.repeat(np.arange(len(loci), dtype = np.int64), n_windows)
+        sub_ids = np.arange(n_windows.sum(), dtype = np.int64) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+        window_starts = starts[region_ids] + sub_ids * self.step_size
+        return RegionTable(chrom_names, chr_table.chrom_codes[region_ids], window_starts, window_starts + self.window_size,
+                           region_ids, sub_ids)
+
+    def __getitem__(self, x):
+        return self.loci[x]
+
+    def to_table(self):
+        return self.loci
+
+    def find_windows(self, chr_name, start, end, contained = False):
+        ''' Indices of windows overlapping [start, end), or containing it with contained, chr_name None searches all chromosomes '''
+        return self.loci.find_windows(chr_name, start, end, contained)
+
+    def check_loci_within_chr(self):
+        ''' Check if the chromosome length in loci is within the chromosome length in the dictionary '''
+        if not isinstance(self.loci, RegionTable): # Loci before splitting
+            return super().check_loci_within_chr()
+        if self.loci.outside_chr(self.chr_lengths).any():
+            raise Exception('Loci/chromosome length is not consistent with the chromosome length in the dictionary')
+        if self.verbose: print('Loci/chromosome length is consistent.')
+
+    def export(self, path):
+        ''' Export windows to a bed file '''
+        self.loci.export_bed(path)
 
 class CustomRangeRegion(SlidingWindowRegion):
     ''' Partition with custom input '''
@@ -128,35 +229,148 @@ class CustomRangeRegion(SlidingWindowRegion):
         return np.array(loci_tuple)
 
 class GenomeRegion(CustomRegion):
+    ''' Genome-wide tiling computed arithmetically per chromosome.
+    Window i of a chromosome starts at chr_margin + i * step_size, only the indices of windows kept
+    after blacklist removal are stored. Region ids number windows across the whole tiling.
+    '''
 
     def __init__(self, window_size, step_size, chr_margin,
-                 excluded_loci, assembly, 
+                 excluded_loci, assembly, chr_sizes,
                  excluded_chrs=['chrX', 'chrY'],
                  check_length=True, 
                  verbose=False):
+        ''' Initialize the partition
+        excluded_loci: bed file or IntervalIndex of windows to remove, None to keep all windows
+        '''
         self.window_size = window_size
         self.step_size = step_size
         self.chr_margin = chr_margin
-        super().__init__(None, excluded_loci, assembly, excluded_chrs, check_length, verbose)
+        self.excluded_chrs = excluded_chrs
+        super().__init__(None, excluded_loci, assembly, chr_sizes, excluded_chrs, check_length, verbose)
 
     def load(self, path):
-        ''' Generate new loci data
-        return: loci, an iterable object
+        ''' Tile every chromosome
+        return: dictionary of chromosome to window indices
         '''
-        window_size = self.window_size
-        step_size = self.step_size
-        chr_margin = self.chr_margin
-        loci = []
-        region_id = 0
         if self.verbose: print('Generating loci')
+        self.tile_offsets = {}
+        loci = {}
+        region_id = 0
         for chr_name, chr_length in self.chr_lengths.items():
-            for start in range(chr_margin, chr_length - window_size - chr_margin, step_size):
-                end = start + window_size
-                loci.append([chr_name, start, end, f'region_{region_id}'])
-                region_id += 1
-        loci = np.array(loci)
+            n_windows = max(0, -(-(chr_length - self.window_size - 2 * self.chr_margin) // self.step_size))
+            self.tile_offsets[chr_name] = region_id
+            loci[chr_name] = np.arange(n_windows, dtype = np.int64)
+            region_id += n_windows
         return loci
 
+    def exclude_chrs(self, loci):
+        ''' Exclude chromosomes in excluded_chrs '''
+        loci_on_chrs = {chr_name : windows for chr_name, windows in loci.items() if chr_name not in self.excluded_chrs}
+        loci_off_chrs = {chr_name : windows for chr_name, windows in loci.items() if chr_name in self.excluded_chrs}
+        return loci_on_chrs, loci_off_chrs
+
+    def load_excluded(self, path):
+        if path is None:
+            return None
+        return super().load_excluded(path)
+
+    def exclude_loci(self, loci, excluded_loci):
+        ''' Remove windows overlapping excluded loci
+        return: kept and removed window indices per chromosome
+        '''
+        if excluded_loci is None:
+            self.set_loci(loci)
+            return self.loci, None
+        excluded_index = self.get_interval_index(excluded_loci)
+        new_loci = {}
+        filtered_loci = {}
+        for chr_name, windows in loci.items():
+            starts = self.window_starts(windows)
+            first, last = excluded_index.find(chr_name, starts, starts + self.window_size)
+            new_loci[chr_name] = windows[first >= last]
+            filtered_loci[chr_name] = windows[first < last]
+            if self.verbose: print(f'Excluded {len(filtered_loci[chr_name])} windows on {chr_name}')
+        self.set_loci(new_loci)
+        return self.loci, filtered_loci
+
+    def set_loci(self, loci):
+        ''' Set window indices per chromosome and the offsets of chromosomes in the partition '''
+        self.loci = {chr_name : windows for chr_name, windows in loci.items() if len(windows) > 0}
+        self.chr_names = list(self.loci.keys())
+        self.chr_offsets = np.cumsum([0] + [len(windows) for windows in self.loci.values()])
+
+    def window_starts(self, windows):
+        return self.chr_margin + windows * self.step_size
+
+    def check_loci_within_chr(self):
+        ''' Check if the last window of every chromosome is within the chromosome '''
+        for chr_name, windows in self.loci.items():
+            starts = self.window_starts(windows[[0, -1]])
+            if starts[0] < 0 or starts[-1] + self.window_size > self.chr_lengths[chr_name]:
+                raise Exception('Loci/chromosome length is not consistent with the chromosome length in the dictionary')
+        if self.verbose: print('Loci/chromosome length is consistent.')
+
+    def __len__(self):
+        return int(self.chr_offsets[-1])
+
+    def __getitem__(self, x):
+        ''' (chr, start, end, region_id) of window x '''
+        if x < 0:
+            x += len(self)
+        if x < 0 or x >= len(self):
+            raise IndexError(f'Window {x} out of range')
+        chr_idx = np.searchsorted(self.chr_offsets, x, side = 'right') - 1
+        chr_name = self.chr_names[chr_idx]
+        window = int(self.loci[chr_name][x - self.chr_offsets[chr_idx]])
+        start = int(self.window_starts(window))
+        return chr_name, start, start + self.window_size, f'region_{self.tile_offsets[chr_name] + window}'
+
+    def find_windows(self, chr_name, start, end, contained = False):
+        ''' Indices of windows overlapping [start, end), or containing it with contained, chr_name None searches all chromosomes '''
+        if chr_name is None:
+            return np.concatenate([self.find_windows(name, start, end, contained) for name in self.chr_names]
+                                  + [np.zeros(0, dtype = np.int64)])
+        if chr_name not in self.loci:
+            return np.zeros(0, dtype = np.int64)
+        if contained:
+            # Windows starting in [end - window_size, start]
+            first = -(-(end - self.window_size - self.chr_margin) // self.step_size)
+            last = (start - self.chr_margin) // self.step_size + 1
+        else:
+            # Windows starting in (start - window_size, end)
+            first = (start - self.window_size - self.chr_margin) // self.step_size + 1
+            last = -(-(end - self.chr_margin) // self.step_size)
+        chr_idx = self.chr_names.index(chr_name)
+        windows = self.loci[chr_name]
+        lo, hi = np.searchsorted(windows, [first, max(first, last)], side = 'left')
+        return np.arange(lo, hi, dtype = np.int64) + self.chr_offsets[chr_idx]
+
+    def shard(self, rank, world_size):
+        ''' Partition of the windows of one worker, chromosomes are split into world_size contiguous
+        ranges of about the same number of windows
+        '''
+        import copy
+        chr_ranks = np.minimum(self.chr_offsets[:-1] * world_size // max(len(self), 1), world_size - 1)
+        shard_region = copy.copy(self)
+        shard_region.set_loci({chr_name : windows for chr_name, windows, chr_rank in zip(self.chr_names, self.loci.values(), chr_ranks)
+                               if chr_rank == rank})
+        return shard_region
+
+    def to_table(self):
+        ''' Materialize windows as a RegionTable '''
+        chr_names = list(self.chr_lengths.keys())
+        chrom_codes = np.concatenate([np.full(len(windows), chr_names.index(chr_name), dtype = np.int32)
+                                      for chr_name, windows in self.loci.items()] + [np.zeros(0, dtype = np.int32)])
+        windows = np.concatenate(list(self.loci.values()) + [np.zeros(0, dtype = np.int64)])
+        region_ids = np.concatenate([self.tile_offsets[chr_name] + windows for chr_name, windows in self.loci.items()]
+                                    + [np.zeros(0, dtype = np.int64)])
+        starts = self.window_starts(windows)
+        return RegionTable(chr_names, chrom_codes, starts, starts + self.window_size, region_ids)
+
+    def export(self, path):
+        ''' Export windows to a bed file '''
+        self.to_table().export_bed(path)
+
 class GeneRegion(CustomRegion):
 
     def get_loci_chr_location(self, gff_entry):
@@ -192,25 +406,29 @@ class GeneGenomeRegion(GeneRegion):
         chr_start_margins = [[chr_n, 0, margin_size, 'Chr Start Region'] for chr_n in chr_dict.keys()]
         chr_end_margins = [[chr_n, length - margin_size, length, 'Chr End Region'] for chr_n, length in chr_dict.items()]
         
+        excluded_loci = self.get_interval_index(excluded_loci).loci
         new_excluded_loci = np.concatenate([excluded_loci, np.array(chr_start_margins), np.array(chr_end_margins)], axis = 0)
         return super().exclude_loci(loci, new_excluded_loci)
 
-def subtract_overlaps(loci_entry, exclusion_intervals, exclusion_margin):
+def subtract_overlaps(loci_entry, exclusion_intervals, exclusion_margin, presorted = False):
     """
     Given a loci_entry (e.g., [chr, start, end, ...]) and a list of overlapping
     exclusion intervals (each as [chr, ex_start, ex_end]), subtract the exclusions
     from the loci_entry and return a list of remaining intervals.
+    With presorted, exclusion_intervals are (ex_start, ex_end) pairs already sorted
+    by start, as returned by IntervalIndex.overlaps.
     """
     chr_name, start, end = loci_entry[0], int(loci_entry[1]), int(loci_entry[2])
     remaining_intervals = []
     
     # Sort the exclusion intervals by their start position.
-    exclusion_intervals = sorted(exclusion_intervals, key=lambda x: x[1])
+    if not presorted:
+        exclusion_intervals = [(ex[1], ex[2]) for ex in sorted(exclusion_intervals, key=lambda x: x[1])]
     
     current_start = start
     # Process each exclusion that overlaps the locus.
     for ex in exclusion_intervals:
-        ex_start, ex_end = ex[1] - exclusion_margin, ex[2] + exclusion_margin
+        ex_start, ex_end = int(ex[0]) - exclusion_margin, int(ex[1]) + exclusion_margin
         # If there is a gap between the current start and the beginning of the exclusion,
         # then that gap is a remaining region.
         if ex_start > current_start:
@@ -0,0 +1,56 @@
+import numpy as np
+
+# Multi-resolution pyramids of zarr tracks are stored next to the full resolution data:
+#     chrs/<chr>                          full resolution track
+#     levels/<resolution>_<aggregation>/<chr>  one value per resolution bp bin, the last bin may be partial
+#     root attrs: pyramid = {'resolutions' : [...], 'aggregations' : [...]}
+
+DEFAULT_RESOLUTIONS = (32, 128, 1024)
+AGGREGATIONS = {'mean' : np.mean, 'max' : np.max}
+
+def level_name(resolution, aggregation):
+    return f'{resolution}_{aggregation}'
+
+def reduce_bins(x, resolution, aggregation):
+    ''' Aggregate consecutive bins of resolution values along the last axis, a partial last bin is aggregated on its own '''
+    aggregate = AGGREGATIONS[aggregation]
+    full_len = x.shape[-1] // resolution * resolution
+    binned = aggregate(x[..., :full_len].reshape(x.shape[:-1] + (-1, resolution)), axis = -1)
+    if full_len == x.shape[-1]:
+        return binned
+    tail = aggregate(x[..., full_len:], axis = -1, keepdims = True)
+    return np.concatenate([binned, tail], axis = -1)
+
+def build_pyramid(zarr_path, resolutions = DEFAULT_RESOLUTIONS, aggregations = ('mean', 'max'), chunk_size = 1000000):
+    ''' Build pyramid levels of every chromosome of a zarr track in place
+    zarr_path: zarr store with chrs/<chr> arrays
+    resolutions: bin sizes in base pairs
+    aggregations: any of mean, max
+    chunk_size: base pairs per level chunk, level chunks cover the same span as full resolution chunks
+    '''
+    import zarr
+    root = zarr.open(zarr_path, mode = 'r+')
+    for chr_name, chr_arr in root['chrs'].arrays():
+        print('Building pyramid of', chr_name)
+        write_pyramid_levels(root, chr_name, chr_arr, resolutions, aggregations, chunk_size)
+    root.attrs['pyramid'] = {'resolutions' : [int(r) for r in resolutions], 'aggregations' : list(aggregations)}
+
+def write_pyramid_levels(root, chr_name, chr_arr, resolutions, aggregations, chunk_size = 1000000):
+    ''' Write all levels of one chromosome, reading the full resolution array in blocks aligned to every resolution '''
+    import numcodecs
+    zarr_compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.SHUFFLE) # Setup compressor
+    chr_length = chr_arr.shape[-1]
+    levels = {}
+    for resolution in resolutions:
+        for aggregation in aggregations:
+            levels[(resolution, aggregation)] = root.create_dataset(f'levels/{level_name(resolution, aggregation)}/{chr_name}',
+                                                                    shape = (-(-chr_length // resolution),), dtype = np.float32,
+                                                                    chunks = max(1, chunk_size // resolution),
+                                                                    compressor = zarr_compressor, overwrite = True)
+    alignment = int(np.lcm.reduce([int(r) for r in resolutions]))
+    block_size = max(1, chunk_size // alignment) * alignment
+    for block_start in range(0, chr_length, block_size):
+        block = np.asarray(chr_arr[block_start : block_start + block_size], dtype = np.float32)
+        for (resolution, aggregation), level in levels.items():
+            level_start = block_start // resolution
+            level[level_start : level_start + -(-len(block) // resolution)] = reduce_bins(block, resolution, aggregation)
@@ -0,0 +1,122 @@
+import numpy as np
+
+class RegionTable:
+    ''' Columnar table of genomic windows.
+    Chromosomes are stored as int32 codes into chrom_names, starts and ends as int64.
+    Windows carry integer ids of the locus they come from (region_ids) and of their position
+    within that locus (sub_ids), the region_{region_id}_{sub_id} names are only built on access.
+    Tables without sub_ids name windows region_{region_id}.
+    '''
+
+    def __init__(self, chrom_names, chrom_codes, starts, ends, region_ids = None, sub_ids = None):
+        ''' Initialize table
+        chrom_names: array of chromosome names, the categories of chrom_codes
+        chrom_codes: index into chrom_names of every window
+        starts, ends: window coordinates
+        region_ids: id of the locus of every window, defaults to the window index
+        sub_ids: index of the window within its locus, None for windows that are not split from loci
+        '''
+        self.chrom_names = np.asarray(chrom_names, dtype = str)
+        self.chrom_codes = np.asarray(chrom_codes, dtype = np.int32)
+        self.starts = np.asarray(starts, dtype = np.int64)
+        self.ends = np.asarray(ends, dtype = np.int64)
+        n_windows = len(self.starts)
+        self.region_ids = np.arange(n_windows, dtype = np.int64) if region_ids is None else np.asarray(region_ids, dtype = np.int64)
+        self.sub_ids = None if sub_ids is None else np.asarray(sub_ids, dtype = np.int64)
+        self.window_index = None
+
+    @classmethod
+    def from_chroms(cls, chroms, starts, ends, region_ids = None, sub_ids = None, chrom_names = None):
+        ''' Build a table from per-window chromosome names
+        chrom_names: category order, defaults to sorted unique names
+        '''
+        chroms = np.asarray(chroms, dtype = str)
+        if chrom_names is None:
+            chrom_names, chrom_codes = np.unique(chroms, return_inverse = True)
+        else:
+            chrom_names = np.asarray(chrom_names, dtype = str)
+            code_map = {chrom : code for code, chrom in enumerate(chrom_names)}
+            chrom_codes = np.array([code_map[chrom] for chrom in chroms], dtype = np.int32)
+        return cls(chrom_names, chrom_codes, starts, ends, region_ids, sub_ids)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        ''' (chrom, start, end, region_id) of one window, or a sub-table for slices and index arrays '''
+        if isinstance(idx, (int, np.integer)):
+            region_id = f'region_{self.region_ids[idx]}' if self.sub_ids is None else f'region_{self.region_ids[idx]}_{self.sub_ids[idx]}'
+            return str(self.chrom_names[self.chrom_codes[idx]]), int(self.starts[idx]), int(self.ends[idx]), region_id
+        return RegionTable(self.chrom_names, self.chrom_codes[idx], self.starts[idx], self.ends[idx],
+                           self.region_ids[idx], None if self.sub_ids is None else self.sub_ids[idx])
+
+    @property
+    def chroms(self):
+        ''' Chromosome name of every window '''
+        return self.chrom_names[self.chrom_codes]
+
+    @property
+    def nbytes(self):
+        columns = [self.chrom_codes, self.starts, self.ends, self.region_ids, self.sub_ids]
+        return sum(column.nbytes for column in columns if column is not None)
+
+    def region_names(self):
+        ''' region_{region_id}_{sub_id} name of every window '''
+        if self.sub_ids is None:
+            return np.char.add('region_', self.region_ids.astype(str))
+        return np.char.add(np.char.add(np.char.add('region_', self.region_ids.astype(str)), '_'), self.sub_ids.astype(str))
+
+    def outside_chr(self, chr_lengths):
+        ''' Boolean mask of windows extending outside of their chromosome '''
+        lengths = np.array([chr_lengths[chrom] for chrom in self.chrom_names], dtype = np.int64)
+        return (self.starts < 0) | (self.ends > lengths[self.chrom_codes])
+
+    def build_window_index(self):
+        ''' Window order sorted by (chrom, start), chromosome bounds in that order and the running maximum of ends per chromosome '''
+        order = np.lexsort((self.starts, self.chrom_codes))
+        chrom_bounds = np.searchsorted(self.chrom_codes[order], np.arange(len(self.chrom_names) + 1), side = 'left')
+        max_ends = self.ends[order].copy()
+        for lo, hi in zip(chrom_bounds[:-1], chrom_bounds[1:]):
+            max_ends[lo:hi] = np.maximum.accumulate(max_ends[lo:hi])
+        self.window_index = {'order' : order, 'chrom_bounds' : chrom_bounds, 'starts' : self.starts[order], 'max_ends' : max_ends}
+
+    def find_windows(self, chrom, start, end, contained = False):
+        ''' Indices of windows overlapping [start, end), or with contained, of windows with start <= start and end >= end
+        chrom: chromosome name, None for all chromosomes
+        return: sorted window indices
+        '''
+        if chrom is None:
+            return np.sort(np.concatenate([self.find_windows(chrom_name, start, end, contained) for chrom_name in self.chrom_names]
+                                          + [np.zeros(0, dtype = np.int64)]))
+        if self.window_index is None:
+            self.build_window_index()
+        chrom_code = np.flatnonzero(self.chrom_names == chrom)
+        if len(chrom_code) == 0:
+            return np.zeros(0, dtype = np.int64)
+        lo, hi = self.window_index['chrom_bounds'][chrom_code[0]], self.window_index['chrom_bounds'][chrom_code[0] + 1]
+        starts, max_ends = self.window_index['starts'][lo:hi], self.window_index['max_ends'][lo:hi]
+        if contained:
+            first = np.searchsorted(max_ends, end, side = 'left')
+            last = np.searchsorted(starts, start, side = 'right')
+        else:
+            first = np.searchsorted(max_ends, start, side = 'right')
+            last = np.searchsorted(starts, end, side = 'left')
+        candidates = self.window_index['order'][lo + first : lo + max(first, last)]
+        if contained:
+            candidates = candidates[self.ends[candidates] >= end]
+        else:
+            candidates = candidates[self.ends[candidates] > start]
+        return np.sort(candidates)
+
+    def to_dataframe(self):
+        ''' Windows as a chr, start, end, region_id DataFrame, the layout of locus.csv '''
+        import pandas as pd
+        return pd.DataFrame({'chr' : self.chroms, 'start' : self.starts, 'end' : self.ends, 'region_id' : self.region_names()})
+
+    def export_bed(self, path):
+        ''' Export windows to a headerless bed file of chr, start, end, region_id '''
+        self.to_dataframe().to_csv(path, sep = '\t', header = False, index = False)
+
+    def export_csv(self, path):
+        ''' Export windows to a locus.csv file '''
+        self.to_dataframe().to_csv(path, index = False)
@@ -2,6 +2,7 @@ from chromnitron_data.origami_infrastructure.genome import Genome
 
 class Storage(Genome):
     ''' Storage class for storing and retrieving data from a genome. '''
+    base_codes = False # True if get returns uint8 base codes instead of bases
 
     def __init__(self, path, assembly, chr_sizes,
                  excluded_chrs=['chrX', 'chrY'],
@@ -36,6 +37,36 @@ class Storage(Genome):
         '''
         raise NotImplementedError
 
+    def get_many(self, chr_name, starts, ends):
+        ''' Get features for a group of equal length windows on one chromosome
+        chr_name: chromosome name
+        starts: start positions
+        ends: end positions
+        The union span of the windows is read once, so windows should be close together.
+        return: read-only array of shape (n_windows, ..., window_length), a strided view
+                of the span when windows are evenly spaced
+        '''
+        import numpy as np
+        starts, ends = np.asarray(starts, dtype = int), np.asarray(ends, dtype = int)
+        lengths = np.unique(ends - starts)
+        if len(lengths) != 1:
+            raise ValueError(f'Windows must have the same length, got lengths {lengths}')
+        span_start = starts.min()
+        span = self.get(chr_name, span_start, ends.max())
+        return window_views(span, starts - span_start, lengths[0])
+
+    def pyramid_resolutions(self, aggregation):
+        ''' Resolutions of pre-aggregated pyramid levels, empty if the storage has none '''
+        return []
+
+    def level_storage(self, resolution, aggregation):
+        ''' Storage of one pyramid level '''
+        raise NotImplementedError
+
+    def cache_stats(self):
+        ''' Get cache hit rate statistics, None if the storage has no cache '''
+        return None
+
     def get_data_chr_length(self, chr_data):
         ''' Get chromosome length from data
         chr_data: chromosome data loaded from storage
@@ -57,3 +88,13 @@ class Storage(Genome):
             if chr_length != data_chr_length:
                 raise Exception(f'Chromosome length in data is not consistent with the chromosome length in the dictionary: {chr_name} \n Ref: {chr_length} \n Data: {data_chr_length}')
         if self.verbose: print('Chromosome length in data is consistent.')
+
+def window_views(span, offsets, length):
+    ''' Slice windows of given length starting at offsets along the last axis of span '''
+    import numpy as np
+    windows = np.moveaxis(np.lib.stride_tricks.sliding_window_view(span, length, axis = -1), -2, 0)
+    steps = np.diff(offsets)
+    if len(offsets) == 1 or (steps[0] > 0 and np.all(steps == steps[0])):
+        step = steps[0] if len(steps) > 0 else 1
+        return windows[offsets[0] : offsets[-1] + 1 : step]
+    return windows[offsets]
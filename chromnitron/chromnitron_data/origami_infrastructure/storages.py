@@ -1,3 +1,4 @@
+import functools
 from chromnitron_data.origami_infrastructure.storage import Storage
 
 class NpyStorage(Storage):
@@ -20,12 +21,611 @@ class NpyStorage(Storage):
 
 class ZarrStorage(NpyStorage):
     ''' Zarr storage assume zarr files are stored with chrs as groups '''
+    def __init__(self, path, assembly, chr_sizes,
+                 excluded_chrs=['chrX', 'chrY'],
+                 check_length=True,
+                 verbose=False,
+                 cache_size=0,
+                 shared_cache=False):
+        ''' Initialize storage
+        cache_size: size in bytes of the LRU cache of decompressed chunks, 0 disables caching
+        shared_cache: keep the cache in shared memory so all DataLoader workers share it
+        '''
+        super().__init__(path, assembly, chr_sizes, excluded_chrs, check_length, verbose)
+        self.chr_ids = {chr_name : chr_id for chr_id, chr_name in enumerate(self.chr_lengths)}
+        self.cache = self.init_cache(cache_size, shared_cache)
+
+    pyramid = None # Pyramid levels stored next to chrs, see pyramid.py
+
     def load(self, path):
         import zarr
         if self.verbose: print(f'Loading zarr files from {path}...')
-        chrs = zarr.open(path, mode='r')['chrs']
+        root = zarr.open(path, mode='r')
+        self.pyramid = root.attrs.get('pyramid', None)
+        chrs = root['chrs']
         return chrs
 
+    def pyramid_resolutions(self, aggregation):
+        if self.pyramid is None or aggregation not in self.pyramid['aggregations']:
+            return []
+        return self.pyramid['resolutions']
+
+    def level_storage(self, resolution, aggregation):
+        return ZarrLevelStorage(self.path, self.assembly, self.chr_lengths, resolution, aggregation, verbose = self.verbose)
+
+    def zarr_chr(self, chr_name):
+        ''' Get the compressed zarr array of a chromosome '''
+        return self.chrs[chr_name]
+
+    def init_cache(self, cache_size, shared_cache):
+        from chromnitron_data.origami_infrastructure.chunk_cache import ChunkCache, init_shared_chunk_cache
+        if cache_size <= 0:
+            return None
+        if not shared_cache:
+            return ChunkCache(cache_size)
+        chr_data = self.zarr_chr(next(iter(self.chr_lengths)))
+        return init_shared_chunk_cache(cache_size, chr_data.chunks, chr_data.dtype)
+
+    def get(self, chr_name, start, end):
+        if self.cache is None:
+            return self.chrs[chr_name][..., start:end] # zarr returns a new array
+        return self.get_cached(chr_name, start, end)
+
+    def get_data_chr_length(self, chr_data):
+        return chr_data.shape[-1]
+
+    def get_cached(self, chr_name, start, end, rows = None):
+        ''' Assemble a region from cached decompressed chunks
+        rows: indices along the first axis to return, None for all. Whole chunks are cached either way
+        '''
+        import numpy as np
+        chr_data = self.zarr_chr(chr_name)
+        chunk_len = chr_data.chunks[-1]
+        chr_len = chr_data.shape[-1]
+        end = min(end, chr_len)
+        leading_shape = chr_data.shape[:-1] if rows is None else (len(rows),) + chr_data.shape[1:-1]
+        out = np.empty(leading_shape + (max(end - start, 0),), dtype = chr_data.dtype)
+        for chunk_idx in range(start // chunk_len, (end - 1) // chunk_len + 1):
+            chunk_start = chunk_idx * chunk_len
+            lo = max(start, chunk_start) - chunk_start
+            hi = min(end, chunk_start + chunk_len) - chunk_start
+            out_view = out[..., chunk_start + lo - start : chunk_start + hi - start]
+            key = (self.chr_ids[chr_name], chunk_idx)
+            if not self.cache.read_into(key, lo, hi, out_view, rows):
+                chunk = chr_data[..., chunk_start : min(chunk_start + chunk_len, chr_len)]
+                self.cache.put(key, chunk)
+                out_view[...] = chunk[..., lo:hi] if rows is None else chunk[rows, lo:hi]
+        return out
+
+    def cache_stats(self):
+        ''' Get chunk cache hit rate statistics, None if caching is disabled '''
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+class ZarrLevelStorage(ZarrStorage):
+    ''' One pyramid level of a zarr track, positions are bins of resolution base pairs '''
+    def __init__(self, path, assembly, chr_sizes, resolution, aggregation, verbose=False, **zarr_kwargs):
+        ''' Initialize storage
+        chr_sizes: chromosome sizes in base pairs
+        resolution: level bin size in base pairs
+        aggregation: level aggregation, mean or max
+        '''
+        self.resolution = resolution
+        self.aggregation = aggregation
+        level_sizes = {chr_name : -(-chr_length // resolution) for chr_name, chr_length in chr_sizes.items()}
+        super().__init__(path, assembly, level_sizes, verbose = verbose, **zarr_kwargs)
+
+    def load(self, path):
+        import zarr
+        from chromnitron_data.origami_infrastructure.pyramid import level_name
+        if self.verbose: print(f'Loading {self.resolution} bp {self.aggregation} level from {path}...')
+        return zarr.open(path, mode='r')['levels'][level_name(self.resolution, self.aggregation)]
+
+    def pyramid_resolutions(self, aggregation):
+        return []
+
+class PreloadedZarrStorage(ZarrStorage):
+    ''' Zarr storage decoded once into a local .npy memmap cache, then sliced zero-copy like NpyStorage '''
+    def __init__(self, path, assembly, chr_sizes,
+                 excluded_chrs=['chrX', 'chrY'],
+                 check_length=True,
+                 verbose=False,
+                 cache_dir=None,
+                 max_cache_size=None,
+                 spans=None,
+                 **zarr_kwargs):
+        ''' Initialize storage
+        cache_dir: local scratch directory of the decoded track cache
+        max_cache_size: maximum size of the decoded track cache in bytes, None for unlimited
+        spans: optional dictionary of chromosome to [(start, end), ...] to decode instead of full chromosomes,
+               reads outside decoded spans fall back to zarr
+        '''
+        from chromnitron_data.origami_infrastructure.decoded_cache import DecodedTrackCache
+        self.decoded_cache = DecodedTrackCache(cache_dir, max_cache_size, verbose)
+        self.spans = spans
+        super().__init__(path, assembly, chr_sizes, excluded_chrs, check_length, verbose, **zarr_kwargs)
+
+    def load(self, path):
+        import numpy as np
+        self.zarr_chrs = super().load(path)
+        chrs, decoded_spans = self.decoded_cache.load(path, self.zarr_chrs, self.chr_lengths, self.spans)
+        self.decoded_spans = {}
+        for chr_name, chr_spans in decoded_spans.items():
+            if chr_spans is not None:
+                chr_spans = np.array(chr_spans, dtype = int).reshape(-1, 2)
+                self.decoded_spans[chr_name] = (chr_spans[:, 0], chr_spans[:, 1])
+        return chrs
+
+    def zarr_chr(self, chr_name):
+        return self.zarr_chrs[chr_name]
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        if chr_name in self.decoded_spans:
+            span_starts, span_ends = self.decoded_spans[chr_name]
+            span_idx = np.searchsorted(span_starts, start, side = 'right') - 1
+            if span_idx < 0 or span_ends[span_idx] < end:
+                return self.get_zarr(chr_name, start, end)
+        return self.chrs[chr_name][..., start:end].copy()
+
+    def get_zarr(self, chr_name, start, end):
+        ''' Read from the source zarr for regions outside decoded spans '''
+        if self.cache is None:
+            return self.zarr_chrs[chr_name][..., start:end]
+        return self.get_cached(chr_name, start, end)
+
+    def __getstate__(self):
+        # Reopen memmaps in workers instead of pickling their content
+        state = self.__dict__.copy()
+        state['chrs'] = {chr_name : chr_data.filename for chr_name, chr_data in self.chrs.items()}
+        return state
+
+    def __setstate__(self, state):
+        import numpy as np
+        self.__dict__.update(state)
+        self.chrs = {chr_name : np.load(chr_path, mmap_mode = 'r') for chr_name, chr_path in self.chrs.items()}
+
+class MergedTrackStorage(Storage):
+    ''' Aggregate of several tracks (e.g. summed replicates) materialized once into the decoded track cache
+    and sliced from local .npy memmaps, reads outside decoded spans fall back to the aggregated track
+    '''
+    def __init__(self, track, paths, assembly, chr_sizes,
+                 excluded_chrs=['chrX', 'chrY'],
+                 check_length=True,
+                 verbose=False,
+                 cache_dir=None,
+                 max_cache_size=None,
+                 spans=None):
+        ''' Initialize storage
+        track: AggregatedTrack over the source storages, at resolution 1
+        paths: source paths of the aggregated storages, used as cache key
+        cache_dir: local scratch directory of the decoded track cache
+        max_cache_size: maximum size of the decoded track cache in bytes, None for unlimited
+        spans: optional dictionary of chromosome to [(start, end), ...] to merge instead of full chromosomes
+        '''
+        from chromnitron_data.origami_infrastructure.decoded_cache import DecodedTrackCache
+        self.track = track
+        self.decoded_cache = DecodedTrackCache(cache_dir, max_cache_size, verbose)
+        self.spans = spans
+        super().__init__(list(paths), assembly, chr_sizes, excluded_chrs, check_length, verbose)
+
+    def load(self, paths):
+        import numpy as np
+        dtype = self.track.get(next(iter(self.chr_lengths)), 0, 1).dtype
+        sources = {chr_name : AggregatedChromosome(self.track, chr_name, chr_length, dtype) for chr_name, chr_length in self.chr_lengths.items()}
+        chrs, decoded_spans = self.decoded_cache.load(paths, sources, self.chr_lengths, self.spans)
+        self.decoded_spans = {}
+        for chr_name, chr_spans in decoded_spans.items():
+            if chr_spans is not None:
+                chr_spans = np.array(chr_spans, dtype = int).reshape(-1, 2)
+                self.decoded_spans[chr_name] = (chr_spans[:, 0], chr_spans[:, 1])
+        return chrs
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        if chr_name in self.decoded_spans:
+            span_starts, span_ends = self.decoded_spans[chr_name]
+            span_idx = np.searchsorted(span_starts, start, side = 'right') - 1
+            if span_idx < 0 or span_ends[span_idx] < end:
+                return self.track.get(chr_name, start, end)
+        return self.chrs[chr_name][..., start:end].copy()
+
+    def get_data_chr_length(self, chr_data):
+        return chr_data.shape[-1]
+
+    def __getstate__(self):
+        # Reopen memmaps in workers instead of pickling their content
+        state = self.__dict__.copy()
+        state['chrs'] = {chr_name : chr_data.filename for chr_name, chr_data in self.chrs.items()}
+        return state
+
+    def __setstate__(self, state):
+        import numpy as np
+        self.__dict__.update(state)
+        self.chrs = {chr_name : np.load(chr_path, mmap_mode = 'r') for chr_name, chr_path in self.chrs.items()}
+
+class AggregatedChromosome:
+    ''' Array-like chromosome of an aggregated track, slicing along the last axis reads the track '''
+    def __init__(self, track, chr_name, chr_length, dtype):
+        self.track = track
+        self.chr_name = chr_name
+        self.shape = (chr_length,)
+        self.dtype = dtype
+
+    def __getitem__(self, key):
+        region = key[-1] if isinstance(key, tuple) else key
+        return self.track.get(self.chr_name, region.start, region.stop)
+
+class StackedZarrStorage(ZarrStorage):
+    ''' Zarr storage of many samples stacked per chromosome as (samples, positions) arrays,
+    chunked along positions so a cached chunk serves a window for all samples.
+    Only the rows of the selected samples are copied out of chunks and dequantized.
+    Built by utils/stack_atac.py, optionally quantized to float16 or uint16 with per-sample scales.
+    '''
+    def __init__(self, path, assembly, chr_sizes,
+                 excluded_chrs=['chrX', 'chrY'],
+                 check_length=True,
+                 verbose=False,
+                 samples=None,
+                 **zarr_kwargs):
+        ''' Initialize storage
+        samples: sample names to return, None for all samples in stored order
+        '''
+        self.selected_samples = samples
+        super().__init__(path, assembly, chr_sizes, excluded_chrs, check_length, verbose, **zarr_kwargs)
+
+    def load(self, path):
+        import zarr
+        import numpy as np
+        if self.verbose: print(f'Loading stacked zarr files from {path}...')
+        root = zarr.open(path, mode='r')
+        self.samples = list(root.attrs['samples'])
+        self.chr_scales = {}
+        for chr_name in self.chr_lengths:
+            scales = root['chrs'][chr_name].attrs.get('scales', None)
+            self.chr_scales[chr_name] = None if scales is None else np.array(scales, dtype = np.float32)
+        self.set_selection(self.selected_samples)
+        return root['chrs']
+
+    def set_selection(self, samples):
+        import numpy as np
+        self.selected_samples = samples
+        selected = self.samples if samples is None else samples
+        self.sample_idx = np.array([self.samples.index(sample) for sample in selected])
+        self.all_samples = samples is None or np.array_equal(self.sample_idx, np.arange(len(self.samples)))
+        self.scales = {chr_name : None if scales is None else scales[self.sample_idx, None] for chr_name, scales in self.chr_scales.items()}
+
+    def select(self, samples):
+        ''' Storage returning the given samples, sharing zarr arrays and chunk cache with this storage '''
+        import copy
+        storage = copy.copy(self)
+        storage.set_selection(samples)
+        return storage
+
+    def get(self, chr_name, start, end):
+        ''' Get (selected samples, positions) float32 features '''
+        import numpy as np
+        rows = None if self.all_samples else self.sample_idx
+        if self.cache is not None:
+            stacked = self.get_cached(chr_name, start, end, rows)
+        elif rows is None:
+            stacked = self.chrs[chr_name][:, start:end]
+        else:
+            stacked = self.chrs[chr_name].get_orthogonal_selection((rows, slice(start, end)))
+        stacked = stacked.astype(np.float32)
+        if self.scales[chr_name] is not None:
+            stacked *= self.scales[chr_name]
+        return stacked
+
+class BigWigStorage(Storage):
+    ''' BigWig storage read through pyBigWig, intervals are expanded to dense float32 signal (0 outside intervals).
+    Decoded blocks of block_size bases can be kept in an LRU cache, file handles are opened once per process.
+    '''
+    def __init__(self, path, assembly, chr_sizes,
+                 excluded_chrs=['chrX', 'chrY'],
+                 check_length=True,
+                 verbose=False,
+                 cache_size=0,
+                 shared_cache=False,
+                 block_size=65536):
+        ''' Initialize storage
+        cache_size: size in bytes of the LRU cache of decoded blocks, 0 disables caching
+        shared_cache: keep the cache in shared memory so all DataLoader workers share it
+        block_size: bases per cached block
+        '''
+        self.file = None
+        self.file_pid = None
+        self.block_size = block_size
+        super().__init__(path, assembly, chr_sizes, excluded_chrs, check_length, verbose)
+        self.chr_ids = {chr_name : chr_id for chr_id, chr_name in enumerate(self.chr_lengths)}
+        self.cache = self.init_cache(cache_size, shared_cache)
+
+    def load(self, path):
+        if self.verbose: print(f'Loading bigwig file from {path}...')
+        return {chr_name : {'length' : chr_length} for chr_name, chr_length in self.bigwig().chroms().items()}
+
+    def bigwig(self):
+        ''' Get the pyBigWig handle opened in this process '''
+        import os
+        import pyBigWig
+        if self.file is None or self.file_pid != os.getpid():
+            self.file = pyBigWig.open(self.path)
+            self.file_pid = os.getpid()
+        return self.file
+
+    def init_cache(self, cache_size, shared_cache):
+        import numpy as np
+        from chromnitron_data.origami_infrastructure.chunk_cache import ChunkCache, init_shared_chunk_cache
+        if cache_size <= 0:
+            return None
+        if not shared_cache:
+            return ChunkCache(cache_size)
+        return init_shared_chunk_cache(cache_size, (self.block_size,), np.float32)
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        start, end = max(start, 0), min(end, self.chr_lengths[chr_name])
+        if self.cache is None:
+            return self.read_dense(chr_name, start, end)
+        out = np.empty(max(end - start, 0), dtype = np.float32)
+        for block_idx in range(start // self.block_size, (end - 1) // self.block_size + 1):
+            block_start = block_idx * self.block_size
+            lo = max(start, block_start) - block_start
+            hi = min(end, block_start + self.block_size) - block_start
+            out_view = out[block_start + lo - start : block_start + hi - start]
+            key = (self.chr_ids[chr_name], block_idx)
+            if not self.cache.read_into(key, lo, hi, out_view):
+                block = self.read_dense(chr_name, block_start, min(block_start + self.block_size, self.chr_lengths[chr_name]))
+                self.cache.put(key, block)
+                out_view[...] = block[lo:hi]
+        return out
+
+    def read_dense(self, chr_name, start, end):
+        ''' Read intervals overlapping a region and expand them to a dense array '''
+        import numpy as np
+        out = np.zeros(max(end - start, 0), dtype = np.float32)
+        if end <= start:
+            return out
+        intervals = self.bigwig().intervals(chr_name, start, end)
+        if intervals is None or len(intervals) == 0:
+            return out
+        intervals = np.array(intervals, dtype = np.float64)
+        starts = np.clip(intervals[:, 0].astype(np.int64), start, end) - start
+        ends = np.clip(intervals[:, 1].astype(np.int64), start, end) - start
+        lengths = ends - starts
+        # Positions of all covered bases: interval start + offset within the interval
+        interval_offsets = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - interval_offsets, lengths) + np.arange(lengths.sum())
+        out[positions] = np.repeat(intervals[:, 2].astype(np.float32), lengths)
+        return out
+
+    def get_data_chr_length(self, chr_data):
+        return chr_data['length']
+
+    def cache_stats(self):
+        ''' Get block cache hit rate statistics, None if caching is disabled '''
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def __getstate__(self):
+        # pyBigWig handles can not be pickled, workers reopen the file
+        state = self.__dict__.copy()
+        state['file'] = None
+        state['file_pid'] = None
+        return state
+
+class RLEStorage(Storage):
+    ''' Run-length encoded storage for piecewise constant tracks, written by utils/io.py export_to_rle:
+        chrs/<chr>/starts       run starts, the first run starts at 0 and the last one ends at the chromosome length
+        chrs/<chr>/values       run values
+        chrs/<chr>/block_index  index of the run covering each multiple of block_size (root attribute)
+    Windows are expanded with np.repeat after reading only the runs they overlap.
+    '''
+    def load(self, path):
+        import zarr
+        import numpy as np
+        if self.verbose: print(f'Loading run-length encoded files from {path}...')
+        root = zarr.open(path, mode='r')
+        self.block_size = root.attrs['block_size']
+        chrs = {}
+        for chr_name in self.chr_lengths:
+            chr_group = root['chrs'][chr_name]
+            chrs[chr_name] = {'length' : chr_group.attrs['length'],
+                              'starts' : chr_group['starts'],
+                              'values' : chr_group['values'],
+                              'block_index' : np.asarray(chr_group['block_index'][:])}
+        return chrs
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        chr_data = self.chrs[chr_name]
+        start, end = max(start, 0), min(end, chr_data['length'])
+        if end <= start:
+            return np.zeros(0, dtype = chr_data['values'].dtype)
+        block_index = chr_data['block_index']
+        first_run = block_index[start // self.block_size]
+        last_block = (end - 1) // self.block_size + 1
+        last_run = block_index[last_block] + 1 if last_block < len(block_index) else len(chr_data['starts'])
+        # One extra start bounds the last run
+        run_starts = np.append(chr_data['starts'][first_run : last_run + 1], chr_data['length'])
+        run_values = chr_data['values'][first_run : last_run]
+        run_lengths = np.diff(np.clip(run_starts[:last_run - first_run + 1], start, end))
+        return np.repeat(run_values, run_lengths)
+
+    def get_data_chr_length(self, chr_data):
+        return chr_data['length']
+
+class SequenceFileStorage(Storage):
+    ''' Base class of sequence file storages, get returns uint8 base codes (a=0, c=1, g=2, t=3, n=4).
+    Files are memory mapped lazily once per process so DataLoader workers get their own handles.
+    '''
+    base_codes = True
+
+    def load(self, path):
+        self.file = None
+        self.file_pid = None
+        return self.read_index(path)
+
+    def read_index(self, path):
+        ''' Read per-chromosome records from the file index
+        return: chrs, a dictionary of records with a length entry
+        '''
+        raise NotImplementedError
+
+    def mmap(self):
+        ''' Get a read-only memory map of the sequence file opened in this process '''
+        import os
+        import mmap
+        if self.file is None or self.file_pid != os.getpid():
+            with open(self.path, 'rb') as f:
+                self.file = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            self.file_pid = os.getpid()
+        return self.file
+
+    def get_data_chr_length(self, chr_data):
+        return chr_data['length']
+
+    def __getstate__(self):
+        # Memory maps are reopened in workers
+        state = self.__dict__.copy()
+        state['file'] = None
+        state['file_pid'] = None
+        return state
+
+class FastaStorage(SequenceFileStorage):
+    ''' FASTA storage read through its samtools faidx index (<path>.fai).
+    Plain FASTA is memory mapped, bgzip compressed FASTA (.gz/.bgz) also needs the <path>.gzi block index.
+    '''
+    def read_index(self, path):
+        import os
+        import numpy as np
+        if self.verbose: print(f'Loading fasta index of {path}...')
+        chrs = {}
+        with open(f'{path}.fai', 'r') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 5:
+                    continue
+                name, length, offset, line_bases, line_width = fields[:5]
+                chrs[name] = {'length' : int(length), 'offset' : int(offset),
+                              'line_bases' : int(line_bases), 'line_width' : int(line_width)}
+        self.bgzip = os.path.exists(f'{path}.gzi')
+        if self.bgzip:
+            gzi = np.fromfile(f'{path}.gzi', dtype = '<u8')
+            blocks = np.concatenate([[0, 0], gzi[1 : 1 + 2 * int(gzi[0])]]).reshape(-1, 2)
+            self.block_offsets = blocks[:, 0].astype(np.int64) # compressed offsets
+            self.block_starts = blocks[:, 1].astype(np.int64) # uncompressed offsets
+        elif path.endswith(('.gz', '.bgz')):
+            raise Exception(f'Compressed fasta needs a bgzip index: {path}.gzi')
+        return chrs
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        from chromnitron_data.transforms import BASE_CODE_TABLE
+        record = self.chrs[chr_name]
+        start, end = max(start, 0), min(end, record['length'])
+        if end <= start:
+            return np.zeros(0, dtype = np.uint8)
+        byte_start = self.byte_offset(record, start)
+        byte_end = self.byte_offset(record, end - 1) + 1
+        raw = np.frombuffer(self.read_bytes(byte_start, byte_end), dtype = np.uint8)
+        if record['line_width'] != record['line_bases']:
+            raw = raw[(raw != ord('\n')) & (raw != ord('\r'))]
+        return BASE_CODE_TABLE[raw]
+
+    def byte_offset(self, record, position):
+        ''' Byte offset of a base in the uncompressed file, skipping line endings '''
+        line_idx, line_pos = divmod(position, record['line_bases'])
+        return record['offset'] + line_idx * record['line_width'] + line_pos
+
+    def read_bytes(self, byte_start, byte_end):
+        if not self.bgzip:
+            return self.mmap()[byte_start:byte_end]
+        return self.read_bgzip(byte_start, byte_end)
+
+    def read_bgzip(self, byte_start, byte_end):
+        ''' Decompress the BGZF blocks covering an uncompressed byte range '''
+        import zlib
+        import numpy as np
+        file = self.mmap()
+        block_idx = np.searchsorted(self.block_starts, byte_start, side = 'right') - 1
+        position = int(self.block_offsets[block_idx])
+        block_start = int(self.block_starts[block_idx])
+        data = []
+        decoded_end = block_start
+        while decoded_end < byte_end and position < len(file):
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) # one gzip member per block
+            compressed = file[position : position + 65536] # BGZF blocks are at most 64 KB
+            block = decompressor.decompress(compressed)
+            position += len(compressed) - len(decompressor.unused_data)
+            data.append(block)
+            decoded_end += len(block)
+        return b''.join(data)[byte_start - block_start : byte_end - block_start]
+
+class TwoBitStorage(SequenceFileStorage):
+    ''' UCSC .2bit storage, packed bases are decoded with a byte lookup table and N blocks are masked.
+    Soft-masked (lowercase) blocks are ignored since base codes are case-insensitive.
+    '''
+    SIGNATURE = 0x1A412743
+    PACKED_CODES = [3, 1, 0, 2] # 2bit packs T, C, A, G as 0, 1, 2, 3
+
+    def read_index(self, path):
+        import numpy as np
+        if self.verbose: print(f'Loading 2bit index of {path}...')
+        with open(path, 'rb') as f:
+            header = f.read(16)
+            byteorder = '<' if int.from_bytes(header[:4], 'little') == self.SIGNATURE else '>'
+            if int.from_bytes(header[:4], 'little' if byteorder == '<' else 'big') != self.SIGNATURE:
+                raise Exception(f'Invalid 2bit file: {path}')
+            version, seq_count = np.frombuffer(header[4:12], dtype = f'{byteorder}u4')
+            offset_dtype = f'{byteorder}u8' if version == 1 else f'{byteorder}u4'
+            offsets = {}
+            for _ in range(seq_count):
+                name_size = f.read(1)[0]
+                name = f.read(name_size).decode()
+                offsets[name] = int(np.frombuffer(f.read(np.dtype(offset_dtype).itemsize), dtype = offset_dtype)[0])
+            chrs = {}
+            for name, offset in offsets.items():
+                if name not in self.chr_lengths:
+                    continue
+                f.seek(offset)
+                length, n_block_count = np.frombuffer(f.read(8), dtype = f'{byteorder}u4')
+                n_blocks = np.frombuffer(f.read(8 * int(n_block_count)), dtype = f'{byteorder}u4').astype(np.int64).reshape(2, -1)
+                mask_block_count = int(np.frombuffer(f.read(4), dtype = f'{byteorder}u4')[0])
+                packed_offset = offset + 12 + 8 * int(n_block_count) + 8 * mask_block_count + 4
+                chrs[name] = {'length' : int(length), 'packed_offset' : packed_offset,
+                              'n_starts' : n_blocks[0], 'n_ends' : n_blocks[0] + n_blocks[1]}
+        self.decode_table = self.build_decode_table()
+        return chrs
+
+    def build_decode_table(self):
+        ''' Packed byte -> 4 base codes table '''
+        import numpy as np
+        packed = np.arange(256, dtype = np.uint8)
+        shifts = np.array([6, 4, 2, 0], dtype = np.uint8)
+        return np.array(self.PACKED_CODES, dtype = np.uint8)[(packed[:, None] >> shifts) & 3]
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        from chromnitron_data.transforms import N_CODE
+        record = self.chrs[chr_name]
+        start, end = max(start, 0), min(end, record['length'])
+        if end <= start:
+            return np.zeros(0, dtype = np.uint8)
+        packed_start = record['packed_offset'] + start // 4
+        packed_end = record['packed_offset'] + (end + 3) // 4
+        packed = np.frombuffer(self.mmap()[packed_start:packed_end], dtype = np.uint8)
+        codes = self.decode_table[packed].reshape(-1)[start % 4 : start % 4 + end - start]
+        # N blocks overlapping the region
+        n_starts, n_ends = record['n_starts'], record['n_ends']
+        first = np.searchsorted(n_ends, start, side = 'right')
+        last = np.searchsorted(n_starts, end, side = 'left')
+        for n_start, n_end in zip(n_starts[first:last], n_ends[first:last]):
+            codes[max(n_start, start) - start : min(n_end, end) - start] = N_CODE
+        return codes
+
 class HiCNpzStorage(NpyStorage):
     ''' Npz storage assume npy files are stored by chromosomes (chrX.npy, etc. '''
     def load(self, path):
@@ -39,27 +639,71 @@ class HiCNpzStorage(NpyStorage):
         return chrs
 
     def get(self, chr_name, start, end):
+        ''' Get the square contact matrix of a region, M[i, j] = diagonal(j - i)[start + min(i, j)] '''
         import numpy as np
-        ori_load = self.chrs[chr_name]
+        diagonals = self.chrs[chr_name]
         square_len = end - start
-        diag_load = {}
+        diag_region = np.zeros((square_len, square_len), dtype = diagonals['0'].dtype)
+        flat_region = diag_region.reshape(-1)
         for diag_i in range(square_len):
-            diag_load[str(diag_i)] = ori_load[str(diag_i)][start : start + square_len - diag_i]
-            diag_load[str(-diag_i)] = ori_load[str(-diag_i)][start : start + square_len - diag_i]
-        start -= start
-        end -= start
+            diag_len = square_len - diag_i
+            # Upper diagonal starts at flat index diag_i, lower diagonal at row diag_i, both step by square_len + 1
+            upper_start, lower_start = diag_i, diag_i * square_len
+            flat_region[upper_start : upper_start + diag_len * (square_len + 1) : square_len + 1] = diagonals[str(diag_i)][start : start + diag_len]
+            if diag_i > 0:
+                flat_region[lower_start : lower_start + diag_len * (square_len + 1) : square_len + 1] = diagonals[str(-diag_i)][start : start + diag_len]
+        return diag_region
 
-        diag_region = []
-        for diag_i in range(square_len):
-            diag_line = []
-            for line_i in range(-1 * diag_i, -1 * diag_i + square_len):
-                if line_i < 0:
-                    diag_line.append(diag_load[str(line_i)][start + line_i + diag_i])
-                else:
-                    diag_line.append(diag_load[str(line_i)][start + diag_i])
-            diag_region.append(diag_line)
-        diag_region = np.array(diag_region).reshape(square_len, square_len)
+    def get_many(self, chr_name, starts, ends):
+        import numpy as np
+        # Contact matrix windows are squares on the diagonal, they can not be sliced from one span
+        return np.stack([self.get(chr_name, start, end) for start, end in zip(starts, ends)])
+
+    def get_data_chr_length(self, chr_data):
+        return len(chr_data['0'])
+
+class HiCBandedStorage(HiCNpzStorage):
+    ''' Banded contact matrix storage, diagonals -K..K of a chromosome stored as one (2K + 1, length) .npy per chromosome,
+    row K + d holds diagonal d indexed by min(i, j). Files are memory mapped so any window is sliced directly.
+    Built by utils/hic_to_banded.py, contacts beyond K diagonals are 0.
+    '''
+    def load(self, path):
+        import numpy as np
+        if self.verbose: print(f'Loading banded contact matrices from {path}...')
+        chrs = {}
+        for chr_name, chr_length in self.chr_lengths.items():
+            chrs[chr_name] = np.load(f'{path}/{chr_name}.npy', mmap_mode = 'r')
+        self.max_diagonal = (next(iter(chrs.values())).shape[0] - 1) // 2 if len(chrs) > 0 else 0
+        return chrs
+
+    def get(self, chr_name, start, end):
+        import numpy as np
+        band = self.chrs[chr_name][:, start:end]
+        diag_idx, pos_idx, in_band = band_indices(int(end - start), self.max_diagonal)
+        diag_region = np.zeros((end - start, end - start), dtype = band.dtype)
+        diag_region[in_band] = band[diag_idx, pos_idx]
         return diag_region
 
     def get_data_chr_length(self, chr_data):
-        return len(chr_data['0'])
\ No newline at end of file
+        return chr_data.shape[-1]
+
+    def __getstate__(self):
+        # Reopen memmaps in workers instead of pickling their content
+        state = self.__dict__.copy()
+        state['chrs'] = {chr_name : chr_data.filename for chr_name, chr_data in self.chrs.items()}
+        return state
+
+    def __setstate__(self, state):
+        import numpy as np
+        self.__dict__.update(state)
+        self.chrs = {chr_name : np.load(chr_path, mmap_mode = 'r') for chr_name, chr_path in self.chrs.items()}
+
+@functools.lru_cache(maxsize = 8)
+def band_indices(square_len, max_diagonal):
+    ''' Band row and position of every in-band cell of a square window, cached per window size '''
+    import numpy as np
+    rows, cols = np.indices((square_len, square_len))
+    offsets = cols - rows
+    in_band = np.abs(offsets) <= max_diagonal
+    return (max_diagonal + offsets)[in_band], np.minimum(rows, cols)[in_band], in_band
+
@@ -1,14 +1,20 @@
 import numpy as np
 
+from chromnitron_data.origami_infrastructure.storage import Storage
+
 class Track:
     ''' Genomic track class  '''
-    def __init__(self, storage, resolution = 1):
+    def __init__(self, storage, resolution = 1, aggregation = 'mean'):
         ''' Initialize track
         storage: storage object
-        resolution: storage bin size in base pairs
+        resolution: storage bin size in base pairs. For storages with pyramid levels, the requested bin size,
+                    served from the coarsest level dividing it
+        aggregation: pyramid aggregation, mean or max
         '''
         self.storage = storage
         self.resolution = resolution
+        self.aggregation = aggregation
+        self.level_storages = {}
 
     def get(self, chrom, start, end):
         ''' Get track data
@@ -16,9 +22,49 @@ class Track:
         start: start position
         end: end position
         '''
-        storage_start = start // self.resolution
-        storage_end = end // self.resolution
-        return self.storage.get(chrom, storage_start, storage_end)
+        level = self.select_level()
+        if level is None:
+            storage_start = start // self.resolution
+            storage_end = end // self.resolution
+            return self.storage.get(chrom, storage_start, storage_end)
+        track_data = self.get_level_storage(level).get(chrom, start // level, end // level)
+        return self.reduce_level(track_data, level)
+
+    def get_many(self, chrom, starts, ends):
+        ''' Get track data for a group of equal length windows on one chromosome
+        chrom: chromosome name
+        starts: start positions
+        ends: end positions
+        return: array of shape (n_windows, ..., window_length)
+        '''
+        level = self.select_level()
+        if level is None:
+            storage_starts = np.asarray(starts) // self.resolution
+            storage_ends = np.asarray(ends) // self.resolution
+            return self.storage.get_many(chrom, storage_starts, storage_ends)
+        track_data = self.get_level_storage(level).get_many(chrom, np.asarray(starts) // level, np.asarray(ends) // level)
+        return self.reduce_level(track_data, level)
+
+    def select_level(self):
+        ''' Coarsest pyramid level dividing the track resolution, None for storages without pyramid levels '''
+        resolutions = self.storage.pyramid_resolutions(self.aggregation) if isinstance(self.storage, Storage) else []
+        if len(resolutions) == 0:
+            return None
+        return max([1] + [level for level in resolutions if self.resolution % level == 0])
+
+    def get_level_storage(self, level):
+        if level == 1:
+            return self.storage
+        if level not in self.level_storages:
+            self.level_storages[level] = self.storage.level_storage(level, self.aggregation)
+        return self.level_storages[level]
+
+    def reduce_level(self, track_data, level):
+        ''' Aggregate level bins further up to the track resolution '''
+        from chromnitron_data.origami_infrastructure.pyramid import reduce_bins
+        if level == self.resolution:
+            return track_data
+        return reduce_bins(track_data, self.resolution // level, self.aggregation)
 
     def visualize(self, track_data):
         ''' Visualize track data '''
@@ -29,20 +75,69 @@ class Track:
         raise NotImplementedError
 
 class AggregatedTrack(Track):
-    ''' Aggregated track class '''
+    ''' Aggregated track class, storage is a list of storages (e.g. replicates) read concurrently on a thread pool '''
+
+    def __init__(self, storage, resolution = 1, num_threads = 1):
+        ''' Initialize track
+        storage: list of storage objects
+        resolution: storage bin size in base pairs
+        num_threads: threads reading storages concurrently, zarr and pyBigWig decode release the GIL
+        '''
+        super().__init__(storage, resolution)
+        self.num_threads = num_threads
+        self.executor = None
+        self.executor_pid = None
 
     def get(self, chrom, start, end):
         storage_start = start // self.resolution
         storage_end = end // self.resolution
-        track_data = [s.get(chrom, storage_start, storage_end) for s in self.storage]
-        track_data = np.array(track_data)
-        return self.aggregator(track_data)
+        return self.aggregate(self.read_storages(lambda s: s.get(chrom, storage_start, storage_end)))
+
+    def get_many(self, chrom, starts, ends):
+        storage_starts = np.asarray(starts) // self.resolution
+        storage_ends = np.asarray(ends) // self.resolution
+        return self.aggregate(self.read_storages(lambda s: s.get_many(chrom, storage_starts, storage_ends)))
+
+    def read_storages(self, read):
+        ''' Apply read to every storage, results are yielded in storage order '''
+        if self.num_threads <= 1 or len(self.storage) <= 1:
+            return (read(s) for s in self.storage)
+        return self.thread_pool().map(read, self.storage)
+
+    def thread_pool(self):
+        ''' Thread pool of this process, DataLoader workers do not inherit the parent's threads '''
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers = self.num_threads)
+            self.executor_pid = os.getpid()
+        return self.executor
+
+    def aggregate(self, track_data):
+        ''' Aggregate an iterable of per-storage arrays '''
+        return self.aggregator(np.array(list(track_data)))
 
     def aggregator(self, x):
         raise NotImplementedError
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['executor'] = None
+        state['executor_pid'] = None
+        return state
+
 class TrackSum(AggregatedTrack):
     ''' Sum of tracks '''
 
+    def aggregate(self, track_data):
+        # Accumulate in storage order into one buffer as reads complete, without stacking
+        total = None
+        for data in track_data:
+            if total is None:
+                total = np.array(data, dtype = np.zeros(0, dtype = data.dtype).sum().dtype) # Same dtype as np.sum
+            else:
+                total += data
+        return total
+
     def aggregator(self, x):
         return np.sum(x, axis=0)
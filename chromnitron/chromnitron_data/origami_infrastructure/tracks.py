@@ -8,3 +8,19 @@ class SequenceEmbeddingTrack(Track):
     def save(self, track_data, save_path):
         ''' Save track data '''
         raise NotImplementedError
+
+class StackedSampleTrack(Track):
+    ''' One sample of a StackedZarrStorage. Tracks on storages selected from one shared StackedZarrStorage
+    share its chunk cache, so a cached chunk serves the window of every cell type.
+    '''
+
+    def __init__(self, storage, sample, resolution = 1):
+        super().__init__(storage, resolution)
+        self.sample = sample
+        self.row = list(storage.sample_idx).index(storage.samples.index(sample))
+
+    def get(self, chrom, start, end):
+        return super().get(chrom, start, end)[self.row]
+
+    def get_many(self, chrom, starts, ends):
+        return super().get_many(chrom, starts, ends)[:, self.row]
@@ -0,0 +1,217 @@
+import functools
+import gzip
+import numpy as np
+
+from chromnitron_data.origami_infrastructure.storage import Storage
+
+class VariantIndex:
+    ''' Sorted in-memory index of one haplotype's variants per chromosome.
+    Alleles are stored as uint8 base codes concatenated per chromosome:
+        positions: 0-based reference start of each variant
+        ref_lengths: reference allele length
+        alt_offsets: start of each alternative allele in alt_codes (length n + 1)
+    '''
+
+    def __init__(self, vcf_path, sample = None, haplotype = 0, pass_only = True, chrs = None):
+        ''' Initialize index
+        vcf_path: .vcf or .vcf.gz file
+        sample: sample column to read genotypes from, None for the first sample,
+                sites only VCFs apply the first alternative allele
+        haplotype: 0 or 1, allele of the genotype to apply, unphased genotypes are taken in listed order
+        pass_only: skip variants with a FILTER other than PASS or .
+        chrs: chromosomes to index, None for all
+        '''
+        self.vcf_path = vcf_path
+        self.sample = sample
+        self.haplotype = haplotype
+        self.pass_only = pass_only
+        self.chrs = self.read_vcf(vcf_path, chrs)
+
+    def read_vcf(self, vcf_path, chrs):
+        from chromnitron_data.transforms import encode_bases
+        records = {}
+        sample_col = None
+        opener = gzip.open if vcf_path.endswith(('.gz', '.bgz')) else open
+        with opener(vcf_path, 'rt') as f:
+            for line in f:
+                if line.startswith('##'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if line.startswith('#'):
+                    sample_col = self.find_sample_column(fields)
+                    continue
+                chrom, pos, _, ref, alts, _, filter_value = fields[:7]
+                if chrs is not None and chrom not in chrs:
+                    continue
+                if self.pass_only and filter_value not in ['PASS', '.']:
+                    continue
+                allele = self.get_allele(fields, sample_col)
+                if allele is None or allele == 0:
+                    continue
+                alt = alts.split(',')[allele - 1]
+                if alt in ['.', '*'] or '<' in alt or '[' in alt or ']' in alt:
+                    continue # Symbolic and breakend alleles are not sequence edits
+                records.setdefault(chrom, []).append((int(pos) - 1, len(ref), alt))
+        chr_index = {}
+        for chrom, variants in records.items():
+            variants.sort(key = lambda variant: variant[0])
+            kept = []
+            for variant in variants:
+                # Drop variants overlapping an earlier one on the same haplotype
+                if len(kept) > 0 and variant[0] < kept[-1][0] + kept[-1][1]:
+                    continue
+                kept.append(variant)
+            alt_codes = [encode_bases(alt) for _, _, alt in kept]
+            alt_lengths = np.array([len(codes) for codes in alt_codes], dtype = np.int64)
+            chr_index[chrom] = {'positions' : np.array([variant[0] for variant in kept], dtype = np.int64),
+                                'ref_lengths' : np.array([variant[1] for variant in kept], dtype = np.int64),
+                                'alt_offsets' : np.concatenate([[0], np.cumsum(alt_lengths)]).astype(np.int64),
+                                'alt_codes' : np.concatenate(alt_codes) if len(alt_codes) > 0 else np.zeros(0, dtype = np.uint8)}
+        return chr_index
+
+    def find_sample_column(self, header):
+        if len(header) <= 9:
+            return None
+        if self.sample is None:
+            return 9
+        if self.sample not in header[9:]:
+            raise ValueError(f'Sample {self.sample} not found in {self.vcf_path}')
+        return header.index(self.sample)
+
+    def get_allele(self, fields, sample_col):
+        ''' Allele index of the selected haplotype, None if missing '''
+        if sample_col is None:
+            return 1
+        genotype = fields[sample_col].split(':')[fields[8].split(':').index('GT')]
+        alleles = genotype.replace('|', '/').split('/')
+        allele = alleles[min(self.haplotype, len(alleles) - 1)] # Haploid calls apply to both haplotypes
+        return None if allele == '.' else int(allele)
+
+    def find(self, chr_name, start, end):
+        ''' Index range of variants overlapping [start, end) '''
+        if chr_name not in self.chrs:
+            return 0, 0
+        positions, ref_lengths = self.chrs[chr_name]['positions'], self.chrs[chr_name]['ref_lengths']
+        first = np.searchsorted(positions, start, side = 'left')
+        if first > 0 and positions[first - 1] + ref_lengths[first - 1] > start:
+            first -= 1 # Deletion spanning start
+        last = np.searchsorted(positions, end, side = 'left')
+        return first, last
+
+@functools.lru_cache(maxsize = 8)
+def load_variant_index(vcf_path, sample = None, haplotype = 0, pass_only = True, chrs = None):
+    ''' Variant index of a VCF, cached so that datasets of all (CAP, cell type) jobs share one parse
+    chrs: frozenset of chromosomes to index, None for all
+    '''
+    return VariantIndex(vcf_path, sample, haplotype, pass_only, chrs)
+
+def read_vcf_snvs(vcf_path, chrs = None, pass_only = True):
+    ''' Single nucleotide variants of a VCF, regardless of genotypes
+    vcf_path: .vcf or .vcf.gz file
+    chrs: chromosomes to keep, None for all
+    pass_only: skip variants with a FILTER other than PASS or .
+    return: DataFrame of chr, pos (0-based), id, ref, alt, multi-allelic sites give one row per alternative allele
+    '''
+    import pandas as pd
+    columns = {'chr' : [], 'pos' : [], 'id' : [], 'ref' : [], 'alt' : []}
+    opener = gzip.open if vcf_path.endswith(('.gz', '.bgz')) else open
+    with opener(vcf_path, 'rt') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            chrom, pos, variant_id, ref, alts, _, filter_value = line.rstrip('\n').split('\t')[:7]
+            if chrs is not None and chrom not in chrs:
+                continue
+            if pass_only and filter_value not in ['PASS', '.']:
+                continue
+            if len(ref) != 1:
+                continue
+            for alt in alts.split(','):
+                if len(alt) != 1 or alt.upper() not in 'ACGT':
+                    continue # Indels, symbolic and missing alleles are not single base edits
+                columns['chr'].append(chrom)
+                columns['pos'].append(int(pos) - 1)
+                columns['id'].append(variant_id)
+                columns['ref'].append(ref.upper())
+                columns['alt'].append(alt.upper())
+    return pd.DataFrame(columns).astype({'pos' : np.int64})
+
+class VariantOverlayStorage(Storage):
+    ''' Sequence storage applying one haplotype's SNVs and indels from a VCF on top of a reference storage.
+    Windows keep reference coordinates of their start and their length: insertions push bases out of the end
+    and deletions pull in downstream reference bases. get returns uint8 base codes.
+    '''
+    base_codes = True
+
+    def __init__(self, reference, vcf_path, sample = None, haplotype = 0, pass_only = True, verbose = False):
+        ''' Initialize storage
+        reference: reference sequence storage
+        vcf_path: .vcf or .vcf.gz file
+        sample: VCF sample name, None for the first sample
+        haplotype: 0 or 1
+        '''
+        self.reference = reference
+        self.variant_kwargs = {'sample' : sample, 'haplotype' : haplotype, 'pass_only' : pass_only}
+        super().__init__(vcf_path, reference.assembly, reference.chr_lengths, check_length = False, verbose = verbose)
+
+    def load(self, path):
+        if self.verbose: print(f'Loading variants from {path}...')
+        self.variants = load_variant_index(path, chrs = frozenset(self.reference.chr_lengths), **self.variant_kwargs)
+        return self.reference.chrs
+
+    def get_reference(self, chr_name, start, end):
+        from chromnitron_data.transforms import encode_bases
+        seq = self.reference.get(chr_name, start, end)
+        return seq if self.reference.base_codes else encode_bases(seq)
+
+    def get(self, chr_name, start, end):
+        length = end - start
+        read_end = end
+        while True:
+            haplotype = self.get_haplotype(chr_name, start, read_end)
+            if len(haplotype) >= length or read_end >= self.chr_lengths[chr_name]:
+                return haplotype[:length]
+            read_end = min(read_end + (length - len(haplotype)) + 1024, self.chr_lengths[chr_name])
+
+    def get_haplotype(self, chr_name, start, end):
+        ''' Haplotype sequence starting at reference position start, built from reference [start, end) '''
+        first, last = self.variants.find(chr_name, start, end)
+        if first == last:
+            return self.get_reference(chr_name, start, end)
+        index = self.variants.chrs[chr_name]
+        positions = index['positions'][first:last]
+        ref_lengths = index['ref_lengths'][first:last]
+        alt_offsets = index['alt_offsets']
+        read_start = min(start, int(positions[0]))
+        read_end = max(end, int(positions[-1] + ref_lengths[-1]))
+        reference = self.get_reference(chr_name, read_start, read_end)
+        pieces = []
+        cursor = read_start
+        hap_length = 0
+        start_offset = None
+        for variant_idx, position, ref_length in zip(range(first, last), positions, ref_lengths):
+            if start_offset is None and position >= start:
+                start_offset = hap_length + start - cursor
+            pieces.append(reference[cursor - read_start : position - read_start])
+            hap_length += position - cursor
+            alt = index['alt_codes'][alt_offsets[variant_idx] : alt_offsets[variant_idx + 1]]
+            if start_offset is None and position + ref_length > start:
+                # Variant spanning start, keep the part of the alternative allele past start
+                start_offset = hap_length + min(len(alt), start - position)
+            pieces.append(alt)
+            hap_length += len(alt)
+            cursor = position + ref_length
+        if start_offset is None:
+            start_offset = hap_length + start - cursor
+        pieces.append(reference[cursor - read_start : end - read_start])
+        return np.concatenate(pieces)[start_offset:]
+
+    def get_many(self, chr_name, starts, ends):
+        # Indels shift windows by different amounts, so windows can not be sliced from one span
+        return np.stack([self.get(chr_name, start, end) for start, end in zip(starts, ends)])
+
+    def get_data_chr_length(self, chr_data):
+        return self.reference.get_data_chr_length(chr_data)
+
+    def cache_stats(self):
+        return self.reference.cache_stats()
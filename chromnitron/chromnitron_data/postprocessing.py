@@ -65,4 +65,5 @@ def run_store_zarr(config, celltype, cap, data_dict, chr_sizes):
         return
     os.makedirs(os.path.dirname(zarr_path), exist_ok=True)
     print(f'Storing zarr for {celltype} with {cap}')
-    export_to_zarr(zarr_path, chr_sizes, data_dict)
+    pyramid_resolutions = config['inference_config']['post_processing'].get('zarr_pyramid', None)
+    export_to_zarr(zarr_path, chr_sizes, data_dict, pyramid_resolutions = pyramid_resolutions)
@@ -0,0 +1,85 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+class ChunkLocalityBatchSampler(Sampler):
+    ''' Batch sampler that orders windows by (chrom, start) and hands every DataLoader worker
+    one contiguous, chunk aligned span of the genome, so each storage chunk is decompressed by a single worker.
+
+    DataLoader dispatches batches to workers round-robin, so batches of the spans are interleaved
+    and every span is split into the same number of batches. Predictions come back in sampler order,
+    use restore_order to put them back in dataset order.
+    '''
+
+    def __init__(self, region, batch_size, num_workers, chunk_size = 1000000):
+        ''' Initialize sampler
+        region: partition with a to_table method or loci rows of [chr, start, end, ...]
+        batch_size: maximum number of windows per batch
+        num_workers: number of DataLoader workers
+        chunk_size: storage chunk size in base pairs
+        '''
+        self.batch_size = batch_size
+        self.num_workers = max(1, num_workers)
+        self.chunk_size = chunk_size
+        chroms, starts = get_window_positions(region)
+        chrom_names, chrom_codes = np.unique(chroms, return_inverse = True)
+        self.sorted_idx = np.lexsort((starts, chrom_codes))
+        chunk_keys = chrom_codes[self.sorted_idx] * (starts.max(initial = 0) // chunk_size + 1) + starts[self.sorted_idx] // chunk_size
+        self.batches = self.build_batches(chunk_keys)
+        self.order = np.concatenate(self.batches) if len(self.batches) > 0 else np.zeros(0, dtype = int)
+
+    def build_batches(self, chunk_keys):
+        ''' Split sorted windows into worker spans and interleave their batches '''
+        n_windows = len(chunk_keys)
+        n_spans = min(self.num_workers, n_windows)
+        if n_spans == 0:
+            return []
+        span_bounds = self.split_spans(chunk_keys, n_spans)
+        span_lengths = np.diff(span_bounds)
+        n_batches = -(-span_lengths.max() // self.batch_size)
+        if span_lengths.min() < n_batches:
+            # Too few chunks to align every span, fall back to an even split with the longer spans first
+            span_lengths = np.full(n_spans, n_windows // n_spans)
+            span_lengths[:n_windows % n_spans] += 1
+            span_bounds = np.concatenate([[0], np.cumsum(span_lengths)])
+            n_batches = -(-span_lengths.max() // self.batch_size)
+        span_batches = [np.array_split(self.sorted_idx[lo:hi], n_batches) for lo, hi in zip(span_bounds[:-1], span_bounds[1:])]
+        # Every round holds one batch per span, so batch i goes to worker i % num_workers and span s to worker s.
+        # Spans shorter than n_batches only occur in the even split, where they are the trailing spans and only
+        # their last batch is empty, so skipping it shortens the final round without shifting any other batch.
+        batches = []
+        for batch_idx in range(n_batches):
+            for batches_in_span in span_batches:
+                if len(batches_in_span[batch_idx]) > 0:
+                    batches.append(batches_in_span[batch_idx])
+        return batches
+
+    def split_spans(self, chunk_keys, n_spans):
+        ''' Snap even split points to the nearest chunk boundary '''
+        n_windows = len(chunk_keys)
+        chunk_bounds = np.concatenate([[0], np.flatnonzero(np.diff(chunk_keys)) + 1, [n_windows]])
+        targets = np.linspace(0, n_windows, n_spans + 1)[1:-1]
+        nearest = np.abs(chunk_bounds[None, :] - targets[:, None]).argmin(axis = 1)
+        inner_bounds = np.maximum.accumulate(chunk_bounds[nearest])
+        return np.concatenate([[0], inner_bounds, [n_windows]])
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def restore_order(self, data):
+        ''' Reorder per-window outputs collected in sampler order back to dataset order '''
+        restored = np.empty_like(self.order)
+        restored[self.order] = np.arange(len(self.order))
+        if hasattr(data, 'iloc'):
+            return data.iloc[restored].reset_index(drop = True)
+        return data[restored]
+
+def get_window_positions(region):
+    ''' Get chromosome names and start positions of all windows in a partition '''
+    if hasattr(region, 'to_table'):
+        windows = region.to_table()
+        return windows.chrom_codes, windows.starts
+    return region.loci[:, 0], region.loci[:, 1].astype(int)
@@ -2,25 +2,96 @@ import random
 import numpy as np
 
 # Onehot
-def to_onehot(seq):
+# Base codes follow the acgtn channel order of the one-hot encoding
+BASES = 'acgtn'
+N_CODE = 4
+
+def _build_base_code_table():
+    ''' Byte -> base code table, a/c/g/t in either case, everything else (IUPAC, gaps) is n '''
+    table = np.full(256, N_CODE, dtype = np.uint8)
+    for code, base in enumerate(BASES[:4]):
+        table[ord(base)] = code
+        table[ord(base.upper())] = code
+    return table
+
+BASE_CODE_TABLE = _build_base_code_table()
+CODE_BASE_TABLE = np.frombuffer(BASES.encode(), dtype = np.uint8)
+COMPLEMENT_CODE_TABLE = np.array([3, 2, 1, 0, 4], dtype = np.uint8)
+ONEHOT_TABLE = np.eye(len(BASES), dtype = np.float32)
+
+def seq_to_bytes(seq):
+    ''' View a sequence (str, bytes, list of str or S1/U1/uint8 array) as uint8 ascii bytes.
+    A list of single character strings is one sequence, a list of equal length sequences is a batch (n, length).
+    '''
+    if isinstance(seq, str):
+        return np.frombuffer(seq.encode('ascii', errors = 'replace'), dtype = np.uint8)
+    if isinstance(seq, (bytes, bytearray, memoryview)):
+        return np.frombuffer(seq, dtype = np.uint8)
+    if isinstance(seq, (list, tuple)):
+        if all(isinstance(s, str) and len(s) == 1 for s in seq):
+            return seq_to_bytes(''.join(seq))
+        return np.stack([seq_to_bytes(s) for s in seq])
+    seq = np.asarray(seq)
+    if seq.dtype == np.uint8:
+        return seq
+    if seq.dtype.kind in 'SU' and seq.dtype.itemsize != np.dtype(f'{seq.dtype.kind}1').itemsize:
+        raise ValueError(f'Expected single character bases, got dtype {seq.dtype}')
+    if seq.dtype.kind == 'S':
+        return np.ascontiguousarray(seq).view(np.uint8)
+    if seq.dtype.kind == 'U':
+        # Non-ascii code points are folded to 0, which maps to n
+        codepoints = np.ascontiguousarray(seq).view(np.uint32)
+        return np.where(codepoints < 256, codepoints, 0).astype(np.uint8)
+    if seq.dtype.kind == 'O':
+        return seq_to_bytes(seq.astype('U1'))
+    raise ValueError(f'Unsupported sequence dtype: {seq.dtype}')
+
+def encode_bases(seq, out = None):
+    ''' Convert sequence to uint8 base codes (a:0, c:1, g:2, t:3, n:4)
+    seq: sequence of shape (..., length), see seq_to_bytes for accepted types
+    out: optional uint8 buffer of matching shape to write codes into
+    '''
+    return np.take(BASE_CODE_TABLE, seq_to_bytes(seq), out = out)
+
+def decode_bases(codes):
+    ''' Convert uint8 base codes to lower case sequence string(s) '''
+    base_bytes = np.take(CODE_BASE_TABLE, codes)
+    if base_bytes.ndim == 1:
+        return base_bytes.tobytes().decode('ascii')
+    return [decode_bases(c) for c in codes]
+
+def codes_to_onehot(codes, out = None):
+    ''' Expand base codes of shape (..., length) to float32 one-hot of shape (..., length, 5) '''
+    return np.take(ONEHOT_TABLE, codes, axis = 0, out = out)
+
+def onehot_to_codes(onehot_seq, out = None):
+    ''' Collapse one-hot of shape (..., length, 5) to uint8 base codes '''
+    if out is None:
+        return np.argmax(onehot_seq, axis = -1).astype(np.uint8)
+    out[...] = np.argmax(onehot_seq, axis = -1)
+    return out
+
+def to_onehot(seq, out = None):
     ''' Convert sequence to one-hot encoding '''
-    seq_dict = {'a' : [1,0,0,0,0],
-                'c' : [0,1,0,0,0],
-                'g' : [0,0,1,0,0],
-                't' : [0,0,0,1,0],
-                'n' : [0,0,0,0,1]}
-    onehot_seq = [seq_dict[base] for base in seq]
-    return np.array(onehot_seq).astype(np.float32)
+    return codes_to_onehot(encode_bases(seq), out = out)
 
 def onehot_to_base(onehot_seq):
     ''' Convert one-hot encoding to sequence '''
-    seq_dict = {0 : 'a',
-                1 : 'c',
-                2 : 'g',
-                3 : 't',
-                4 : 'n'}
-    base_seq = [seq_dict[onehot_base] for onehot_base in np.argmax(onehot_seq, axis = 1)]
-    return ''.join(base_seq)
+    return decode_bases(onehot_to_codes(onehot_seq))
+
+def set_base(seq, position, code):
+    ''' Set the base at position in place, seq is uint8 base codes (..., length) or one-hot (..., length, 5) '''
+    if seq.dtype == np.uint8:
+        seq[..., position] = code
+    else:
+        seq[..., position, :] = ONEHOT_TABLE[code]
+    return seq
+
+def get_base(seq, position):
+    ''' Base code at position of uint8 base codes (..., length) or one-hot (..., length, 5) '''
+    if seq.dtype == np.uint8:
+        return seq[..., position]
+    return np.argmax(seq[..., position, :], axis = -1).astype(np.uint8)
 
 # Log(x+1) transform and clip negative values
 def log1p_features(input_tracks, output_tracks):
@@ -69,11 +140,16 @@ def reverse_track(track):
     else:
         return track[::-1].copy()
 
-def reverse_complement(seq):
-    ''' Reverse complement onehot vector in form of acgtn '''
-    seq = seq[::-1].copy()
-    reversed_seq = np.concatenate([seq[:,3:4], seq[:,2:3], seq[:,1:2], seq[:,0:1], seq[:,4:5]], axis = 1)
-    return reversed_seq
+def reverse_complement(seq, out = None):
+    ''' Reverse complement onehot vector(s) in form of acgtn, shape (..., length, 5) '''
+    if out is None:
+        return seq[..., ::-1, COMPLEMENT_CODE_TABLE]
+    out[...] = seq[..., ::-1, COMPLEMENT_CODE_TABLE]
+    return out
+
+def reverse_complement_codes(codes, out = None):
+    ''' Reverse complement base codes of shape (..., length) '''
+    return np.take(COMPLEMENT_CODE_TABLE, codes[..., ::-1], out = out)
 
 # Gaussian Noise
 def add_gaussian_noise(seq, input_tracks, output_tracks, chance = 0.8):
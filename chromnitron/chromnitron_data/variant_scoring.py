@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+from torch.utils.data import Dataset
+
+import chromnitron_data.transforms as transforms
+
+# Variant scores are stored column-wise in a zarr group, one array per column:
+#     <path>/<column>   one row per variant: chr, pos, id, ref, alt, window_start, ref_match, ref_sum, alt_sum, delta_sum, delta_max
+#     root attrs: columns (column order), radius
+
+def variant_loci(variants, chr_sizes, window_size):
+    ''' Loci covering the variants of each chromosome, variants closer than a window are merged into one locus.
+    Loci are kept a window away from chromosome ends so that their windows stay within the chromosome.
+    '''
+    loci = []
+    for chrom, chr_variants in variants.groupby('chr', sort = False):
+        if chrom not in chr_sizes:
+            continue
+        positions = np.sort(chr_variants['pos'].to_numpy())
+        breaks = np.flatnonzero(np.diff(positions) > window_size) + 1
+        for group in np.split(positions, breaks):
+            start = max(int(group[0]), window_size)
+            end = min(int(group[-1]) + 1, chr_sizes[chrom] - window_size)
+            if end > start:
+                loci.append([chrom, start, end])
+    return loci
+
+class VariantScoringDataset(Dataset):
+    ''' Reference and alternative windows of single nucleotide variants.
+    Every variant is scored in the window whose center is closest to it. Items are ordered by window and the
+    reference item of a window is followed by the alternative items of all its variants, so every reference
+    window is predicted once and batched together with its alternatives. Alternative items carry
+    |variant:<index>|ref_match:<0 or 1> in their region id.
+    '''
+
+    def __init__(self, dataset, variants):
+        ''' Initialize dataset
+        dataset: InferenceDataset whose windows cover the variants
+        variants: DataFrame of chr, pos (0-based), ref, alt, e.g. from read_vcf_snvs
+        '''
+        self.dataset = dataset
+        self.variants = variants.reset_index(drop = True)
+        self.positions = self.variants['pos'].to_numpy(dtype = np.int64)
+        self.ref_codes = transforms.encode_bases(''.join(self.variants['ref']))
+        self.alt_codes = transforms.encode_bases(''.join(self.variants['alt']))
+        self.variant_windows, self.window_starts = self.assign_windows()
+        self.item_windows, self.item_variants = self.build_items()
+
+    def assign_windows(self):
+        ''' Window of every variant, -1 for variants outside of all windows
+        return: window indices and window starts per variant
+        '''
+        windows = self.dataset.region.to_table()
+        variant_windows = np.full(len(self.variants), -1, dtype = np.int64)
+        window_starts = np.full(len(self.variants), -1, dtype = np.int64)
+        chroms = self.variants['chr'].to_numpy()
+        for chrom_code, chrom in enumerate(windows.chrom_names):
+            chr_windows = np.flatnonzero(windows.chrom_codes == chrom_code)
+            chr_variants = np.flatnonzero(chroms == chrom)
+            if len(chr_windows) == 0 or len(chr_variants) == 0:
+                continue
+            centers = (windows.starts[chr_windows] + windows.ends[chr_windows]) / 2
+            order = np.argsort(centers, kind = 'stable')
+            chr_windows, centers = chr_windows[order], centers[order]
+            positions = self.positions[chr_variants]
+            # Nearest center is one of the two centers around the position
+            right = np.clip(np.searchsorted(centers, positions), 0, len(centers) - 1)
+            left = np.clip(right - 1, 0, len(centers) - 1)
+            nearest = np.where(np.abs(centers[left] - positions) <= np.abs(centers[right] - positions), left, right)
+            nearest_windows = chr_windows[nearest]
+            contained = (windows.starts[nearest_windows] <= positions) & (windows.ends[nearest_windows] > positions)
+            variant_windows[chr_variants[contained]] = nearest_windows[contained]
+            window_starts[chr_variants[contained]] = windows.starts[nearest_windows[contained]]
+        return variant_windows, window_starts
+
+    def build_items(self):
+        ''' Window and variant (-1 for the reference) of every item '''
+        scored = np.flatnonzero(self.variant_windows >= 0)
+        scored = scored[np.argsort(self.variant_windows[scored], kind = 'stable')]
+        windows = self.variant_windows[scored]
+        unique_windows, first = np.unique(windows, return_index = True)
+        item_windows = np.insert(windows, first, unique_windows)
+        item_variants = np.insert(scored, first, -1)
+        return item_windows, item_variants
+
+    def __len__(self):
+        return len(self.item_windows)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        ''' Items of a batch, every window is read once and copied for each of its variants '''
+        window_indices = np.unique(self.item_windows[indices]).tolist()
+        window_samples = dict(zip(window_indices, self.dataset.__getitems__(window_indices)))
+        samples = []
+        for idx in indices:
+            seq, input_features, esm_feature, (start, end, chrom, region_id, metadata_key) = window_samples[self.item_windows[idx]]
+            variant_idx = self.item_variants[idx]
+            if variant_idx < 0:
+                samples.append((seq, input_features, esm_feature, (start, end, chrom, f'{region_id}|ref', metadata_key)))
+                continue
+            offset = self.positions[variant_idx] - start
+            ref_match = int(transforms.get_base(seq[0], offset) == self.ref_codes[variant_idx])
+            alt_seq = transforms.set_base(seq.copy(), offset, self.alt_codes[variant_idx])
+            alt_region_id = f'{region_id}|variant:{variant_idx}|ref_match:{ref_match}'
+            samples.append((alt_seq, input_features, esm_feature, (start, end, chrom, alt_region_id, metadata_key)))
+        return samples
+
+    def get_static_inputs(self):
+        return self.dataset.get_static_inputs()
+
+class VariantScoreAccumulator:
+    ''' Per-variant summary scores from predictions of a VariantScoringDataset, streamed in item order.
+    Within radius bp of a variant, delta_sum is the sum of alternative minus reference predictions,
+    delta_max the difference with the largest magnitude, ref_sum and alt_sum the summed predictions.
+    Variants outside of all windows keep NaN scores.
+    '''
+
+    def __init__(self, dataset, radius = 1024):
+        self.dataset = dataset
+        self.radius = radius
+        self.scores = {name : np.full(len(dataset.variants), np.nan, dtype = np.float32)
+                       for name in ['ref_sum', 'alt_sum', 'delta_sum', 'delta_max']}
+        self.ref_match = np.zeros(len(dataset.variants), dtype = bool)
+        self.item_idx = 0
+        self.ref_pred = None
+
+    def add(self, preds, region_ids):
+        ''' Add predictions of the next items
+        preds: (batch, length) predictions in item order
+        region_ids: region ids of the items
+        '''
+        for pred, region_id in zip(preds, region_ids):
+            variant_idx = self.dataset.item_variants[self.item_idx]
+            self.item_idx += 1
+            if variant_idx < 0:
+                self.ref_pred = pred
+                continue
+            offset = self.dataset.positions[variant_idx] - self.dataset.window_starts[variant_idx]
+            lo, hi = max(offset - self.radius, 0), min(offset + self.radius + 1, len(pred))
+            ref_pred, alt_pred = self.ref_pred[lo:hi], pred[lo:hi]
+            delta = alt_pred - ref_pred
+            self.scores['ref_sum'][variant_idx] = ref_pred.sum()
+            self.scores['alt_sum'][variant_idx] = alt_pred.sum()
+            self.scores['delta_sum'][variant_idx] = delta.sum()
+            self.scores['delta_max'][variant_idx] = delta[np.argmax(np.abs(delta))]
+            self.ref_match[variant_idx] = region_id.endswith('ref_match:1')
+
+    def to_dataframe(self):
+        scores = self.dataset.variants.copy()
+        scores['window_start'] = self.dataset.window_starts
+        scores['ref_match'] = self.ref_match
+        for name, values in self.scores.items():
+            scores[name] = values
+        return scores
+
+    def save(self, path):
+        write_variant_scores(path, self.to_dataframe(), radius = self.radius)
+
+def write_variant_scores(path, scores, radius, chunk_size = 1000000):
+    ''' Write a DataFrame of variant scores as one zarr array per column '''
+    import zarr
+    import numcodecs
+    root = zarr.group(store = path, overwrite = True)
+    zarr_compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.SHUFFLE) # Setup compressor
+    for column in scores.columns:
+        values = scores[column].to_numpy()
+        chunks = max(1, min(chunk_size, len(values)))
+        if values.dtype == object:
+            root.create_dataset(column, data = values.astype(str).astype(object), chunks = chunks, dtype = object,
+                                object_codec = numcodecs.VLenUTF8(), compressor = zarr_compressor)
+        else:
+            root.create_dataset(column, data = values, chunks = chunks, compressor = zarr_compressor)
+    root.attrs['columns'] = list(scores.columns)
+    root.attrs['radius'] = int(radius)
+
+def load_variant_scores(path):
+    ''' Read variant scores written by write_variant_scores into a DataFrame '''
+    import zarr
+    root = zarr.open(path, mode = 'r')
+    return pd.DataFrame({column : root[column][:] for column in root.attrs['columns']})
@@ -0,0 +1,173 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+# Attribution of Chromnitron predictions to the one-hot sequence and ATAC-seq inputs.
+# The target of a window is the sum of its prediction (log1p scale) over target_region,
+# (start, end) offsets within the window, or over the whole window when target_region is None.
+# Attributions are written per window to zarr:
+#     <path>/seq    (windows, length) contribution of the reference base at every position
+#     <path>/atac   (windows, length) contribution of the log1p ATAC-seq signal at every position
+#     <path>/target (windows,) target value
+#     <path>/chr, start, end, region_id   window coordinates
+#     root attrs: method, target_region, steps
+
+def prepare_inputs(batch, device, static_esm_embeddings = None):
+    ''' One-hot sequence (batch, 5, length), features (batch, 1, length) and CAP embeddings of a DataLoader batch '''
+    seq, input_features, esm_embeddings, loc_info = batch
+    batch_size, mini_bs = seq.shape[:2]
+    seq = seq.to(device)
+    seq = seq.view(batch_size * mini_bs, *seq.shape[2:])
+    if seq.dtype == torch.uint8: # Base codes are expanded here so gradients are taken on the one-hot input
+        seq = nn.functional.one_hot(seq.long(), 5)
+    seq = seq.float().transpose(1, 2).contiguous()
+    input_features = input_features.to(device).view(batch_size * mini_bs, 1, -1).float()
+    if static_esm_embeddings is not None:
+        esm_embeddings = static_esm_embeddings
+    else:
+        esm_embeddings = esm_embeddings.to(device).float().transpose(-1, -2)
+    return seq, input_features, esm_embeddings, loc_info
+
+def target_output(model, seq, input_features, esm_embeddings, target_region = None):
+    ''' Prediction summed over the target region, (batch,) '''
+    preds, confidence = model((seq, input_features), esm_embeddings)
+    preds = preds[:, 0, :]
+    if target_region is not None:
+        preds = preds[:, target_region[0]:target_region[1]]
+    return preds.sum(dim = -1)
+
+def input_gradients(model, seq, input_features, esm_embeddings, target_region = None):
+    ''' Gradients of the target with respect to the sequence and feature inputs, one forward and backward pass '''
+    seq = seq.detach().requires_grad_(True)
+    input_features = input_features.detach().requires_grad_(True)
+    with torch.enable_grad():
+        target = target_output(model, seq, input_features, esm_embeddings, target_region)
+        seq_grad, feature_grad = torch.autograd.grad(target.sum(), [seq, input_features])
+    return seq_grad, feature_grad, target.detach()
+
+def gradient_x_input(model, seq, input_features, esm_embeddings, target_region = None):
+    ''' Gradient times input
+    return: sequence attribution (batch, 5, length), feature attribution (batch, 1, length), sequence gradients, target
+    '''
+    seq_grad, feature_grad, target = input_gradients(model, seq, input_features, esm_embeddings, target_region)
+    return seq_grad * seq, feature_grad * input_features, seq_grad, target
+
+def integrated_gradients(model, seq, input_features, esm_embeddings, target_region = None, steps = 16,
+                         seq_baseline = None, feature_baseline = None):
+    ''' Integrated gradients from an all-zero baseline, approximated with steps midpoint samples of the path.
+    Costs steps forward and backward passes plus one forward pass for the target at the input.
+    return: sequence attribution (batch, 5, length), feature attribution (batch, 1, length), path averaged sequence gradients, target
+    '''
+    seq_baseline = torch.zeros_like(seq) if seq_baseline is None else seq_baseline
+    feature_baseline = torch.zeros_like(input_features) if feature_baseline is None else feature_baseline
+    seq_grad_sum = torch.zeros_like(seq)
+    feature_grad_sum = torch.zeros_like(input_features)
+    for alpha in (np.arange(steps) + 0.5) / steps:
+        seq_grad, feature_grad, _ = input_gradients(model, seq_baseline + alpha * (seq - seq_baseline),
+                                                    feature_baseline + alpha * (input_features - feature_baseline),
+                                                    esm_embeddings, target_region)
+        seq_grad_sum += seq_grad
+        feature_grad_sum += feature_grad
+    with torch.no_grad():
+        target = target_output(model, seq, input_features, esm_embeddings, target_region)
+    seq_grad_mean = seq_grad_sum / steps
+    return (seq - seq_baseline) * seq_grad_mean, (input_features - feature_baseline) * feature_grad_sum / steps, seq_grad_mean, target
+
+def attribute(model, seq, input_features, esm_embeddings, method = 'gradient_x_input', target_region = None, steps = 16):
+    assert method in ['gradient_x_input', 'integrated_gradients']
+    if method == 'gradient_x_input':
+        return gradient_x_input(model, seq, input_features, esm_embeddings, target_region)
+    return integrated_gradients(model, seq, input_features, esm_embeddings, target_region, steps)
+
+def run_attribution(model, dataloader, zarr_path, method = 'gradient_x_input', target_region = None, steps = 16,
+                    use_tqdm = True, static_inputs = None):
+    ''' Attribute every window of a dataloader and stream the per-base contributions to zarr '''
+    import zarr
+    import numcodecs
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    static_esm_embeddings = None
+    if static_inputs is not None:
+        static_esm_embeddings = torch.from_numpy(static_inputs['esm_feature']).to(device).float().transpose(-1, -2)
+    root = zarr.group(store = zarr_path, overwrite = True)
+    zarr_compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.SHUFFLE) # Setup compressor
+    n_windows = len(dataloader.dataset)
+    loci = {'chr' : [], 'start' : [], 'end' : [], 'region_id' : []}
+    arrays = None
+    window_idx = 0
+    if use_tqdm:
+        from tqdm import tqdm
+        dataloader = tqdm(dataloader)
+    for batch in dataloader:
+        seq, input_features, esm_embeddings, loc_info = prepare_inputs(batch, device, static_esm_embeddings)
+        seq_attr, feature_attr, _, target = attribute(model, seq, input_features, esm_embeddings, method, target_region, steps)
+        if arrays is None:
+            window_size = seq.shape[-1]
+            chunks = (max(1, min(64, n_windows)), window_size)
+            arrays = {name : root.zeros(name, shape = (n_windows, window_size), chunks = chunks, dtype = np.float32, compressor = zarr_compressor)
+                      for name in ['seq', 'atac']}
+            arrays['target'] = root.zeros('target', shape = (n_windows,), chunks = (max(1, min(65536, n_windows)),), dtype = np.float32)
+        batch_end = window_idx + len(seq)
+        arrays['seq'][window_idx:batch_end] = seq_attr.sum(dim = 1).detach().cpu().numpy()
+        arrays['atac'][window_idx:batch_end] = feature_attr[:, 0].detach().cpu().numpy()
+        arrays['target'][window_idx:batch_end] = target.cpu().numpy()
+        window_idx = batch_end
+        loci['start'].extend(loc_info[0].tolist())
+        loci['end'].extend(loc_info[1].tolist())
+        loci['chr'].extend(loc_info[2])
+        loci['region_id'].extend(loc_info[3])
+    for name in ['chr', 'region_id']:
+        root.create_dataset(name, data = np.array(loci[name], dtype = object), dtype = object, object_codec = numcodecs.VLenUTF8())
+    for name in ['start', 'end']:
+        root.create_dataset(name, data = np.array(loci[name], dtype = np.int64))
+    root.attrs['method'] = method
+    root.attrs['target_region'] = None if target_region is None else [int(v) for v in target_region]
+    root.attrs['steps'] = int(steps) if method == 'integrated_gradients' else 1
+    return root
+
+def ism_deltas(model, seq, input_features, esm_embeddings, ism_region, target_region = None, batch_size = 16):
+    ''' Exhaustive in-silico mutagenesis of one window
+    seq, input_features: inputs of a single window, (1, 5, length) and (1, 1, length)
+    esm_embeddings: CAP embeddings of a single window
+    ism_region: (start, end) offsets to mutate
+    return: change of the target for every base (acgt) at every offset, (4, end - start), 0 at the reference base
+    '''
+    offsets = np.arange(ism_region[0], ism_region[1])
+    ref_bases = seq[0, :4, offsets].argmax(dim = 0).cpu().numpy()
+    edits = [(offset_idx, base) for offset_idx in range(len(offsets)) for base in range(4) if base != ref_bases[offset_idx]]
+    deltas = np.zeros((4, len(offsets)), dtype = np.float32)
+    with torch.no_grad():
+        ref_target = target_output(model, seq, input_features, esm_embeddings, target_region)[0]
+        for batch_start in range(0, len(edits), batch_size):
+            batch_edits = edits[batch_start : batch_start + batch_size]
+            mutated = seq.repeat(len(batch_edits), 1, 1)
+            for edit_idx, (offset_idx, base) in enumerate(batch_edits):
+                mutated[edit_idx, :, offsets[offset_idx]] = 0
+                mutated[edit_idx, base, offsets[offset_idx]] = 1
+            targets = target_output(model, mutated, input_features.expand(len(batch_edits), -1, -1), esm_embeddings, target_region)
+            for (offset_idx, base), target in zip(batch_edits, (targets - ref_target).cpu().numpy()):
+                deltas[base, offset_idx] = target
+    return deltas
+
+def compare_with_ism(model, seq, input_features, esm_embeddings, ism_region, target_region = None, method = 'gradient_x_input', steps = 16):
+    ''' Compare attribution of one window with exhaustive ISM over ism_region.
+    The attribution estimate of a mutation to base b is the first order change gradient[b] - gradient[reference base].
+    return: dictionary of ism and attribution deltas (4, n), their pearson correlation over mutations and the forward passes of each,
+            integrated gradients counts its steps path passes and the target pass
+    '''
+    import time
+    start_time = time.time()
+    ism = ism_deltas(model, seq, input_features, esm_embeddings, ism_region, target_region)
+    ism_time = time.time() - start_time
+    start_time = time.time()
+    _, _, seq_grad, _ = attribute(model, seq, input_features, esm_embeddings, method, target_region, steps)
+    attribution_time = time.time() - start_time
+    offsets = np.arange(ism_region[0], ism_region[1])
+    region_grad = seq_grad[0, :4, offsets].detach().cpu().numpy()
+    ref_bases = seq[0, :4, offsets].argmax(dim = 0).cpu().numpy()
+    estimate = region_grad - region_grad[ref_bases, np.arange(len(offsets))]
+    mutations = np.ones_like(ism, dtype = bool)
+    mutations[ref_bases, np.arange(len(offsets))] = False
+    pearson = np.corrcoef(ism[mutations], estimate[mutations])[0, 1]
+    return {'ism' : ism, 'attribution' : estimate, 'pearson' : float(pearson),
+            'ism_passes' : int(mutations.sum()) + 1, 'attribution_passes' : steps + 1 if method == 'integrated_gradients' else 1,
+            'ism_seconds' : ism_time, 'attribution_seconds' : attribution_time}
@@ -56,7 +56,8 @@ class MultiModalEncoder(nn.Module):
     def __init__(self, num_feat, hidden = 512, filter_size = 9, num_blocks = 2):
         super(MultiModalEncoder, self).__init__()
         hidden_start = hidden // 4
-        self.start_seq = ConvBlock(23, 2, hidden_in = 5, hidden = hidden_start)
+        self.num_bases = 5 # acgtn
+        self.start_seq = ConvBlock(23, 2, hidden_in = self.num_bases, hidden = hidden_start)
         self.start_feat = ConvBlock(23, 2, hidden_in = num_feat, hidden = hidden_start)
         hidden_ins = [hidden_start] + [hidden] * (num_blocks - 1)
         hiddens =                     [hidden] * num_blocks
@@ -66,6 +67,8 @@ class MultiModalEncoder(nn.Module):
 
     def forward(self, x):
         seq, epi = x
+        if seq.dim() == 2:
+            seq = self.expand_seq_codes(seq)
         seq = self.scale_seq(self.start_seq(seq))
         epi = self.scale_feat(self.start_feat(epi))
 
@@ -73,6 +76,11 @@ class MultiModalEncoder(nn.Module):
         out = self.conv_end(x)
         return out
 
+    def expand_seq_codes(self, seq_codes):
+        ''' Expand uint8 base codes (batch, length) to one-hot (batch, 5, length) '''
+        onehot = nn.functional.one_hot(seq_codes.long(), self.num_bases)
+        return onehot.transpose(1, 2).float()
+
     def get_res_blocks(self, n, his, hs, size):
         blocks = []
         for i, h, hi in zip(range(n), hs, his):
@@ -20,7 +20,9 @@ class Chromnitron(nn.Module):
         seq_embedding = self.encoder(seq_feature)
         batch_size = seq_embedding.size(0)
         chunk_size, num_targets, prot_h, prot_len = prot_feature.size()
-        assert chunk_size * self.sample_per_chunk == batch_size
+        # A single protein chunk is broadcast to the whole batch (static per-job input)
+        sample_per_chunk = batch_size if chunk_size == 1 else self.sample_per_chunk
+        assert chunk_size * sample_per_chunk == batch_size
         prot_feature = prot_feature.view(chunk_size * num_targets, prot_h, prot_len)
         prot_embedding_chunk = self.prot_encoder(prot_feature)
         prot_embedding_chunk = prot_embedding_chunk.view(chunk_size, num_targets, self.hidden, -1)
@@ -30,7 +32,7 @@ class Chromnitron(nn.Module):
         seq_emb_repeat = seq_embedding.unsqueeze(1).repeat(1, num_targets, 1, 1)
         split_emb = torch.zeros(batch_size, num_targets, self.hidden, 1, device = seq_embedding.device)
         # Repeat the protein embedding within each chunk to save memory
-        prot_emb_repeat = prot_embedding_chunk.repeat_interleave(self.sample_per_chunk, 0)
+        prot_emb_repeat = prot_embedding_chunk.repeat_interleave(sample_per_chunk, 0)
         joint_embedding = torch.cat([seq_emb_repeat, split_emb, prot_emb_repeat], dim = -1)
 
         joint_batch = joint_embedding.view(batch_size * num_targets, -1, joint_embedding.size(-1))
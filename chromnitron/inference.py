@@ -15,19 +15,34 @@ def main():
 
     # Inference
     if config['inference_config']['inference']['enable']:
-        for cap in cap_list:
-            print(f'Loading model for {cap}')
-            model = load_chromnitron(config, cap)
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            model.to(device)
-            for celltype in celltype_list:
-                if verify_prediction_exists(config, celltype, cap): continue
-                print(f'Loading data for {celltype}')
-                chr_sizes = get_chr_sizes(config, chrs)
-                dataloader = load_data(config, celltype, loci_info, cap, chr_sizes)
-                print(f'Running inference for {celltype} with {cap}')
-                pred_cache, label_df = run_inference(config, model, dataloader, celltype, cap)
-                save_prediction(pred_cache, label_df, config, celltype, cap)
+        from chromnitron_data.input_shards import order_jobs
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        model_cap = None
+        excluded_index = get_excluded_index(config) # Shared by all (CAP, cell type) jobs
+        stacked_storage = get_stacked_storage(config, get_chr_sizes(config, chrs)) # Shared by all cell types
+        for cap, celltype in order_jobs(cap_list, celltype_list):
+            if verify_prediction_exists(config, celltype, cap): continue
+            if cap != model_cap:
+                print(f'Loading model for {cap}')
+                model = load_chromnitron(config, cap)
+                model.to(device)
+                model_cap = cap
+            print(f'Loading data for {celltype}')
+            chr_sizes = get_chr_sizes(config, chrs)
+            dataloader = load_data(config, celltype, loci_info, cap, chr_sizes, excluded_index, stacked_storage)
+            print(f'Running inference for {celltype} with {cap}')
+            static_inputs = dataloader.dataset.get_static_inputs()
+            pred_cache, label_df = run_inference(config, model, dataloader, celltype, cap, static_inputs = static_inputs)
+            report_cache_stats(dataloader.dataset)
+            save_prediction(pred_cache, label_df, config, celltype, cap)
+
+    # Variant scoring
+    if config['inference_config'].get('variant_scoring', {}).get('enable', False):
+        run_variant_scoring(config, celltype_list, cap_list)
+
+    # Input attribution
+    if config['inference_config'].get('attribution', {}).get('enable', False):
+        run_input_attribution(config, loci_info, chrs, celltype_list, cap_list)
 
     # Post-processing
     if config['inference_config']['post_processing']['enable']:
@@ -61,28 +76,159 @@ def save_prediction(pred_cache, label_df, config, celltype, cap):
     label_df.to_csv(label_save_path, index=False)
     label_df[['chr', 'start', 'end', 'region_id']].to_csv(bed_save_path, header=False, index=False, sep='\t')
 
-def load_data(config, celltype, loci_info, cap, chr_sizes):
-    input_dict = config['input_resource']
-    input_seq_path = os.path.join(input_dict['root'], input_dict['sequence'], f'{config["inference_config"]["input"]["assembly"]}.zarr')
-    input_features_path = os.path.join(input_dict['root'], input_dict['atac'], f'{celltype}.zarr')
-    assembly = config['inference_config']['input']['assembly']
-    esm_feature_path = os.path.join(input_dict['root'], input_dict['cap'], f'{cap}.npz')
+def load_data(config, celltype, loci_info, cap, chr_sizes, excluded_index = None, stacked_storage = None):
+    if config['inference_config']['inference'].get('input_shards', False):
+        data = load_input_shard_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index, stacked_storage)
+    else:
+        data = build_inference_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index, stacked_storage)
 
-    if config['inference_config']['input']['excluded_region_path'] == 'auto':
-        excluded_region_path = f"{config['input_resource']['root']}/{config['input_resource']['sequence']}/{assembly}-blacklist.v2.bed"
+    batch_size = config['inference_config']['inference']['batch_size']
+    num_workers = config['inference_config']['inference']['num_workers']
+    batch_size = min(batch_size, len(data) // 2 + 1) # Ensure at least 2 batches
+    # Input shards are already decoded, locality only matters when reading storages
+    if config['inference_config']['inference'].get('chunk_locality', False) and hasattr(data, 'region'):
+        from chromnitron_data.samplers import ChunkLocalityBatchSampler
+        seq_storage = data.data['seq'].storage
+        seq_chunk_size = seq_storage.zarr_chr(next(iter(chr_sizes))).chunks[-1] if hasattr(seq_storage, 'zarr_chr') else 1000000
+        batch_sampler = ChunkLocalityBatchSampler(data.region, batch_size, num_workers, chunk_size = seq_chunk_size)
+        dataloader = torch.utils.data.DataLoader(data, batch_sampler=batch_sampler, num_workers=num_workers)
     else:
-        excluded_region_path = config['inference_config']['input']['excluded_region_path']
+        dataloader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    return dataloader
+
+def get_input_paths(config, celltype, cap):
+    input_dict = config['input_resource']
+    input_seq_path = find_input_path(os.path.join(input_dict['root'], input_dict['sequence']), config['inference_config']['input']['assembly'],
+                                     ['.zarr', '.2bit', '.fa', '.fasta', '.fa.gz', '.fasta.gz', '.fa.bgz', '.fasta.bgz'])
+    if input_dict.get('atac_stack', None) is not None:
+        input_features_path = os.path.join(input_dict['root'], input_dict['atac_stack'])
+    else:
+        input_features_path = find_atac_path(os.path.join(input_dict['root'], input_dict['atac']), celltype)
+    if input_dict.get('cap_bank', None) is not None:
+        esm_feature_path = os.path.join(input_dict['root'], input_dict['cap_bank'], cap) # Embedding in a packed bank
+    else:
+        esm_feature_path = os.path.join(input_dict['root'], input_dict['cap'], f'{cap}.npz')
+
+    excluded_region_path = get_excluded_region_path(config)
     if not os.path.exists(excluded_region_path):
         print(f'WARNING: {excluded_region_path} does not exist, using all regions')
+    return input_seq_path, input_features_path, esm_feature_path, excluded_region_path
+
+def get_excluded_region_path(config):
+    assembly = config['inference_config']['input']['assembly']
+    if config['inference_config']['input']['excluded_region_path'] == 'auto':
+        return f"{config['input_resource']['root']}/{config['input_resource']['sequence']}/{assembly}-blacklist.v2.bed"
+    return config['inference_config']['input']['excluded_region_path']
+
+def get_excluded_index(config):
+    ''' Interval index of the excluded regions, built once instead of per dataset, None if the file does not exist '''
+    from chromnitron_data.origami_infrastructure.partitions import load_interval_index
+    excluded_region_path = get_excluded_region_path(config)
+    if not os.path.exists(excluded_region_path):
+        return None
+    return load_interval_index(excluded_region_path)
+
+def get_stacked_storage(config, chr_sizes):
+    ''' Stacked multi-sample ATAC-seq storage opened once and shared by all cell types, None without atac_stack '''
+    atac_stack = config['input_resource'].get('atac_stack', None)
+    if atac_stack is None:
+        return None
+    from chromnitron_data.origami_infrastructure.storages import StackedZarrStorage
+    chunk_cache_size = int(config['inference_config']['inference'].get('chunk_cache_mb', 0) * 1024 ** 2)
+    shared_chunk_cache = config['inference_config']['inference'].get('shared_chunk_cache', False)
+    return StackedZarrStorage(os.path.join(config['input_resource']['root'], atac_stack), config['inference_config']['input']['assembly'], chr_sizes,
+                              cache_size = chunk_cache_size, shared_cache = shared_chunk_cache)
+
+def find_input_path(input_dir, name, extensions, default_extension = None):
+    ''' First existing <name><extension> in input_dir, e.g. sequence as .zarr, .2bit or .fa, ATAC-seq as .zarr or .bw
+    default_extension: extension of the returned path when none exists, defaults to the first extension
+    '''
+    for extension in extensions:
+        input_path = os.path.join(input_dir, f'{name}{extension}')
+        if os.path.exists(input_path):
+            return input_path
+    return os.path.join(input_dir, f'{name}{extensions[0] if default_extension is None else default_extension}')
+
+def find_atac_path(atac_dir, celltype):
+    ''' ATAC-seq track of a cell type, or the list of replicate tracks in an <atac_dir>/<celltype>/ directory '''
+    extensions = ['.rle.zarr', '.zarr', '.bw', '.bigwig', '.bigWig'] # .rle.zarr first, <celltype>.zarr would otherwise shadow it
+    replicate_dir = os.path.join(atac_dir, celltype)
+    if os.path.isdir(replicate_dir) and not os.path.exists(os.path.join(replicate_dir, '.zgroup')):
+        replicates = sorted(name for name in os.listdir(replicate_dir) if name.endswith(tuple(extensions)))
+        if len(replicates) > 0:
+            return [os.path.join(replicate_dir, name) for name in replicates]
+    return find_input_path(atac_dir, celltype, extensions, default_extension = '.zarr')
+
+def get_window_plan(config):
+    sample_size = config['inference_config']['input'].get('sample_size', 8192)
+    step_size = config['inference_config']['input'].get('step_size', 5120)
+    return sample_size, step_size
+
+def build_inference_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index = None, stacked_storage = None):
+    input_seq_path, input_features_path, esm_feature_path, excluded_region_path = get_input_paths(config, celltype, cap)
+    assembly = config['inference_config']['input']['assembly']
 
     from chromnitron_data.chromnitron_dataset import InferenceDataset
-    data = InferenceDataset(loci_info, input_seq_path, input_features_path, esm_feature_path, assembly, chr_sizes, metadata_key = celltype, excluded_region_path = excluded_region_path)
+    seq_encoding = config['inference_config']['inference'].get('seq_encoding', 'onehot')
+    static_esm_feature = config['inference_config']['inference'].get('static_cap_embedding', False)
+    chunk_cache_size = int(config['inference_config']['inference'].get('chunk_cache_mb', 0) * 1024 ** 2)
+    shared_chunk_cache = config['inference_config']['inference'].get('shared_chunk_cache', False)
+    decoded_cache_dir = config['inference_config']['inference'].get('decoded_cache_dir', None)
+    decoded_cache_gb = config['inference_config']['inference'].get('decoded_cache_gb', None)
+    decoded_cache_size = None if decoded_cache_gb is None else int(decoded_cache_gb * 1024 ** 3)
+    decoded_cache_mode = config['inference_config']['inference'].get('decoded_cache_mode', 'spans')
+    sample_size, step_size = get_window_plan(config)
+    input_features_sample = celltype if config['input_resource'].get('atac_stack', None) is not None else None
+    vcf_path, vcf_sample, vcf_haplotype = get_variant_inputs(config)
+    replicate_threads = config['inference_config']['inference'].get('replicate_threads', 1)
+    merged_replicate_cache = config['inference_config']['inference'].get('merged_replicate_cache', False)
+    data = InferenceDataset(loci_info, input_seq_path, input_features_path, esm_feature_path, assembly, chr_sizes, metadata_key = celltype, excluded_region_path = excluded_region_path, seq_encoding = seq_encoding, static_esm_feature = static_esm_feature,
+                            sample_size = sample_size, step_size = step_size,
+                            chunk_cache_size = chunk_cache_size, shared_chunk_cache = shared_chunk_cache,
+                            decoded_cache_dir = decoded_cache_dir, decoded_cache_size = decoded_cache_size, decoded_cache_mode = decoded_cache_mode,
+                            input_features_sample = input_features_sample,
+                            vcf_path = vcf_path, vcf_sample = vcf_sample, vcf_haplotype = vcf_haplotype,
+                            replicate_threads = replicate_threads, merged_replicate_cache = merged_replicate_cache,
+                            excluded_index = excluded_index, stacked_storage = stacked_storage)
+    return data
 
-    batch_size = config['inference_config']['inference']['batch_size']
-    num_workers = config['inference_config']['inference']['num_workers']
-    batch_size = min(batch_size, len(data) // 2 + 1) # Ensure at least 2 batches
-    dataloader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
-    return dataloader
+def get_variant_inputs(config):
+    ''' VCF path, sample and haplotype of a personal genome, None path for the reference genome '''
+    vcf = config['input_resource'].get('vcf', None)
+    vcf_path = None if vcf is None else os.path.join(config['input_resource']['root'], vcf)
+    vcf_sample = config['inference_config']['input'].get('vcf_sample', None)
+    vcf_haplotype = config['inference_config']['input'].get('vcf_haplotype', 0)
+    return vcf_path, vcf_sample, vcf_haplotype
+
+def load_input_shard_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index = None, stacked_storage = None):
+    ''' Stream inputs from the cell type's input shard, materializing it on first use '''
+    from chromnitron_data.input_shards import shard_key, shard_exists, materialize_input_shard, InputShardDataset
+    input_seq_path, input_features_path, esm_feature_path, excluded_region_path = get_input_paths(config, celltype, cap)
+    shard_root = config['inference_config']['inference'].get('input_shard_dir', None)
+    if shard_root is None:
+        shard_root = os.path.join(config['inference_config']['output']['path'], 'input_shards')
+    sample_size, step_size = get_window_plan(config)
+    key, sources = shard_key(input_seq_path, input_features_path, loci_info, chr_sizes, sample_size, step_size, excluded_region_path,
+                             variants = get_variant_inputs(config))
+    shard_dir = os.path.join(shard_root, f'{celltype}-{key}')
+    if not shard_exists(shard_dir):
+        print(f'Materializing input shard for {celltype} at {shard_dir}')
+        os.makedirs(shard_root, exist_ok=True)
+        data = build_inference_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index, stacked_storage)
+        num_workers = config['inference_config']['inference']['num_workers']
+        materialize_input_shard(data, shard_dir, sources, num_workers = num_workers)
+    seq_encoding = config['inference_config']['inference'].get('seq_encoding', 'onehot')
+    static_esm_feature = config['inference_config']['inference'].get('static_cap_embedding', False)
+    return InputShardDataset(shard_dir, esm_feature_path, metadata_key = celltype, seq_encoding = seq_encoding, static_esm_feature = static_esm_feature)
+
+def report_cache_stats(dataset):
+    cache_stats = dataset.cache_stats()
+    if cache_stats is None:
+        return
+    for input_name, stats in cache_stats.items():
+        if stats is None: # Inputs without a chunk cache, e.g. 2bit sequence
+            continue
+        print(f'Chunk cache {input_name}: {stats["hits"]} hits, {stats["misses"]} misses, {stats["evictions"]} evictions, hit rate {stats["hit_rate"]:.1%}')
 
 def verify_prediction_exists(config, celltype, cap):
     # Define save path
@@ -96,7 +242,7 @@ def verify_prediction_exists(config, celltype, cap):
         return True
     return False
 
-def run_inference(config, model, dataloader, celltype, cap, use_tqdm=True):
+def run_inference(config, model, dataloader, celltype, cap, use_tqdm=True, static_inputs=None):
 
     pred_cache = []
     label_cache_dict = {'chr': [],
@@ -110,30 +256,22 @@ def run_inference(config, model, dataloader, celltype, cap, use_tqdm=True):
     torch.backends.cuda.matmul.allow_tf32 = True
     torch.backends.cudnn.allow_tf32 = True
 
+    # Static inputs are shared by all samples, move them to device once
+    static_esm_embeddings = None
+    if static_inputs is not None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        static_esm_embeddings = torch.from_numpy(static_inputs['esm_feature']).to(device).float().transpose(-1, -2)
+
+    # Samplers that reorder windows for locality restore dataset order afterwards
+    batch_sampler = dataloader.batch_sampler
+
     # Run inference
     with torch.no_grad():
         if use_tqdm:
             from tqdm import tqdm
             dataloader = tqdm(dataloader)
         for batch in dataloader:
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            seq, input_features, esm_embeddings, loc_info = batch
-            seq = seq.to(device)
-            input_features = input_features.to(device)
-            esm_embeddings = esm_embeddings.to(device)
-
-            esm_embeddings = esm_embeddings.float().transpose(-1, -2)
-
-            batch_size, mini_bs, seq_len, seq_dim = seq.shape
-            seq = seq.view(batch_size * mini_bs, seq_len, seq_dim)
-            input_features = input_features.view(batch_size * mini_bs, -1)
-            seq = seq.transpose(1, 2).float()
-            input_features = input_features.unsqueeze(2).transpose(1, 2).float()
-
-            inputs = (seq, input_features)
-
-            preds, confidence = model(inputs, esm_embeddings)
-            preds = preds.detach().cpu().numpy()[:, 0, :]
+            preds, loc_info = predict_batch(model, batch, static_esm_embeddings)
             pred_cache.append(preds)
             label_cache_dict['start'].extend(loc_info[0].tolist())
             label_cache_dict['end'].extend(loc_info[1].tolist())
@@ -144,8 +282,131 @@ def run_inference(config, model, dataloader, celltype, cap, use_tqdm=True):
     # Exponential transform
     pred_cache = np.exp(pred_cache) - 1
     label_df = pd.DataFrame(label_cache_dict)
+    if hasattr(batch_sampler, 'restore_order'):
+        pred_cache = batch_sampler.restore_order(pred_cache)
+        label_df = batch_sampler.restore_order(label_df)
     return pred_cache, label_df
 
+def predict_batch(model, batch, static_esm_embeddings = None):
+    ''' Predictions of a batch before the exponential transform, (batch, length) '''
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    seq, input_features, esm_embeddings, loc_info = batch
+    seq = seq.to(device)
+    input_features = input_features.to(device)
+    if static_esm_embeddings is not None:
+        esm_embeddings = static_esm_embeddings
+    else:
+        esm_embeddings = esm_embeddings.to(device).float().transpose(-1, -2)
+
+    batch_size, mini_bs = seq.shape[:2]
+    seq = seq.view(batch_size * mini_bs, *seq.shape[2:])
+    input_features = input_features.view(batch_size * mini_bs, -1)
+    if seq.dtype != torch.uint8: # uint8 base codes are expanded to one-hot by the model
+        seq = seq.transpose(1, 2).float()
+    input_features = input_features.unsqueeze(2).transpose(1, 2).float()
+
+    inputs = (seq, input_features)
+
+    preds, confidence = model(inputs, esm_embeddings)
+    preds = preds.detach().cpu().numpy()[:, 0, :]
+    return preds, loc_info
+
+def run_variant_scoring(config, celltype_list, cap_list):
+    ''' Score the single nucleotide variants of a VCF for every (CAP, cell type) pair
+    Writes <output path>/<celltype>/<cap>/output/variant_scores.zarr
+    '''
+    from chromnitron_data.input_shards import order_jobs
+    from chromnitron_data.origami_infrastructure.variants import read_vcf_snvs
+    from chromnitron_data.variant_scoring import variant_loci, VariantScoringDataset
+    scoring_config = config['inference_config']['variant_scoring']
+    vcf_path = os.path.join(config['input_resource']['root'], scoring_config['vcf_path']) # Same root as input_resource.vcf
+    all_chr_sizes = get_chr_sizes(config, None)
+    variants = read_vcf_snvs(vcf_path, chrs = set(all_chr_sizes), pass_only = scoring_config.get('pass_only', True))
+    chr_sizes = get_chr_sizes(config, list(variants['chr'].unique()))
+    sample_size, step_size = get_window_plan(config)
+    loci_info = variant_loci(variants, chr_sizes, sample_size)
+    if len(loci_info) == 0:
+        print(f'No single nucleotide variants to score in {vcf_path}, skipping variant scoring')
+        return
+    print(f'Scoring {len(variants)} variants from {vcf_path}')
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    excluded_index = get_excluded_index(config)
+    stacked_storage = get_stacked_storage(config, chr_sizes)
+    model_cap = None
+    for cap, celltype in order_jobs(cap_list, celltype_list):
+        save_path = f'{config["inference_config"]["output"]["path"]}/{celltype}/{cap}/output/variant_scores.zarr'
+        if os.path.exists(save_path):
+            print(f'Variant scores already exist for {save_path}, skipping...')
+            continue
+        if cap != model_cap:
+            print(f'Loading model for {cap}')
+            model = load_chromnitron(config, cap)
+            model.to(device)
+            model_cap = cap
+        data = build_inference_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index, stacked_storage)
+        scoring_data = VariantScoringDataset(data, variants)
+        batch_size = config['inference_config']['inference']['batch_size']
+        num_workers = config['inference_config']['inference']['num_workers']
+        dataloader = torch.utils.data.DataLoader(scoring_data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        print(f'Scoring variants for {celltype} with {cap}')
+        scores = score_variants(model, dataloader, scoring_config.get('radius', 1024), static_inputs = scoring_data.get_static_inputs())
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        scores.save(save_path)
+
+def score_variants(model, dataloader, radius, use_tqdm=True, static_inputs=None):
+    ''' Stream predictions of a VariantScoringDataset into per-variant scores, full tracks are not kept '''
+    from chromnitron_data.variant_scoring import VariantScoreAccumulator
+    scores = VariantScoreAccumulator(dataloader.dataset, radius = radius)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    static_esm_embeddings = None
+    if static_inputs is not None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        static_esm_embeddings = torch.from_numpy(static_inputs['esm_feature']).to(device).float().transpose(-1, -2)
+    with torch.no_grad():
+        if use_tqdm:
+            from tqdm import tqdm
+            dataloader = tqdm(dataloader)
+        for batch in dataloader:
+            preds, loc_info = predict_batch(model, batch, static_esm_embeddings)
+            # Exponential transform
+            scores.add(np.exp(preds) - 1, loc_info[3])
+    return scores
+
+def run_input_attribution(config, loci_info, chrs, celltype_list, cap_list):
+    ''' Attribute predictions of every window to its sequence and ATAC-seq inputs for every (CAP, cell type) pair
+    Writes <output path>/<celltype>/<cap>/output/attribution.zarr
+    '''
+    from chromnitron_data.input_shards import order_jobs
+    from chromnitron_model.attribution import run_attribution
+    attribution_config = config['inference_config']['attribution']
+    method = attribution_config.get('method', 'gradient_x_input')
+    target_region = attribution_config.get('target_region', None)
+    steps = attribution_config.get('steps', 16)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    excluded_index = get_excluded_index(config)
+    chr_sizes = get_chr_sizes(config, chrs)
+    stacked_storage = get_stacked_storage(config, chr_sizes)
+    model_cap = None
+    for cap, celltype in order_jobs(cap_list, celltype_list):
+        save_path = f'{config["inference_config"]["output"]["path"]}/{celltype}/{cap}/output/attribution.zarr'
+        if os.path.exists(save_path):
+            print(f'Attribution already exists for {save_path}, skipping...')
+            continue
+        if cap != model_cap:
+            print(f'Loading model for {cap}')
+            model = load_chromnitron(config, cap)
+            model.to(device)
+            model_cap = cap
+        data = build_inference_dataset(config, celltype, loci_info, cap, chr_sizes, excluded_index, stacked_storage)
+        batch_size = config['inference_config']['inference']['batch_size']
+        num_workers = config['inference_config']['inference']['num_workers']
+        dataloader = torch.utils.data.DataLoader(data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        print(f'Running {method} attribution for {celltype} with {cap}')
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        run_attribution(model, dataloader, save_path, method, target_region, steps, static_inputs = data.get_static_inputs())
+
 def load_inputs(config):
     loci_info, chrs = read_region_bed(os.path.join(config['inference_config']['input']['root'], config['inference_config']['input']['locus_list_path']))
     celltype_list = read_list(os.path.join(config['inference_config']['input']['root'], config['inference_config']['input']['celltype_list_path']))
@@ -174,8 +435,9 @@ def get_chr_sizes(config, chrs):
         for line in file:
             chrom, size = line.strip().split('\t')
             chr_sizes[chrom] = int(size)
-    # Only includes chromosomes in chrs for easy processing
-    chr_sizes = {chr: chr_sizes[chr] for chr in chrs}
+    # Only includes chromosomes in chrs for easy processing, None keeps all chromosomes
+    if chrs is not None:
+        chr_sizes = {chr: chr_sizes[chr] for chr in chrs}
     return chr_sizes
 
 def read_list(list_path):
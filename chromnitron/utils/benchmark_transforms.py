@@ -0,0 +1,73 @@
+# Benchmark the sequence codec against the previous per-base implementations
+# Usage (from the chromnitron directory): python -m utils.benchmark_transforms
+import argparse
+import timeit
+import numpy as np
+import chromnitron_data.transforms as transforms
+
+def main():
+    args = parse_args()
+    benchmark(args.length, args.batch_size, args.repeat)
+
+def benchmark(length, batch_size, repeat):
+    rng = np.random.default_rng(0)
+    seq = ''.join(rng.choice(list('acgtn'), length))
+    seq_arr = np.array(list(seq))
+    batch_arr = np.array([list(seq)] * batch_size)
+    onehot = legacy_to_onehot(seq)
+
+    # Outputs must match the legacy implementations before timing them
+    assert np.array_equal(transforms.to_onehot(seq_arr), onehot)
+    assert transforms.onehot_to_base(onehot) == legacy_onehot_to_base(onehot)
+    assert np.array_equal(transforms.reverse_complement(onehot), legacy_reverse_complement(onehot))
+
+    onehot_buffer = np.empty((batch_size, length, 5), dtype = np.float32)
+    code_buffer = np.empty((batch_size, length), dtype = np.uint8)
+    cases = [
+        ('to_onehot', lambda: legacy_to_onehot(seq_arr), lambda: transforms.to_onehot(seq_arr)),
+        ('onehot_to_base', lambda: legacy_onehot_to_base(onehot), lambda: transforms.onehot_to_base(onehot)),
+        ('reverse_complement', lambda: legacy_reverse_complement(onehot), lambda: transforms.reverse_complement(onehot)),
+        (f'to_onehot x{batch_size} (batched, in place)',
+            lambda: [legacy_to_onehot(s) for s in batch_arr],
+            lambda: transforms.codes_to_onehot(transforms.encode_bases(batch_arr, out = code_buffer), out = onehot_buffer)),
+    ]
+    print(f'Sequence length: {length}, repeat: {repeat}')
+    print(f'{"function":<40}{"legacy (ms)":>14}{"codec (ms)":>14}{"speedup":>10}')
+    for name, legacy_fn, codec_fn in cases:
+        legacy_time = min(timeit.repeat(legacy_fn, number = 1, repeat = repeat)) * 1000
+        codec_time = min(timeit.repeat(codec_fn, number = 1, repeat = repeat)) * 1000
+        print(f'{name:<40}{legacy_time:>14.3f}{codec_time:>14.3f}{legacy_time / codec_time:>9.1f}x')
+
+# Reference implementations prior to the lookup table codec
+def legacy_to_onehot(seq):
+    seq_dict = {'a' : [1,0,0,0,0],
+                'c' : [0,1,0,0,0],
+                'g' : [0,0,1,0,0],
+                't' : [0,0,0,1,0],
+                'n' : [0,0,0,0,1]}
+    onehot_seq = [seq_dict[base] for base in seq]
+    return np.array(onehot_seq).astype(np.float32)
+
+def legacy_onehot_to_base(onehot_seq):
+    seq_dict = {0 : 'a',
+                1 : 'c',
+                2 : 'g',
+                3 : 't',
+                4 : 'n'}
+    base_seq = [seq_dict[onehot_base] for onehot_base in np.argmax(onehot_seq, axis = 1)]
+    return ''.join(base_seq)
+
+def legacy_reverse_complement(seq):
+    seq = seq[::-1].copy()
+    reversed_seq = np.concatenate([seq[:,3:4], seq[:,2:3], seq[:,1:2], seq[:,0:1], seq[:,4:5]], axis = 1)
+    return reversed_seq
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--length', type=int, required=False, default=8192)
+    parser.add_argument('--batch-size', type=int, required=False, default=8)
+    parser.add_argument('--repeat', type=int, required=False, default=20)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
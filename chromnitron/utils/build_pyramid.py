@@ -0,0 +1,20 @@
+import argparse
+from chromnitron_data.origami_infrastructure.pyramid import build_pyramid, DEFAULT_RESOLUTIONS
+
+# Add mean/max pyramid levels to an existing zarr track (e.g. ATAC-seq or prediction data.zarr),
+# read through Track(storage, resolution = <bp>) from the coarsest matching level
+
+def main():
+    args = parse_args()
+    build_pyramid(args.zarr_path, args.resolutions, args.aggregations, args.chunk_size)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zarr-path', type=str, required=True)
+    parser.add_argument('--resolutions', type=int, nargs='+', required=False, default=list(DEFAULT_RESOLUTIONS))
+    parser.add_argument('--aggregations', type=str, nargs='+', required=False, default=['mean', 'max'], choices=['mean', 'max'])
+    parser.add_argument('--chunk-size', type=int, required=False, default=1000000)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
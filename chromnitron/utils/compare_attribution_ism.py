@@ -0,0 +1,59 @@
+# Compare gradient attribution with exhaustive in-silico mutagenesis (ISM) around one position
+# Usage (from the chromnitron directory):
+#     python -m utils.compare_attribution_ism --config <config.yaml> --celltype <celltype> --cap <cap> --chr chr1 --position 1000000
+import argparse
+import numpy as np
+import torch
+from chromnitron_model.attribution import prepare_inputs, compare_with_ism
+from chromnitron_model.load_model import load_chromnitron
+from inference import load_yaml, get_window_plan, get_chr_sizes, get_excluded_index, build_inference_dataset
+
+def main():
+    args = parse_args()
+    config = load_yaml(args.config)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    sample_size, step_size = get_window_plan(config)
+    chr_sizes = get_chr_sizes(config, [args.chr])
+    # Locus of a single window centered on the position
+    start = min(max(args.position - sample_size // 2, 0), chr_sizes[args.chr] - sample_size)
+    data = build_inference_dataset(config, args.celltype, [[args.chr, start, start + sample_size]], args.cap, chr_sizes, get_excluded_index(config))
+    window_idx = data.find_windows(args.chr, args.position, args.position + 1, contained = True)
+    if len(window_idx) == 0:
+        raise ValueError(f'No window covers {args.chr}:{args.position}')
+    model = load_chromnitron(config, args.cap)
+    model.to(device)
+    sample = torch.utils.data.default_collate([data[int(window_idx[0])]])
+    static_inputs = data.get_static_inputs()
+    static_esm_embeddings = None
+    if static_inputs is not None:
+        static_esm_embeddings = torch.from_numpy(static_inputs['esm_feature']).to(device).float().transpose(-1, -2)
+    seq, input_features, esm_embeddings, loc_info = prepare_inputs(sample, device, static_esm_embeddings)
+    offset = args.position - int(loc_info[0][0])
+    ism_region = (max(offset - args.ism_radius, 0), min(offset + args.ism_radius + 1, seq.shape[-1]))
+    target_region = (max(offset - args.target_radius, 0), min(offset + args.target_radius + 1, seq.shape[-1]))
+    for method in args.methods:
+        result = compare_with_ism(model, seq, input_features, esm_embeddings, ism_region, target_region, method, args.steps)
+        print(f'{method}: pearson {result["pearson"]:.3f} over {result["ism_passes"] - 1} mutations, '
+              f'ISM {result["ism_passes"]} passes in {result["ism_seconds"]:.2f}s, '
+              f'attribution {result["attribution_passes"]} passes in {result["attribution_seconds"]:.2f}s')
+        if args.output_prefix is not None:
+            np.savez(f'{args.output_prefix}_{method}.npz', ism = result['ism'], attribution = result['attribution'],
+                     ism_region = np.array(ism_region) + int(loc_info[0][0]))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, required=True)
+    parser.add_argument('--celltype', type=str, required=True)
+    parser.add_argument('--cap', type=str, required=True)
+    parser.add_argument('--chr', type=str, required=True)
+    parser.add_argument('--position', type=int, required=True) # 0-based center of the mutated and target regions
+    parser.add_argument('--ism-radius', type=int, required=False, default=10) # Mutate every base within this distance (bp)
+    parser.add_argument('--target-radius', type=int, required=False, default=512) # Attribute predictions within this distance (bp)
+    parser.add_argument('--methods', type=str, nargs='+', required=False, default=['gradient_x_input', 'integrated_gradients'],
+                        choices=['gradient_x_input', 'integrated_gradients'])
+    parser.add_argument('--steps', type=int, required=False, default=16)
+    parser.add_argument('--output-prefix', type=str, required=False, default=None) # Save ISM and attribution deltas to <prefix>_<method>.npz
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
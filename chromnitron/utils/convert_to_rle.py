@@ -0,0 +1,34 @@
+import argparse
+from utils.io import bedgraph_to_rle, zarr_to_rle
+
+# Convert piecewise constant tracks to run-length encoded stores read by RLEStorage:
+# bedGraph coverage (e.g. Genrich) or dense zarr tracks (e.g. dynamic binning output)
+
+def main():
+    args = parse_args()
+    chr_sizes = read_chr_sizes(args.chrom_sizes)
+    if args.input_path.endswith('.zarr'):
+        zarr_to_rle(args.input_path, chr_sizes, args.output_path, args.block_size)
+    else:
+        bedgraph_to_rle(args.input_path, chr_sizes, args.output_path, args.block_size)
+
+def read_chr_sizes(chrom_sizes_path):
+    chr_sizes = {}
+    with open(chrom_sizes_path, 'r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            chr_name, length = line.split()[:2]
+            chr_sizes[chr_name] = int(length)
+    return chr_sizes
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-path', type=str, required=True) # .bedGraph file or .zarr track
+    parser.add_argument('--chrom-sizes', type=str, required=True)
+    parser.add_argument('--output-path', type=str, required=True) # e.g. <sample_name>.rle.zarr
+    parser.add_argument('--block-size', type=int, required=False, default=65536)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import argparse
+import os
+import numpy as np
+
+# Convert per-chromosome diagonal Hi-C .npz files (keys '0', '1', '-1', ... as read by HiCNpzStorage)
+# into banded .npy matrices read by HiCBandedStorage:
+#     <chr>.npy  (2 * max_diagonal + 1, chromosome length), row max_diagonal + d holds diagonal d
+
+def main():
+    args = parse_args()
+    hic_to_banded(args.input_dir, args.output_dir, args.max_diagonal, args.dtype)
+
+def hic_to_banded(input_dir, output_dir, max_diagonal, dtype = 'float32'):
+    os.makedirs(output_dir, exist_ok = True)
+    chr_names = sorted(name[:-len('.npz')] for name in os.listdir(input_dir) if name.endswith('.npz'))
+    for chr_name in chr_names:
+        print('Processing and saving', chr_name)
+        with np.load(os.path.join(input_dir, f'{chr_name}.npz')) as diagonals:
+            chr_length = len(diagonals['0'])
+            banded = np.lib.format.open_memmap(os.path.join(output_dir, f'{chr_name}.npy'), mode = 'w+',
+                                               dtype = dtype, shape = (2 * max_diagonal + 1, chr_length))
+            for diag_i in range(-max_diagonal, max_diagonal + 1):
+                if str(diag_i) not in diagonals:
+                    banded[max_diagonal + diag_i] = 0
+                    continue
+                diagonal = diagonals[str(diag_i)][:chr_length]
+                banded[max_diagonal + diag_i, :len(diagonal)] = diagonal
+                banded[max_diagonal + diag_i, len(diagonal):] = 0
+            banded.flush()
+            del banded
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', type=str, required=True) # Directory of <chr>.npz diagonal files
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--max-diagonal', type=int, required=True) # Number of diagonals kept on each side, e.g. window size in bins
+    parser.add_argument('--dtype', type=str, required=False, default='float32', choices=['float32', 'float16'])
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
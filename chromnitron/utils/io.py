@@ -21,15 +21,87 @@ def export_to_bigwig(bw_name, chr_sizes, data_dict):
             chroms = np.repeat(chr_name, len(starts))
             bw.addEntries(chroms, starts, ends, values=values)
 
-def export_to_zarr(zarr_name, chr_sizes, data_dict, chunk_size=1000000):
+def export_to_zarr(zarr_name, chr_sizes, data_dict, chunk_size=1000000, pyramid_resolutions=None, pyramid_aggregations=('mean', 'max')):
+    ''' Export tracks to zarr, optionally with pyramid levels (e.g. [32, 128, 1024]) for coarse queries '''
     import zarr
     import numcodecs
+    from chromnitron_data.origami_infrastructure.pyramid import write_pyramid_levels
     root = zarr.group(store = zarr_name, overwrite = True) # init zarr group
     zarr_compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.SHUFFLE) # Setup compressor
     for chr_name in chr_sizes.keys():
         print('Processing and saving', chr_name)
         chr_arr = data_dict[chr_name]
         root.create_dataset(f'chrs/{chr_name}', data = chr_arr, chunks = chunk_size, compressor = zarr_compressor)
+        if pyramid_resolutions:
+            write_pyramid_levels(root, chr_name, chr_arr, pyramid_resolutions, pyramid_aggregations, chunk_size)
+    if pyramid_resolutions:
+        root.attrs['pyramid'] = {'resolutions' : [int(r) for r in pyramid_resolutions], 'aggregations' : list(pyramid_aggregations)}
+
+def dense_to_runs(array):
+    ''' Run starts and values of a piecewise constant array, e.g. dynamic binning output '''
+    array = np.asarray(array)
+    starts = np.concatenate([[0], np.flatnonzero(array[1:] != array[:-1]) + 1])
+    return starts, array[starts]
+
+def bedgraph_to_runs(starts, ends, values, chr_length):
+    ''' Runs of a sorted, non-overlapping bedGraph chromosome, gaps are filled with 0 and equal neighbours merged '''
+    starts, ends, values = np.asarray(starts, dtype = np.int64), np.asarray(ends, dtype = np.int64), np.asarray(values, dtype = np.float32)
+    # Gap runs start where an interval ends before the next one starts
+    gap_starts = np.concatenate([[0], ends])
+    gap_ends = np.concatenate([starts, [chr_length]])
+    has_gap = gap_ends > gap_starts
+    run_starts = np.concatenate([starts, gap_starts[has_gap]])
+    run_values = np.concatenate([values, np.zeros(has_gap.sum(), dtype = np.float32)])
+    order = np.argsort(run_starts, kind = 'stable')
+    run_starts, run_values = run_starts[order], run_values[order]
+    keep = np.concatenate([[True], run_values[1:] != run_values[:-1]])
+    return run_starts[keep], run_values[keep]
+
+def export_to_rle(rle_name, chr_sizes, runs_dict, block_size=65536, dtype='float32'):
+    ''' Export run-length encoded tracks read by RLEStorage
+    runs_dict: dictionary of chromosome to (run starts, run values), runs cover the chromosome from 0.
+               Chromosomes of chr_sizes without runs are written as a single zero run
+    block_size: spacing of the block index of run positions
+    '''
+    import zarr
+    import numcodecs
+    root = zarr.group(store = rle_name, overwrite = True) # init zarr group
+    zarr_compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.SHUFFLE) # Setup compressor
+    root.attrs['format'] = 'rle'
+    root.attrs['block_size'] = block_size
+    for chr_name, chr_length in chr_sizes.items():
+        print('Processing and saving', chr_name)
+        starts, values = runs_dict.get(chr_name, ([0], [0])) # No coverage, e.g. sparse or filtered bedGraph
+        block_index = np.searchsorted(starts, np.arange(0, chr_length, block_size), side = 'right') - 1
+        chr_group = root.create_group(f'chrs/{chr_name}')
+        chr_group.attrs['length'] = int(chr_length)
+        chr_group.create_dataset('starts', data = np.asarray(starts, dtype = np.int64), chunks = 262144, compressor = zarr_compressor)
+        chr_group.create_dataset('values', data = np.asarray(values, dtype = dtype), chunks = 262144, compressor = zarr_compressor)
+        chr_group.create_dataset('block_index', data = block_index.astype(np.int64), compressor = zarr_compressor)
+
+def bedgraph_to_rle(bedgraph_name, chr_sizes, rle_name, block_size=65536):
+    ''' Convert a bedGraph (e.g. Genrich coverage) to a run-length encoded store '''
+    import pandas as pd
+    df = pd.read_csv(bedgraph_name, sep = '\t', header = None, usecols = [0, 1, 2, 3], comment = '#',
+                     names = ['chr', 'start', 'end', 'value'], dtype = {'chr' : str})
+    df = df[~df['chr'].isin(['track', 'browser'])]
+    runs_dict = {}
+    for chr_name, chr_df in df.groupby('chr', sort = False):
+        if chr_name not in chr_sizes:
+            continue
+        chr_df = chr_df.sort_values('start')
+        runs_dict[chr_name] = bedgraph_to_runs(chr_df['start'].values, chr_df['end'].values, chr_df['value'].values, chr_sizes[chr_name])
+    export_to_rle(rle_name, chr_sizes, runs_dict, block_size)
+
+def zarr_to_rle(zarr_name, chr_sizes, rle_name, block_size=65536):
+    ''' Convert a dense piecewise constant zarr track (e.g. dynamic binning output) to a run-length encoded store '''
+    import zarr
+    data_dict_zarr = zarr.open(zarr_name, mode = 'r')
+    runs_dict = {}
+    for chr_name in chr_sizes.keys():
+        if f'chrs/{chr_name}' in data_dict_zarr:
+            runs_dict[chr_name] = dense_to_runs(data_dict_zarr[f'chrs/{chr_name}'][:])
+    export_to_rle(rle_name, chr_sizes, runs_dict, block_size)
 
 def zarr_to_bigwig(zarr_name, chr_sizes, bigwig_name):
     import zarr
@@ -0,0 +1,48 @@
+import argparse
+import os
+import json
+import numpy as np
+
+# Pack per-CAP embeddings (CAP_embeddings/<cap>.npz with an 'embedding' array) into one
+# memory-mapped bank, read with chromnitron_data.cap_bank.CapEmbeddingBank:
+#     embeddings.npy  (total length, embedding dim), CAPs concatenated
+#     index.json      dtype, dim and [offset, length] of each CAP
+
+def main():
+    args = parse_args()
+    pack_cap_embeddings(args.input_dir, args.output_dir, args.dtype)
+
+def pack_cap_embeddings(input_dir, output_dir, dtype = 'float32'):
+    caps = sorted(name[:-len('.npz')] for name in os.listdir(input_dir) if name.endswith('.npz'))
+    if len(caps) == 0:
+        raise Exception(f'No .npz embeddings found in {input_dir}')
+    index = {'dtype' : dtype, 'dim' : None, 'caps' : {}}
+    offset = 0
+    for cap in caps:
+        with np.load(os.path.join(input_dir, f'{cap}.npz')) as data:
+            length, dim = data['embedding'].shape
+        if index['dim'] is not None and dim != index['dim']:
+            raise Exception(f'Embedding dimension of {cap} is not consistent: {dim} vs {index["dim"]}')
+        index['dim'] = dim
+        index['caps'][cap] = [offset, length]
+        offset += length
+    os.makedirs(output_dir, exist_ok = True)
+    embeddings = np.lib.format.open_memmap(os.path.join(output_dir, 'embeddings.npy'), mode = 'w+', dtype = dtype, shape = (offset, index['dim']))
+    for cap, (cap_offset, length) in index['caps'].items():
+        print('Packing', cap)
+        with np.load(os.path.join(input_dir, f'{cap}.npz')) as data:
+            embeddings[cap_offset : cap_offset + length] = data['embedding'].astype(dtype)
+    embeddings.flush()
+    del embeddings
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', type=str, required=True) # Directory of <cap>.npz embeddings
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--dtype', type=str, required=False, default='float32', choices=['float32', 'float16'])
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import numpy as np
+import zarr
+import numcodecs
+
+# Stack per-sample ATAC-seq zarr tracks (ATAC_seq/<sample>.zarr) into one store:
+#     chrs/<chr>: (samples, positions) array chunked along positions only
+#     root attrs: samples, dtype; chr attrs: scales (uint16 only, value = stored * scale per sample)
+# A chunk holds every sample, so the default chunk length shrinks with the number of samples to keep
+# chunks near CHUNK_BYTES, well below the inference chunk cache (chunk_cache_mb) that must hold them.
+
+CHUNK_BYTES = 16 * 1024 ** 2
+
+def main():
+    args = parse_args()
+    samples = read_samples(args.input_dir, args.sample_list)
+    stack_atac(args.input_dir, samples, args.output_path, args.dtype, args.chunk_size, args.cache_mb)
+
+def default_chunk_size(n_samples, dtype, chunk_bytes = CHUNK_BYTES, max_chunk_size = 1000000):
+    ''' Positions per chunk so that a (samples, positions) chunk stays near chunk_bytes, a multiple of 1024 '''
+    chunk_size = chunk_bytes // (n_samples * np.dtype(dtype).itemsize) // 1024 * 1024
+    return int(min(max_chunk_size, max(1024, chunk_size)))
+
+def stack_atac(input_dir, samples, output_path, dtype = 'float32', chunk_size = None, cache_mb = 256):
+    ''' Stack sample tracks
+    chunk_size: positions per chunk, None derives it from the number of samples and dtype
+    cache_mb: chunk_cache_mb used at inference, a warning is printed if one chunk does not fit
+    '''
+    if chunk_size is None:
+        chunk_size = default_chunk_size(len(samples), dtype)
+    chunk_bytes = len(samples) * chunk_size * np.dtype(dtype).itemsize
+    if cache_mb > 0 and chunk_bytes > cache_mb * 1024 ** 2:
+        print(f'Warning: chunks of {chunk_bytes / 1024 ** 2:.1f} MB exceed the {cache_mb} MB chunk cache and will not be cached, lower --chunk-size')
+    write_size = chunk_size * max(1, 1000000 // chunk_size) # Read sources in blocks of about 1 Mb
+    sources = [zarr.open(os.path.join(input_dir, f'{sample}.zarr'), mode = 'r')['chrs'] for sample in samples]
+    chr_names = [chr_name for chr_name in sources[0].keys() if all(chr_name in source for source in sources)]
+    root = zarr.group(store = output_path, overwrite = True) # init zarr group
+    zarr_compressor = numcodecs.Blosc(cname = 'zstd', clevel = 3, shuffle = numcodecs.Blosc.SHUFFLE) # Setup compressor
+    root.attrs['samples'] = list(samples)
+    root.attrs['dtype'] = dtype
+    for chr_name in chr_names:
+        print('Processing and saving', chr_name)
+        chr_length = len(sources[0][chr_name])
+        for sample, source in zip(samples, sources):
+            if len(source[chr_name]) != chr_length:
+                raise Exception(f'Chromosome length of {sample} is not consistent: {chr_name}')
+        scales = get_scales(sources, chr_name, write_size) if dtype == 'uint16' else None
+        chr_arr = root.create_dataset(f'chrs/{chr_name}', shape = (len(samples), chr_length), chunks = (len(samples), chunk_size),
+                                      dtype = dtype, compressor = zarr_compressor)
+        for block_start in range(0, chr_length, write_size):
+            block_end = min(block_start + write_size, chr_length)
+            block = np.stack([source[chr_name][block_start:block_end] for source in sources]).astype(np.float32)
+            chr_arr[:, block_start:block_end] = quantize(block, dtype, scales)
+        if scales is not None:
+            chr_arr.attrs['scales'] = scales.tolist()
+
+def get_scales(sources, chr_name, chunk_size):
+    ''' Per-sample uint16 quantization step so that the sample maximum maps to 65535 '''
+    maxima = np.zeros(len(sources))
+    for sample_idx, source in enumerate(sources):
+        chr_data = source[chr_name]
+        for block_start in range(0, len(chr_data), chunk_size):
+            maxima[sample_idx] = max(maxima[sample_idx], np.max(chr_data[block_start:block_start + chunk_size]))
+    scales = np.maximum(maxima, 0) / np.iinfo(np.uint16).max
+    scales[scales == 0] = 1.0
+    return scales
+
+def quantize(block, dtype, scales = None):
+    if dtype == 'uint16':
+        block = np.round(np.clip(block, 0, None) / scales[:, None])
+        return np.clip(block, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+    return block.astype(dtype)
+
+def read_samples(input_dir, sample_list):
+    if sample_list is None:
+        return sorted(name[:-len('.zarr')] for name in os.listdir(input_dir) if name.endswith('.zarr'))
+    samples = []
+    with open(sample_list, 'r') as file:
+        for line in file:
+            if line.strip() != '':
+                samples.append(line.strip())
+    return samples
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input-dir', type=str, required=True) # Directory of <sample>.zarr ATAC-seq tracks
+    parser.add_argument('--output-path', type=str, required=True)
+    parser.add_argument('--sample-list', type=str, required=False, default=None) # Text file, one sample per line. Defaults to all samples
+    parser.add_argument('--dtype', type=str, required=False, default='float32', choices=['float32', 'float16', 'uint16'])
+    parser.add_argument('--chunk-size', type=int, required=False, default=None) # Positions per chunk, defaults to about 16 MB chunks
+    parser.add_argument('--cache-mb', type=int, required=False, default=256) # chunk_cache_mb used at inference, to warn about chunks that do not fit
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()